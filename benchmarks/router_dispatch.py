@@ -0,0 +1,75 @@
+"""InteractionRouterの振り分けにかかる時間を、コグごとのon_interactionリスナーと比べるベンチマーク
+
+使い方:
+    python3 benchmarks/router_dispatch.py [ルートの数] [回数]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import discord
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from services.router import InteractionRouter
+
+
+async def handler(interaction, customFields):
+    pass
+
+
+def makeInteraction(prefix: str):
+    return SimpleNamespace(
+        type=discord.InteractionType.component,
+        data={
+            "component_type": discord.ComponentType.button.value,
+            "custom_id": f"{prefix},1234567890,0",
+        },
+    )
+
+
+def makeListener(prefix: str):
+    # これまでのコグのように、すべてのインタラクションを受け取ってcustom_idを調べるリスナー
+    async def listener(interaction):
+        try:
+            if interaction.data["component_type"] == 2:
+                customFields = interaction.data["custom_id"].split(",")
+                if customFields[0] == prefix:
+                    await handler(interaction, customFields)
+        except KeyError:
+            pass
+
+    return listener
+
+
+async def main(routeCount: int, iterations: int):
+    prefixes = [f"route{i}" for i in range(routeCount)]
+    for prefix in prefixes:
+        InteractionRouter.register(discord.ComponentType.button, prefix, handler)
+    listeners = [makeListener(prefix) for prefix in prefixes]
+    interactions = [makeInteraction(prefix) for prefix in prefixes]
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        await InteractionRouter.dispatch(interactions[i % routeCount])
+    router = (time.perf_counter() - start) / iterations
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        interaction = interactions[i % routeCount]
+        for listener in listeners:
+            await listener(interaction)
+    fanOut = (time.perf_counter() - start) / iterations
+
+    print(f"ルート数: {routeCount}, 回数: {iterations}")
+    print(f"InteractionRouter: {router * 1e6:.2f}µs/回")
+    print(f"リスナー: {fanOut * 1e6:.2f}µs/回")
+
+
+if __name__ == "__main__":
+    routeCount = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    asyncio.run(main(routeCount, iterations))
@@ -4,7 +4,18 @@ import traceback
 import discord
 from discord.ext import commands
 
+from services.account import AccountService
+from services.admission import AdmissionController
+from services.breaker import CircuitBreaker
 from services.database import Database
+from services.executor import PurchaseExecutor
+from services.history import HistoryService
+from services.jihanki import JihankiService
+from services.proxy import ProxyHealthService
+from services.render import RenderScheduler
+from services.router import InteractionRouter
+from services.transport import TransportPool
+from services.user import UserService
 
 
 class AdminCog(commands.Cog):
@@ -59,6 +70,74 @@ class AdminCog(commands.Cog):
         else:
             await ctx.reply("存在しません")
 
+    @commands.command("stats")
+    async def statsCommand(self, ctx: commands.Context):
+        if ctx.author.id != 1048448686914551879:
+            return
+
+        caches = {
+            **AccountService.sessionStats(),
+            "linkStatus": AccountService.linkStatusCache.stats(),
+            "jihanki": JihankiService.cache.stats(),
+            "user": UserService.cache.stats(),
+            "transport": TransportPool.stats(),
+            "purchase": PurchaseExecutor.stats(),
+            "admission": AdmissionController.stats(),
+            "history": HistoryService.stats(),
+            "render": RenderScheduler.stats(),
+            "router": InteractionRouter.stats(),
+            **(
+                {"panel": panel.renderCache.stats()}
+                if (panel := self.bot.get_cog("JihankiPanelCog"))
+                else {}
+            ),
+            **{
+                f"breaker:{name}": breaker.stats()
+                for name, breaker in CircuitBreaker.breakers.items()
+            },
+        }
+
+        embed = discord.Embed(title="統計", colour=discord.Colour.blurple())
+        # 埋め込みのフィールドは25個まで
+        for name, stats in list(caches.items())[:25]:
+            embed.add_field(
+                name=name,
+                value="\n".join(
+                    (
+                        f"{key}: `{value:.2%}`"
+                        if key == "hitRate"
+                        else (
+                            f"{key}: `{value:.2f}`"
+                            if isinstance(value, float)
+                            else f"{key}: `{value}`"
+                        )
+                    )
+                    for key, value in stats.items()
+                ),
+            )
+        await ctx.reply(embed=embed)
+
+    @commands.command("proxystatus")
+    async def proxyStatusCommand(self, ctx: commands.Context):
+        if ctx.author.id != 1048448686914551879:
+            return
+
+        lines = [
+            f"{'🟢' if health.healthy else '🔴'} `{ProxyHealthService.mask(proxy)}` "
+            f"遅延: `{f'{health.latency * 1000:.0f}ms' if health.latency is not None else '-'}` "
+            f"エラー率: `{health.errorRate:.0%}`"
+            for proxy, health in sorted(
+                ProxyHealthService.health.items(),
+                key=lambda item: item[1].latency or ProxyHealthService.timeout,
+            )
+        ]
+        embed = discord.Embed(
+            title="プロキシの状態",
+            description="\n".join(lines[:40]) or "まだ確認していません",
+            colour=discord.Colour.blurple(),
+        )
+        await ctx.reply(embed=embed)
+
     @commands.command("channel")
     async def channelCommand(self, ctx: commands.Context, channelId: int):
         channel = self.bot.get_channel(channelId)
@@ -89,8 +168,10 @@ class AdminCog(commands.Cog):
         successCount = 0
         failedCount = 0
 
-        for u in users:
-            user = await self.bot.fetch_user(u)
+        for user in (await UserService.getUsers(self.bot, users)).values():
+            if not user:
+                failedCount += 1
+                continue
             print(
                 f"username: {user.name} / userid: {user.id} / displayname: {user.display_name}"
             )
@@ -120,8 +201,10 @@ class AdminCog(commands.Cog):
         successCount = 0
         failedCount = 0
 
-        for u in users:
-            user = await self.bot.fetch_user(u)
+        for user in (await UserService.getUsers(self.bot, users)).values():
+            if not user:
+                failedCount += 1
+                continue
             print(
                 f"username: {user.name} / userid: {user.id} / displayname: {user.display_name}"
             )
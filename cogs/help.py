@@ -56,6 +56,9 @@ class HelpCog(commands.Cog):
             ).add_field(
                 name="/editgoods",
                 value="自販機の商品の中身を確認・修正します。",
+            ).add_field(
+                name="/addstock",
+                value="商品の在庫を補充します。1行に1つずつ、まとめて追加できます。",
             ).add_field(
                 name="/removegoods", value="自販機から商品を削除します。"
             ).add_field(
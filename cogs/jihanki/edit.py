@@ -1,4 +1,6 @@
+import math
 import os
+from typing import Awaitable, Callable, List
 
 import discord
 import dotenv
@@ -9,7 +11,7 @@ from discord.ext import commands
 from snowflake import SnowflakeGenerator
 
 from objects import Good, Jihanki
-from services.jihanki import JihankiService
+from services.jihanki import GoodNotFoundException, JihankiService
 
 dotenv.load_dotenv()
 
@@ -20,6 +22,69 @@ def isEmoji(s: str) -> bool:
     return s in emoji.EMOJI_DATA
 
 
+# 選択メニュー1つに表示する商品の数。選択肢は25個までなので、自販機パネルの「選択してください」の分を空けておく
+# 自販機パネル(panel.py)もこの値を使う
+PAGE_SIZE = 20
+
+
+def goodsView(
+    goods: List[Good],
+    onSelect: Callable[[discord.Interaction], Awaitable[None]],
+    page: int = 0,
+) -> discord.ui.View:
+    """商品を選択するメニューを作ります。商品が多い場合は、ページに分けて前後のボタンを付けます。
+
+    Args:
+        goods (List[Good]): 選択肢にする商品のリスト。
+        onSelect (Callable[[discord.Interaction], Awaitable[None]]): 商品が選択されたときに呼ばれる関数。
+        page (int, optional): 表示するページ。デフォルトは0です。
+
+    Returns:
+        discord.ui.View: 選択メニュー。
+    """
+    pageCount = max(math.ceil(len(goods) / PAGE_SIZE), 1)
+    page = min(max(page, 0), pageCount - 1)
+
+    view = discord.ui.View(timeout=None)
+    select = discord.ui.Select(
+        placeholder=(
+            f"商品を選択 ({page + 1}/{pageCount}ページ)" if pageCount > 1 else None
+        ),
+        options=[
+            discord.SelectOption(
+                label=f'{good.name} ({good.price}円) {"(在庫無限)" if good.infinite else f"(在庫: {good.stock}個)"}',
+                description=good.description,
+                value=str(good.id),
+            )
+            for good in goods[page * PAGE_SIZE : (page + 1) * PAGE_SIZE]
+        ],
+    )
+    select.callback = onSelect
+    view.add_item(select)
+
+    if pageCount > 1:
+
+        def move(to: int):
+            async def callback(interaction: discord.Interaction):
+                await interaction.response.edit_message(
+                    view=goodsView(goods, onSelect, to)
+                )
+
+            return callback
+
+        previousButton = discord.ui.Button(
+            label="前のページ", disabled=page <= 0, row=1
+        )
+        previousButton.callback = move(page - 1)
+        nextButton = discord.ui.Button(
+            label="次のページ", disabled=page >= pageCount - 1, row=1
+        )
+        nextButton.callback = move(page + 1)
+        view.add_item(previousButton)
+        view.add_item(nextButton)
+    return view
+
+
 class AddGoodsModal(discord.ui.Modal, title="商品を追加"):
     def __init__(
         self,
@@ -89,18 +154,21 @@ class AddGoodsModal(discord.ui.Modal, title="商品を追加"):
                 await interaction.followup.send(embed=embed, ephemeral=True)
                 return
 
-        jihanki.goods.append(
+        value = cipherSuite.encrypt(self.goodsValue.value.encode()).decode()
+        good = await JihankiService.addGood(
+            jihanki,
             Good(
                 name=self.name,
                 description=self.description,
                 price=self.price,
                 infinite=self.infinite,
-                value=cipherSuite.encrypt(self.goodsValue.value.encode()).decode(),
+                value=value if self.infinite else "",
                 emoji=self.emoji,
-            )
+            ),
         )
-
-        await JihankiService.editJihanki(jihanki, editGoods=True)
+        if not self.infinite:
+            await JihankiService.addStock(jihanki, good, [value])
+        interaction.client.dispatch("jihanki_update", jihanki.id)
         embed = discord.Embed(
             title="自販機に商品を追加しました", colour=discord.Colour.green()
         )
@@ -111,51 +179,55 @@ class EditGoodModal(discord.ui.Modal):
     def __init__(
         self,
         jihanki: Jihanki,
-        select: int,
+        good: Good,
         interaction: discord.Interaction,
     ):
-        super().__init__(title=f"{jihanki.goods[select].name} を編集")
+        super().__init__(title=f"{good.name} を編集")
 
         self.jihanki: Jihanki = jihanki
-        self.select: int = select
+        self.good: Good = good
         self.interaction: discord.Interaction = interaction
 
         self.name = discord.ui.TextInput(
             label="商品の名前",
             placeholder="愛情",
-            default=jihanki.goods[self.select].name,
+            default=self.good.name,
         )
         self.add_item(self.name)
 
         self.description = discord.ui.TextInput(
             label="商品の説明",
             placeholder="私の愛情を受け取ることができます",
-            default=jihanki.goods[self.select].description,
+            default=self.good.description,
         )
         self.add_item(self.description)
 
         self.price = discord.ui.TextInput(
             label="価格",
             placeholder="数字以外は受け付けません",
-            default=jihanki.goods[self.select].price,
+            default=self.good.price,
         )
         self.add_item(self.price)
 
         self.emoji = discord.ui.TextInput(
             label="ラベルの絵文字",
             placeholder="絵文字以外は受け付けません",
-            default=jihanki.goods[self.select].emoji,
+            default=self.good.emoji,
             required=False,
         )
         self.add_item(self.emoji)
 
-        self.value = discord.ui.TextInput(
-            label="内容",
-            placeholder="Chu!😘",
-            style=discord.TextStyle.long,
-            default=cipherSuite.decrypt(jihanki.goods[self.select].value).decode(),
-        )
-        self.add_item(self.value)
+        # 在庫のある商品の中身は /addstock で管理する
+        if self.good.infinite:
+            self.value = discord.ui.TextInput(
+                label="内容",
+                placeholder="Chu!😘",
+                style=discord.TextStyle.long,
+                default=cipherSuite.decrypt(self.good.value).decode(),
+            )
+            self.add_item(self.value)
+        else:
+            self.value = None
 
     def convertToInteger(self, numeric: str) -> str | bool:
         try:
@@ -165,8 +237,8 @@ class EditGoodModal(discord.ui.Modal):
 
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
-        self.jihanki.goods[self.select].name = self.name.value
-        self.jihanki.goods[self.select].description = self.description.value
+        self.good.name = self.name.value
+        self.good.description = self.description.value
         price = self.convertToInteger(self.price.value)
 
         if (price is False) or (price < 0):
@@ -178,10 +250,9 @@ class EditGoodModal(discord.ui.Modal):
             await interaction.followup.send(embed=embed)
             return
 
-        self.jihanki.goods[self.select].price = price
-        self.jihanki.goods[self.select].value = cipherSuite.encrypt(
-            self.value.value.encode()
-        ).decode()
+        self.good.price = price
+        if self.value:
+            self.good.value = cipherSuite.encrypt(self.value.value.encode()).decode()
         if self.emoji.value:
             emoji = discord.PartialEmoji.from_str(self.emoji.value)
             if not emoji.is_custom_emoji() and not isEmoji(emoji.name):
@@ -191,11 +262,12 @@ class EditGoodModal(discord.ui.Modal):
                 )
                 await interaction.followup.send(embed=embed, ephemeral=True)
                 return
-            self.jihanki.goods[self.select].emoji = self.emoji.value
+            self.good.emoji = self.emoji.value
         else:
-            self.jihanki.goods[self.select].emoji = None
+            self.good.emoji = None
 
-        await JihankiService.editJihanki(self.jihanki, editGoods=True)
+        await JihankiService.editGood(self.jihanki, self.good)
+        interaction.client.dispatch("jihanki_update", self.jihanki.id)
 
         embed = discord.Embed(
             title="編集しました！",
@@ -203,29 +275,16 @@ class EditGoodModal(discord.ui.Modal):
         )
         await interaction.followup.send(embed=embed, ephemeral=True)
 
-        view = discord.ui.View(timeout=None)
-        select = discord.ui.Select(
-            options=[
-                discord.SelectOption(
-                    label=f'{good.name} ({good.price}円) {"(在庫無限)" if good.infinite else ""}',
-                    description=good.description,
-                    value=index,
-                )
-                for index, good in enumerate(self.jihanki.goods[0:20])
-            ]
-        )
-
         async def editGoodsOnSelect(_interaction: discord.Interaction):
             await _interaction.response.send_modal(
                 EditGoodModal(
                     self.jihanki,
-                    int(_interaction.data["values"][0]),
+                    self.jihanki.getGood(int(_interaction.data["values"][0])),
                     interaction,
                 )
             )
 
-        select.callback = editGoodsOnSelect
-        view.add_item(select)
+        view = goodsView(self.jihanki.goods, editGoodsOnSelect)
         embed = discord.Embed(
             title="確認・編集する商品を選択してください", colour=discord.Colour.pink()
         )
@@ -233,6 +292,45 @@ class EditGoodModal(discord.ui.Modal):
         await self.interaction.edit_original_response(embed=embed, view=view)
 
 
+class AddStockModal(discord.ui.Modal):
+    def __init__(self, jihanki: Jihanki, good: Good):
+        super().__init__(title=f"{good.name[0:30]} の在庫を補充")
+        self.jihanki: Jihanki = jihanki
+        self.good: Good = good
+
+        self.values = discord.ui.TextInput(
+            label="追加する在庫 (1行に1つ)",
+            placeholder="XXXX-XXXX-XXXX\nYYYY-YYYY-YYYY",
+            style=discord.TextStyle.long,
+        )
+        self.add_item(self.values)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+        values = [
+            cipherSuite.encrypt(line.strip().encode()).decode()
+            for line in self.values.value.splitlines()
+            if line.strip()
+        ]
+        if not values:
+            embed = discord.Embed(
+                title="追加する在庫がありません",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+
+        stock = await JihankiService.addStock(self.jihanki, self.good, values)
+        interaction.client.dispatch("jihanki_update", self.jihanki.id)
+
+        embed = discord.Embed(
+            title="在庫を補充しました",
+            description=f"{len(values)}個追加しました。現在の在庫は**{stock}個**です。",
+            colour=discord.Colour.green(),
+        )
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+
 context = app_commands.AppCommandContext(guild=True)
 installs = app_commands.AppInstallationType(guild=True)
 jihankiGroup = app_commands.Group(
@@ -452,6 +550,7 @@ class JihankiEditCog(commands.Cog):
         jihanki.achievementChannelId = achievementChannelId
         jihanki.shuffle = shuffle.value
         await JihankiService.editJihanki(jihanki)
+        interaction.client.dispatch("jihanki_update", jihanki.id)
 
     # @goodsGroup.command(name="add", description="自販機に商品を追加します。")
     @app_commands.command(name="addgoods", description="自販機に商品を追加します。")
@@ -539,34 +638,81 @@ class JihankiEditCog(commands.Cog):
             )
             await interaction.followup.send(embed=embed, ephemeral=True)
             return
-        view = discord.ui.View(timeout=None)
-        select = discord.ui.Select(
-            options=[
-                discord.SelectOption(
-                    label=f'{good.name} ({good.price}円) {"(在庫無限)" if good.infinite else ""}',
-                    description=good.description,
-                    value=index,
-                )
-                for index, good in enumerate(jihanki.goods[0:20])
-            ]
-        )
 
         async def editGoodsOnSelect(_interaction: discord.Interaction):
             await _interaction.response.send_modal(
                 EditGoodModal(
                     jihanki,
-                    int(_interaction.data["values"][0]),
+                    jihanki.getGood(int(_interaction.data["values"][0])),
                     interaction,
                 )
             )
 
-        select.callback = editGoodsOnSelect
-        view.add_item(select)
+        view = goodsView(jihanki.goods, editGoodsOnSelect)
         embed = discord.Embed(
             title="確認・編集する商品を選択してください", colour=discord.Colour.pink()
         )
         await interaction.followup.send(embed=embed, view=view)
 
+    @app_commands.command(name="addstock", description="商品の在庫を補充します。")
+    @app_commands.autocomplete(_jihanki=JihankiService.getJihankiList)
+    @app_commands.rename(_jihanki="自販機")
+    @app_commands.describe(_jihanki="在庫を補充したい自販機")
+    @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
+    @app_commands.allowed_installs(guilds=True, users=False)
+    async def addStockCommand(
+        self,
+        interaction: discord.Interaction,
+        _jihanki: str,
+    ):
+        await interaction.response.defer(ephemeral=True)
+        try:
+            if _jihanki.isdigit():
+                jihanki = await JihankiService.getJihanki(
+                    interaction.user, id=int(_jihanki)
+                )
+            else:
+                jihanki = await JihankiService.getJihanki(
+                    interaction.user, name=_jihanki
+                )
+        except:
+            embed = discord.Embed(
+                title="指定された自販機は存在しません！",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        if jihanki.freezed:
+            embed = discord.Embed(
+                title=f"自販機が凍結されています\n```\n{jihanki.freezed}\n```",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+        goods = [good for good in jihanki.goods if not good.infinite]
+        if not goods:
+            embed = discord.Embed(
+                title="在庫を補充できる商品がありません",
+                description="在庫無限の商品には在庫を補充できません。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+
+        async def addStockOnSelect(_interaction: discord.Interaction):
+            await _interaction.response.send_modal(
+                AddStockModal(
+                    jihanki,
+                    jihanki.getGood(int(_interaction.data["values"][0])),
+                )
+            )
+
+        view = goodsView(goods, addStockOnSelect)
+        embed = discord.Embed(
+            title="在庫を補充する商品を選択してください", colour=discord.Colour.pink()
+        )
+        await interaction.followup.send(embed=embed, view=view)
+
     # @goodsGroup.command(name="remove", description="自販機の商品を削除します。")
     @app_commands.command(name="removegoods", description="自販機の商品を削除します。")
     @app_commands.autocomplete(_jihanki=JihankiService.getJihankiList)
@@ -603,23 +749,15 @@ class JihankiEditCog(commands.Cog):
             )
             await interaction.followup.send(embed=embed, ephemeral=True)
             return
-        view = discord.ui.View(timeout=None)
-        select = discord.ui.Select(
-            options=[
-                discord.SelectOption(
-                    label=f'{good.name} ({good.price}円) {"(在庫無限)" if good.infinite else ""}',
-                    description=good.description,
-                    value=index,
-                )
-                for index, good in enumerate(jihanki.goods[0:20])
-            ]
-        )
 
         async def removeGoodsOnSelect(_interaction: discord.Interaction):
             await _interaction.response.defer(ephemeral=True)
             try:
-                jihanki.goods.remove(jihanki.goods[int(_interaction.data["values"][0])])
-                await JihankiService.editJihanki(jihanki, editGoods=True)
+                good = jihanki.getGood(int(_interaction.data["values"][0]))
+                jihanki.goods.remove(good)
+                if not await JihankiService.deleteGood(jihanki, good):
+                    raise GoodNotFoundException()
+                _interaction.client.dispatch("jihanki_update", jihanki.id)
 
                 embed = discord.Embed(
                     title="自販機から商品を削除しました",
@@ -627,20 +765,7 @@ class JihankiEditCog(commands.Cog):
                 )
                 await _interaction.followup.send(embed=embed, ephemeral=True)
 
-                view = discord.ui.View(timeout=None)
-                select = discord.ui.Select(
-                    options=[
-                        discord.SelectOption(
-                            label=f'{good.name} ({good.price}円) {"(在庫無限)" if good.infinite else ""}',
-                            description=good.description,
-                            value=index,
-                        )
-                        for index, good in enumerate(jihanki.goods[0:20])
-                    ]
-                )
-
-                select.callback = removeGoodsOnSelect
-                view.add_item(select)
+                view = goodsView(jihanki.goods, removeGoodsOnSelect)
                 embed = discord.Embed(
                     title="確認・編集する商品を選択してください",
                     colour=discord.Colour.pink(),
@@ -653,8 +778,7 @@ class JihankiEditCog(commands.Cog):
                 )
                 await interaction.followup.send(embed=embed, ephemeral=True)
 
-        select.callback = removeGoodsOnSelect
-        view.add_item(select)
+        view = goodsView(jihanki.goods, removeGoodsOnSelect)
         embed = discord.Embed(
             title="確認・編集する商品を選択してください", colour=discord.Colour.pink()
         )
@@ -3,23 +3,34 @@ import random
 import os
 import traceback
 import math
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+from zoneinfo import ZoneInfo
 
 import aiohttp
 import dotenv
 import discord
 from cryptography.fernet import Fernet
 from discord import app_commands
-from discord.ext import commands
-from snowflake import SnowflakeGenerator
+from discord.ext import commands, tasks
 
 # from .edit import jihankiGroup, goodsGroup
+from .edit import PAGE_SIZE
 
 from services.jihanki import JihankiService
-from services.database import Database
-from services.account import AccountService
+from services.user import UserService
+from services.account import AccountService, PaymentStatusUnknown
+from services.admission import AdmissionController, Overloaded
+from services.breaker import ProviderUnavailable
+from services.cache import TTLCache
+from services.intent import IntentAlreadyExists, IntentService
+from services.panel import PanelService
 from services.payment import PaymentService, MoneyNotEnough
+from services.render import RenderScheduler
+from services.reservation import ReservationService
+from services.router import InteractionRouter
 
-from objects import Jihanki, Good, PaymentType
+from objects import Jihanki, Good, PaymentIntent, PaymentType
 
 dotenv.load_dotenv()
 
@@ -42,33 +53,103 @@ class JihankiPanelCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.botOwner: discord.User = None
+        self.renderCache: TTLCache[tuple, tuple] = TTLCache(maxsize=512, ttl=600)
         self.ctxUpdateJihanki = app_commands.ContextMenu(
             name="自販機を再読み込み",
             callback=self.updateJihankiContextMenu,
         )
         self.bot.tree.add_command(self.ctxUpdateJihanki)
 
+    async def cog_load(self) -> None:
+        InteractionRouter.register(discord.ComponentType.select, "buy", self.buy)
+        InteractionRouter.register(discord.ComponentType.button, "page", self.showPage)
+        self.releaseExpiredReservations.start()
+        self.resumeIntents.start()
+
     async def cog_unload(self) -> None:
+        InteractionRouter.unregister(discord.ComponentType.select, "buy")
+        InteractionRouter.unregister(discord.ComponentType.button, "page")
+        self.releaseExpiredReservations.cancel()
+        self.resumeIntents.cancel()
         self.bot.tree.remove_command(
             self.ctxUpdateJihanki.name, type=self.ctxUpdateJihanki.type
         )
 
+    @tasks.loop(seconds=30)
+    async def releaseExpiredReservations(self):
+        """期限切れの在庫の確保を解放し、影響を受けたパネルを再描画します。"""
+        released = await ReservationService.releaseExpired()
+
+        for jihankiId in released:
+            self.bot.dispatch("jihanki_update", jihankiId)
+
+    @releaseExpiredReservations.before_loop
+    async def beforeReleaseExpiredReservations(self):
+        await self.bot.wait_until_ready()
+
+    @commands.Cog.listener()
+    async def on_jihanki_update(self, jihankiId: int):
+        """自販機が変更されたときに、登録されているすべてのパネルを再描画します。"""
+        try:
+            panels = await PanelService.getPanels(jihankiId)
+            if not panels:
+                return
+            jihanki = await JihankiService.getJihanki(None, id=jihankiId)
+        except:
+            traceback.print_exc()
+            return
+
+        for channelId, messageId in panels:
+            message = self.bot.get_partial_messageable(channelId).get_partial_message(
+                messageId
+            )
+            self.scheduleUpdate(jihanki, message)
+
+    @tasks.loop(minutes=1)
+    async def resumeIntents(self):
+        """再起動などで途中で止まった決済を、止まった段階から再開します。"""
+        now = datetime.now(ZoneInfo("Asia/Tokyo"))
+        for intent in await IntentService.getStuck(timedelta(minutes=2)):
+            try:
+                if intent.state == "created":
+                    # 決済が通ったかどうかはわからないので、失敗にはせず運営が確認する
+                    if now - intent.createdAt > timedelta(minutes=15):
+                        await IntentService.markUnknown(
+                            intent, "決済が完了したか確認できませんでした"
+                        )
+                    continue
+
+                if intent.kind == "BUY":
+                    buyer = await UserService.getUser(self.bot, intent.userId)
+                    await self.fulfillIntent(intent, buyer)
+                else:
+                    if intent.state == "paid":
+                        await IntentService.advance(intent, "delivered")
+                    await IntentService.record(intent)
+            except:
+                traceback.print_exc()
+                await IntentService.touch(intent, traceback.format_exc())
+
+    @resumeIntents.before_loop
+    async def beforeResumeIntents(self):
+        await self.bot.wait_until_ready()
+
     async def sendSaleMessage(
         self,
-        interaction: discord.Interaction,
+        buyer: discord.User,
         jihanki: Jihanki,
         good: Good,
         service: PaymentType,
     ):
-        owner = await self.bot.fetch_user(jihanki.ownerId)
+        owner = await UserService.getUser(self.bot, jihanki.ownerId)
 
         try:
             embed = (
                 discord.Embed(title="商品が購入されました")
-                .set_thumbnail(url=interaction.user.display_avatar.url)
+                .set_thumbnail(url=buyer.display_avatar.url)
                 .add_field(
                     name="ユーザー",
-                    value=f"{interaction.user.mention} (ID: `{interaction.user.name}`)",
+                    value=f"{buyer.mention} (ID: `{buyer.name}`)",
                 )
                 .add_field(
                     name="商品",
@@ -95,10 +176,10 @@ class JihankiPanelCog(commands.Cog):
                             .set_author(
                                 name=owner.display_name, icon_url=owner.display_avatar
                             )
-                            .set_thumbnail(url=interaction.user.display_avatar)
+                            .set_thumbnail(url=buyer.display_avatar)
                             .add_field(
                                 name="ユーザー",
-                                value=f"{interaction.user.mention}",
+                                value=f"{buyer.mention}",
                             )
                             .add_field(
                                 name="商品",
@@ -118,10 +199,10 @@ class JihankiPanelCog(commands.Cog):
             traceback.print_exc()
 
     async def sendPurchaseMessage(
-        self, interaction: discord.Interaction, jihanki: Jihanki, good: Good
+        self, buyer: discord.User, jihanki: Jihanki, good: Good
     ):
         try:
-            owner = await self.bot.fetch_user(jihanki.ownerId)
+            owner = await UserService.getUser(self.bot, jihanki.ownerId)
             embed = (
                 discord.Embed(title="購入明細書")
                 .add_field(
@@ -141,32 +222,209 @@ class JihankiPanelCog(commands.Cog):
                     value=f"```\n{cipherSuite.decrypt(good.value).decode()}\n```",
                 )
             )
-            await interaction.user.send(embed=embed)
+            await buyer.send(embed=embed)
         except:
             traceback.print_exc()
 
-    async def updateJihanki(self, jihanki: Jihanki, message: discord.Message):
-        owner = await self.bot.fetch_user(jihanki.ownerId)
+    async def sendRefundNotice(
+        self, intent: PaymentIntent, buyer: Optional[discord.User]
+    ):
+        """決済の後に在庫がなくなっていた購入を、自販機のオーナーと運営に知らせます。"""
+        jihanki = IntentService.getJihanki(intent)
+        good = Good.model_validate_json(intent.good)
+        embed = (
+            discord.Embed(
+                title="返金が必要な購入があります",
+                description="決済は完了していますが、在庫がなくなっていたため商品を受け渡せませんでした。\n購入したユーザーへ返金してください。",
+                colour=discord.Colour.red(),
+            )
+            .add_field(
+                name="ユーザー",
+                value=(
+                    f"{buyer.mention} (ID: `{buyer.name}`)"
+                    if buyer
+                    else f"<@{intent.userId}>"
+                ),
+            )
+            .add_field(name="自販機", value=jihanki.name)
+            .add_field(name="商品", value=f"{good.name} ({good.price}円)")
+            .add_field(name="種別", value=serviceString(intent.paymentType))
+            .set_footer(text=f"決済ID: {intent.id}")
+        )
 
-        embed = discord.Embed(
-            title=jihanki.name,
-            description=f"{jihanki.description}\nオーナー: {owner.mention} (`{owner.name}`)\n最終更新: {discord.utils.format_dt(discord.utils.utcnow())}\n\n-# 商品を購入する前に、<@1289535525681627156> からのDMを許可してください。\n-# 許可せずに商品を購入し、商品が受け取れなかった場合、責任を負いませんのでご了承ください。",
-            colour=discord.Colour.og_blurple(),
+        try:
+            owner = await UserService.getUser(self.bot, jihanki.ownerId)
+            await owner.send(embed=embed)
+        except:
+            traceback.print_exc()
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                webhook = discord.Webhook.from_url(
+                    os.getenv("error_webhook"), session=session
+                )
+                await webhook.send(embed=embed)
+        except:
+            traceback.print_exc()
+
+    async def fulfillIntent(
+        self, intent: PaymentIntent, buyer: Optional[discord.User]
+    ) -> bool:
+        """決済の終わった購入の商品を受け渡し、履歴に記録します。
+        途中で止まった購入を再開するときにも使います。
+
+        Args:
+            intent (PaymentIntent): 購入の決済。
+            buyer (Optional[discord.User]): 購入したユーザー。
+
+        Returns:
+            bool: 商品を受け渡せたかどうか。在庫がなかった場合は返金が必要なことを記録し、Falseを返します。
+        """
+        if intent.state == "paid":
+            if await IntentService.takeStock(intent) is None:
+                # お金は受け取っているので、失敗にはせず返金が必要なことを知らせる
+                if await IntentService.requireRefund(intent, "在庫がありませんでした"):
+                    await self.sendRefundNotice(intent, buyer)
+                return False
+            jihanki = IntentService.getJihanki(intent)
+            good = IntentService.getGood(intent)
+            await self.sendSaleMessage(buyer, jihanki, good, intent.paymentType)
+            await self.sendPurchaseMessage(buyer, jihanki, good)
+            await IntentService.advance(intent, "delivered")
+            if not good.infinite:
+                self.bot.dispatch("jihanki_update", jihanki.id)
+
+        if intent.state == "delivered":
+            await IntentService.record(intent)
+        return True
+
+    def scheduleUpdate(
+        self,
+        jihanki: Jihanki,
+        message: discord.Message | discord.PartialMessage,
+        *,
+        delay: Optional[float] = None,
+    ) -> asyncio.Future:
+        """パネルの再描画を予約します。短い間に何度も頼まれた場合は、最後のものだけを描画します。
+
+        Args:
+            jihanki (Jihanki): 描画する自販機。
+            message (discord.Message | discord.PartialMessage): パネルのメッセージ。
+            delay (Optional[float], optional): ほかの依頼を待つ時間(秒)。デフォルトはNoneです。
+
+        Returns:
+            asyncio.Future: 再描画が終わったときに完了するFuture。
+        """
+
+        async def render():
+            try:
+                await self.updateJihanki(jihanki, message)
+            except discord.NotFound:
+                # パネルが削除されていたら、次から再描画しない
+                await PanelService.remove(message.id)
+                raise
+
+        return RenderScheduler.schedule(
+            message.channel.id, message.id, render, delay=delay
         )
 
-        view = discord.ui.View(timeout=None)
+    def renderKey(
+        self, jihanki: Jihanki, owner: discord.User, page: int, goods: list[Good]
+    ) -> tuple:
+        """パネルの見た目を決める内容をまとめたキーを返します。内容が変わるとキーも変わります。"""
+        return (
+            jihanki.id,
+            jihanki.name,
+            jihanki.description,
+            page,
+            tuple(
+                (
+                    good.id,
+                    good.name,
+                    good.price,
+                    good.infinite,
+                    good.stock,
+                    good.description,
+                    good.emoji,
+                )
+                for good in goods
+            ),
+            (owner.id, owner.name),
+        )
+
+    def renderParts(
+        self, jihanki: Jihanki, owner: discord.User, page: int = 0
+    ) -> tuple[str, str, list[discord.SelectOption], int, int]:
+        """パネルの説明文と、指定したページの商品の選択肢を作ります。
+        内容が変わっていなければ、前回作ったものを返します。
+
+        Args:
+            jihanki (Jihanki): 描画する自販機。
+            owner (discord.User): 自販機のオーナー。
+            page (int, optional): 表示するページ。デフォルトは0です。
+
+        Returns:
+            tuple[str, str, list[discord.SelectOption], int, int]: 最終更新日時の前後の説明文、商品の選択肢、実際に表示するページ、ページ数。
+        """
+        # 商品を1回なめるだけなので、内容からキャッシュのキーを作るのと変わらない。選択肢の作成だけをキャッシュする
+        available = [good for good in jihanki.goods if good.infinite or good.stock > 0]
+        pageCount = max(math.ceil(len(available) / PAGE_SIZE), 1)
+        page = min(max(page, 0), pageCount - 1)
+        # 表示するページの商品だけを選択肢にする
+        goods = available[page * PAGE_SIZE : (page + 1) * PAGE_SIZE]
+
+        key = self.renderKey(jihanki, owner, page, goods)
+        parts = self.renderCache.get(key)
+        if parts:
+            return (*parts, page, pageCount)
+
+        head = f"{jihanki.description}\nオーナー: {owner.mention} (`{owner.name}`)\n最終更新: "
+        tail = "\n\n-# 商品を購入する前に、<@1289535525681627156> からのDMを許可してください。\n-# 許可せずに商品を購入し、商品が受け取れなかった場合、責任を負いませんのでご了承ください。"
         items = [
             discord.SelectOption(
-                label=f"{good.name} ({good.price}円)",
+                label=(
+                    f"{good.name} ({good.price}円)"
+                    if good.infinite
+                    else f"{good.name} ({good.price}円) 残り{good.stock}個"
+                ),
                 description=good.description,
-                value=index,
+                value=str(good.id),
                 emoji=(
                     discord.PartialEmoji.from_str(good.emoji) if good.emoji else None
                 ),
             )
-            for index, good in enumerate(jihanki.goods[0:19])
+            for good in goods
         ]
-        random.shuffle(items)
+        parts = (head, tail, items)
+        self.renderCache.set(key, parts)
+        return (*parts, page, pageCount)
+
+    async def buildPanel(
+        self, jihanki: Jihanki, page: int = 0
+    ) -> tuple[discord.Embed, discord.ui.View]:
+        """自販機パネルの埋め込みとビューを作ります。
+
+        Args:
+            jihanki (Jihanki): 描画する自販機。
+            page (int, optional): 表示するページ。デフォルトは0です。
+
+        Returns:
+            tuple[discord.Embed, discord.ui.View]: パネルの埋め込みとビュー。
+        """
+        owner = await UserService.getUser(self.bot, jihanki.ownerId)
+        head, tail, items, page, pageCount = self.renderParts(jihanki, owner, page)
+
+        # 最終更新日時と並び順だけは、描画のたびに作り直す
+        embed = discord.Embed(
+            title=jihanki.name,
+            description=f"{head}{discord.utils.format_dt(discord.utils.utcnow())}{tail}",
+            colour=discord.Colour.og_blurple(),
+        )
+        if pageCount > 1:
+            embed.set_footer(text=f"{page + 1}/{pageCount}ページ")
+
+        view = discord.ui.View(timeout=None)
+        items = random.sample(items, len(items))
         items.insert(
             0,
             discord.SelectOption(
@@ -178,16 +436,82 @@ class JihankiPanelCog(commands.Cog):
         )
         view.add_item(
             discord.ui.Select(
-                custom_id=f"buy,{jihanki.id}",
+                custom_id=f"buy,{jihanki.id},{page}",
                 options=items,
             ),
         )
+        if pageCount > 1:
+            view.add_item(
+                discord.ui.Button(
+                    label="前のページ",
+                    custom_id=f"page,{jihanki.id},{page - 1}",
+                    disabled=page <= 0,
+                    row=1,
+                )
+            )
+            view.add_item(
+                discord.ui.Button(
+                    label="次のページ",
+                    custom_id=f"page,{jihanki.id},{page + 1}",
+                    disabled=page >= pageCount - 1,
+                    row=1,
+                )
+            )
+        return embed, view
 
+    async def updateJihanki(self, jihanki: Jihanki, message: discord.Message):
+        # 共有のパネルは常に最初のページを表示する
+        embed, view = await self.buildPanel(jihanki)
         await message.edit(embed=embed, view=view)
 
+    async def showPage(self, interaction: discord.Interaction, customFields: list[str]):
+        """パネルのほかのページを表示します。
+        共有のパネルはほかのユーザーも使っているので、押したユーザーにだけ見えるメッセージで表示します。"""
+        jihanki = await JihankiService.getJihanki(None, id=int(customFields[1]))
+        embed, view = await self.buildPanel(jihanki, int(customFields[2]))
+        if interaction.message and interaction.message.flags.ephemeral:
+            await interaction.response.edit_message(embed=embed, view=view)
+        else:
+            await interaction.response.send_message(
+                embed=embed, view=view, ephemeral=True
+            )
+
     async def buy(self, interaction: discord.Interaction, customFields: list[str]):
-        _interaction = interaction
         await interaction.response.defer(ephemeral=True)
+        try:
+            async with AdmissionController.admit():
+                await self.buyProcess(interaction, customFields)
+        except Overloaded:
+            await self.sendBusyMessage(interaction)
+
+    async def sendBusyMessage(self, interaction: discord.Interaction):
+        embed = discord.Embed(
+            title="ただいま混み合っています",
+            description="少し時間をおいてから、もう一度お試しください。\n-# 決済は行われていません。",
+            colour=discord.Colour.red(),
+        )
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    async def sendDuplicateMessage(self, interaction: discord.Interaction):
+        embed = discord.Embed(
+            title="この購入はすでに処理中か、完了しています",
+            description="二重に支払わないよう、同じ購入の決済は1回だけ行います。\n商品が届かない場合は、[サポートサーバー](https://discord.gg/PN3KWEnYzX)へ連絡してください。",
+            colour=discord.Colour.red(),
+        )
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    async def sendStatusUnknownMessage(self, interaction: discord.Interaction):
+        embed = discord.Embed(
+            title="決済が完了したか確認できませんでした",
+            description="決済サービスとの通信が途切れました。**二重に支払わないよう、もう一度購入しないでください。**\n運営が決済の状況を確認します。しばらくしても商品が届かない場合は、[サポートサーバー](https://discord.gg/PN3KWEnYzX)へ連絡してください。",
+            colour=discord.Colour.orange(),
+        )
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    async def buyProcess(
+        self, interaction: discord.Interaction, customFields: list[str]
+    ):
+        _interaction = interaction
         if interaction.data["values"][0] == "-1":
             return
         jihanki = await JihankiService.getJihanki(
@@ -237,9 +561,8 @@ class JihankiPanelCog(commands.Cog):
             await interaction.followup.send(embed=embed, ephemeral=True)
             return
 
-        try:
-            good = jihanki.goods[int(interaction.data["values"][0])]
-        except:
+        good = jihanki.getGood(int(interaction.data["values"][0]))
+        if not good:
             embed = discord.Embed(
                 title="エラーが発生しました。",
                 description="商品が存在しません。\n**メッセージを長押し、または右クリック**し、「**アプリ**」を選択し、「**自販機を再読み込み**」を選択してみてください。\n購入しようとしていた商品が存在しない場合は、オーナーに連絡してみてください。",
@@ -248,47 +571,99 @@ class JihankiPanelCog(commands.Cog):
             await interaction.followup.send(embed=embed)
             return
 
-        asyncio.create_task(self.updateJihanki(jihanki, _interaction.message))
-
-        async def postProcessing(type: PaymentType):
-            await self.sendSaleMessage(interaction, jihanki, good, type)
-            await self.sendPurchaseMessage(interaction, jihanki, good)
-
-            if not good.infinite:
-                jihanki.goods.remove(good)
-                await JihankiService.editJihanki(jihanki, editGoods=True)
-
-                await self.updateJihanki(jihanki, interaction.message)
-
-            gen = SnowflakeGenerator(15)
-            paymentId = next(gen)
-
-            _jihanki = jihanki
-            del _jihanki.goods
+        # 表示される在庫の数には自分が確保している分が含まれないので、確保していれば選び直せるようにする
+        if (
+            not good.infinite
+            and good.stock <= 0
+            and not ReservationService.find(interaction.user.id, good.id)
+        ):
+            embed = discord.Embed(
+                title="売り切れです",
+                description="オーナーが在庫を補充するまでお待ちください。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
 
-            await Database.pool.execute(
-                "INSERT INTO history (id, jihanki, good, user_id, to_id, type, amount) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                paymentId,
-                _jihanki.model_dump_json(),
-                good.model_dump_json(),
+        reservation = None
+        previousStock = good.stock
+        if not good.infinite:
+            reservation = await ReservationService.reserve(
+                jihanki,
+                good,
                 interaction.user.id,
-                _jihanki.ownerId,
-                "BUY",
-                -good.price,
+                channelId=interaction.channel_id,
+                messageId=interaction.message.id,
             )
+            if not reservation:
+                embed = discord.Embed(
+                    title="売り切れです",
+                    description="ほかのユーザーが決済中の可能性があります。しばらくしてからもう一度お試しください。",
+                    colour=discord.Colour.red(),
+                )
+                await interaction.followup.send(embed=embed, ephemeral=True)
+                return
 
-            paymentId = next(gen)
-
-            await Database.pool.execute(
-                "INSERT INTO history (id, jihanki, good, user_id, to_id, type, amount) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                paymentId,
-                _jihanki.model_dump_json(),
-                good.model_dump_json(),
-                _jihanki.ownerId,
-                interaction.user.id,
-                "GOT_BUY",
-                good.price,
+        # ページ送りで表示した本人にだけ見えるパネルは登録しない
+        if not _interaction.message.flags.ephemeral:
+            await PanelService.register(
+                jihanki.id, _interaction.channel_id, _interaction.message.id
+            )
+        if reservation and good.stock != previousStock:
+            # 在庫の数が変わったので、この自販機のすべてのパネルを再描画する
+            self.bot.dispatch("jihanki_update", jihanki.id)
+        elif not _interaction.message.flags.ephemeral:
+            # 選択メニューを元に戻すため、操作されたパネルだけを再描画する
+            self.scheduleUpdate(jihanki, _interaction.message)
+
+        async def pay(
+            interaction: discord.Interaction,
+            type: PaymentType,
+            payment: Optional[Callable[[], Awaitable[None]]] = None,
+            *,
+            link: Optional[str] = None,
+        ) -> PaymentIntent:
+            # ボタンの連打やモーダルの再送信で二重に決済しないように、同じ購入には同じキーを使う
+            # 在庫の行は解放された後にほかのユーザーが確保し直すので、確保ごとのトークンも含める
+            if reservation:
+                key = f"buy:{reservation.id}:{reservation.userId}:{reservation.token}"
+            elif link:
+                key = f"buy:link:{link}"
+            else:
+                key = f"buy:{_interaction.id}"
+            intent = await IntentService.create(
+                key,
+                kind="BUY",
+                userId=interaction.user.id,
+                toId=jihanki.ownerId,
+                amount=good.price,
+                paymentType=type,
+                jihanki=jihanki,
+                good=good,
+                reservation=reservation,
             )
+            if payment:
+                try:
+                    async with AdmissionController.admit(payment=True):
+                        await payment()
+                except PaymentStatusUnknown as e:
+                    await IntentService.markUnknown(intent, repr(e.__cause__))
+                    raise
+                except Exception as e:
+                    await IntentService.fail(intent, repr(e))
+                    raise
+            await IntentService.advance(intent, "paid")
+            return intent
+
+        async def postProcessing(intent: PaymentIntent):
+            if not await self.fulfillIntent(intent, interaction.user):
+                embed = discord.Embed(
+                    title="在庫がなくなっていました",
+                    description=f"決済は完了していますが、商品の在庫がありませんでした。\n自販機のオーナーと運営に返金が必要なことを知らせました。しばらくしても返金されない場合は、自販機のオーナー (<@{jihanki.ownerId}>) または[サポートサーバー](https://discord.gg/PN3KWEnYzX)へ連絡してください。",
+                    colour=discord.Colour.red(),
+                )
+                await interaction.followup.send(embed=embed, ephemeral=True)
+                return
 
             embed = discord.Embed(
                 title="購入しました！",
@@ -299,18 +674,35 @@ class JihankiPanelCog(commands.Cog):
             return
 
         if good.price == 0:
-            await postProcessing(PaymentType.NONE)
+            try:
+                intent = await pay(interaction, PaymentType.NONE)
+            except IntentAlreadyExists:
+                await self.sendDuplicateMessage(interaction)
+                return
+            await postProcessing(intent)
             return
 
-        seller = await self.bot.fetch_user(jihanki.ownerId)
+        seller = await UserService.getUser(self.bot, jihanki.ownerId)
 
         view = discord.ui.View(timeout=300)
 
-        handlePayPay = await AccountService.paypayWebAPIExists(jihanki.ownerId)
-        handleKyash = await AccountService.kyashExists(jihanki.ownerId)
+        async def releaseAndSendBusyMessage(interaction: discord.Interaction):
+            # 混み合っている間に在庫を確保したままにしないよう、解放して商品から選び直してもらう
+            view.stop()
+            if reservation:
+                await ReservationService.release(reservation)
+                self.bot.dispatch("jihanki_update", jihanki.id)
+            await self.sendBusyMessage(interaction)
+
+        linkStatuses = await AccountService.getLinkStatuses(
+            [jihanki.ownerId, interaction.user.id]
+        )
 
-        buyerHasPayPay = await AccountService.paypayExists(interaction.user.id)
-        buyerHasKyash = await AccountService.kyashExists(interaction.user.id)
+        handlePayPay = linkStatuses[jihanki.ownerId].paypayWebAPI
+        handleKyash = linkStatuses[jihanki.ownerId].kyash
+
+        buyerHasPayPay = linkStatuses[interaction.user.id].paypay
+        buyerHasKyash = linkStatuses[interaction.user.id].kyash
 
         if handleKyash:
             kyashButton = discord.ui.Button(
@@ -323,11 +715,21 @@ class JihankiPanelCog(commands.Cog):
                 if buyerHasKyash:
                     await interaction.response.defer(ephemeral=True)
                     try:
-                        await PaymentService.payWithKyash(
-                            amount=good.price,
-                            buyer=interaction.user,
-                            seller=seller,
+                        intent = await pay(
+                            interaction,
+                            PaymentType.KYASH,
+                            lambda: PaymentService.payWithKyash(
+                                amount=good.price,
+                                buyer=interaction.user,
+                                seller=seller,
+                            ),
                         )
+                    except IntentAlreadyExists:
+                        await self.sendDuplicateMessage(interaction)
+                        return
+                    except Overloaded:
+                        await releaseAndSendBusyMessage(interaction)
+                        return
                     except MoneyNotEnough:
                         embed = discord.Embed(
                             title="お金が足りません！！",
@@ -336,6 +738,17 @@ class JihankiPanelCog(commands.Cog):
                         )
                         await interaction.followup.send(embed=embed, ephemeral=True)
                         return
+                    except PaymentStatusUnknown:
+                        await self.sendStatusUnknownMessage(interaction)
+                        return
+                    except ProviderUnavailable as e:
+                        embed = discord.Embed(
+                            title="決済サービスが不調です",
+                            description=f"{e.message}\nしばらくしてからもう一度お試しください。",
+                            colour=discord.Colour.red(),
+                        )
+                        await interaction.followup.send(embed=embed, ephemeral=True)
+                        return
                     except:
                         embed = discord.Embed(
                             title="エラーが発生しました",
@@ -344,7 +757,7 @@ class JihankiPanelCog(commands.Cog):
                         )
                         await interaction.followup.send(embed=embed, ephemeral=True)
                         return
-                    await postProcessing(PaymentType.KYASH)
+                    await postProcessing(intent)
                 else:
                     _self = self
                     _interaction = interaction
@@ -360,11 +773,22 @@ class JihankiPanelCog(commands.Cog):
                         ) -> None:
                             await interaction.response.defer(ephemeral=True)
                             try:
-                                await PaymentService.receiveKyashUrl(
-                                    url=self.url.value,
-                                    amount=good.price,
-                                    seller=seller,
+                                intent = await pay(
+                                    interaction,
+                                    PaymentType.KYASH,
+                                    lambda: PaymentService.receiveKyashUrl(
+                                        url=self.url.value,
+                                        amount=good.price,
+                                        seller=seller,
+                                    ),
+                                    link=self.url.value,
                                 )
+                            except IntentAlreadyExists:
+                                await _self.sendDuplicateMessage(interaction)
+                                return
+                            except Overloaded:
+                                await releaseAndSendBusyMessage(interaction)
+                                return
                             except MoneyNotEnough:
                                 embed = discord.Embed(
                                     title="お金が足りません！！",
@@ -375,6 +799,19 @@ class JihankiPanelCog(commands.Cog):
                                     embed=embed, ephemeral=True
                                 )
                                 return
+                            except PaymentStatusUnknown:
+                                await _self.sendStatusUnknownMessage(interaction)
+                                return
+                            except ProviderUnavailable as e:
+                                embed = discord.Embed(
+                                    title="決済サービスが不調です",
+                                    description=f"{e.message}\nしばらくしてからもう一度お試しください。",
+                                    colour=discord.Colour.red(),
+                                )
+                                await interaction.followup.send(
+                                    embed=embed, ephemeral=True
+                                )
+                                return
                             except:
                                 embed = discord.Embed(
                                     title="エラーが発生しました",
@@ -385,7 +822,7 @@ class JihankiPanelCog(commands.Cog):
                                     embed=embed, ephemeral=True
                                 )
                                 return
-                            await postProcessing(PaymentType.KYASH)
+                            await postProcessing(intent)
 
                     await interaction.response.send_modal(KyashModal())
 
@@ -418,12 +855,23 @@ class JihankiPanelCog(commands.Cog):
                     async def on_submit(self, interaction: discord.Interaction) -> None:
                         await interaction.response.defer(ephemeral=True)
                         try:
-                            await PaymentService.receivePayPayUrl(
-                                url=self.url.value,
-                                amount=good.price,
-                                seller=seller,
-                                passcode=self.passcode.value,
+                            intent = await pay(
+                                interaction,
+                                PaymentType.PAYPAY,
+                                lambda: PaymentService.receivePayPayUrl(
+                                    url=self.url.value,
+                                    amount=good.price,
+                                    seller=seller,
+                                    passcode=self.passcode.value,
+                                ),
+                                link=self.url.value,
                             )
+                        except IntentAlreadyExists:
+                            await _self.sendDuplicateMessage(interaction)
+                            return
+                        except Overloaded:
+                            await releaseAndSendBusyMessage(interaction)
+                            return
                         except MoneyNotEnough:
                             embed = discord.Embed(
                                 title="お金が足りません！！",
@@ -432,6 +880,17 @@ class JihankiPanelCog(commands.Cog):
                             )
                             await interaction.followup.send(embed=embed, ephemeral=True)
                             return
+                        except PaymentStatusUnknown:
+                            await _self.sendStatusUnknownMessage(interaction)
+                            return
+                        except ProviderUnavailable as e:
+                            embed = discord.Embed(
+                                title="決済サービスが不調です",
+                                description=f"{e.message}\nしばらくしてからもう一度お試しください。",
+                                colour=discord.Colour.red(),
+                            )
+                            await interaction.followup.send(embed=embed, ephemeral=True)
+                            return
                         except:
                             embed = discord.Embed(
                                 title="エラーが発生しました",
@@ -440,7 +899,7 @@ class JihankiPanelCog(commands.Cog):
                             )
                             await interaction.followup.send(embed=embed, ephemeral=True)
                             return
-                        await postProcessing(PaymentType.PAYPAY)
+                        await postProcessing(intent)
 
                 await interaction.response.send_modal(PayPayModal())
 
@@ -448,6 +907,8 @@ class JihankiPanelCog(commands.Cog):
             view.add_item(paypayButton)
 
         if len(view.children) <= 0:
+            if reservation:
+                await ReservationService.release(reservation)
             embed = discord.Embed(
                 title="自販機のオーナーがPayPay・Kyashの両方のアカウントをリンクしていません",
                 description="自販機のオーナーに「アカウントをリンクしてください！」と言ってあげてください。",
@@ -469,17 +930,6 @@ class JihankiPanelCog(commands.Cog):
 
         await interaction.followup.send(embed=embed, view=view, ephemeral=True)
 
-    @commands.Cog.listener()
-    async def on_interaction(self, interaction: discord.Interaction):
-        try:
-            if interaction.data["component_type"] == 3:
-                customId = interaction.data["custom_id"]
-                customFields = customId.split(",")
-                if customFields[0] == "buy":
-                    await self.buy(interaction, customFields)
-        except KeyError:
-            pass
-
     @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
     @app_commands.allowed_installs(guilds=True, users=False)
     async def updateJihankiContextMenu(
@@ -491,7 +941,8 @@ class JihankiPanelCog(commands.Cog):
         try:
             select: discord.SelectMenu = message.components[0].children[0]
             customFields = select.custom_id.split(",")
-            if len(customFields) == 2:
+            # ページ付きのパネルは buy,自販機ID,ページ の形式
+            if len(customFields) in (2, 3):
                 if customFields[0] == "buy":
                     _jihanki = int(customFields[1])
         except:
@@ -507,7 +958,17 @@ class JihankiPanelCog(commands.Cog):
 
         jihanki = await JihankiService.getJihanki(interaction.user, id=int(_jihanki))
 
-        await self.updateJihanki(jihanki, message)
+        await PanelService.register(jihanki.id, message.channel.id, message.id)
+        try:
+            await self.scheduleUpdate(jihanki, message, delay=0)
+        except discord.HTTPException:
+            embed = discord.Embed(
+                title="自販機を再読込できませんでした",
+                description="このボットがそのメッセージを編集できるか確認してください。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
 
         embed = discord.Embed(
             title="自販機を再読込しました",
@@ -594,7 +1055,17 @@ class JihankiPanelCog(commands.Cog):
         )
         message = await channel.send(embed=embed)
 
-        await self.updateJihanki(jihanki, message)
+        await PanelService.register(jihanki.id, channel.id, message.id)
+        try:
+            await self.scheduleUpdate(jihanki, message, delay=0)
+        except discord.HTTPException:
+            embed = discord.Embed(
+                title="自販機を送信できませんでした",
+                description="このボットがそのチャンネルのメッセージを編集できるか確認してください。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
 
         embed = discord.Embed(
             title="自販機を送信しました",
@@ -17,8 +17,11 @@ from services.account import (
     AccountService,
     AccountNotLinkedException,
     FailedToLoginException,
+    Session,
 )
 from services.database import Database
+from services.proxy import ProxyHealthService
+from services.transport import TransportPool
 
 dotenv.load_dotenv()
 
@@ -49,10 +52,13 @@ class AccountLinkCog(commands.Cog):
         await interaction.response.defer(ephemeral=True)
         if service == "kyash":
             try:
-                kyash: Kyash = await AccountService.loginKyash(interaction.user.id)
 
-                await kyash.get_profile()
-                await kyash.get_wallet()
+                async def getInfo(kyash: Kyash) -> Kyash:
+                    await kyash.get_profile()
+                    await kyash.get_wallet()
+                    return kyash
+
+                kyash = await AccountService.useKyash(interaction.user.id, getInfo)
                 embed = (
                     discord.Embed(title="Kyashの情報", colour=discord.Colour.blue())
                     .set_author(name=kyash.username, icon_url=kyash.icon)
@@ -93,18 +99,21 @@ class AccountLinkCog(commands.Cog):
                 return
         else:
             try:
-                if await AccountService.paypayExists(interaction.user.id):
-                    paypay: PayPay = await AccountService.loginPayPay(
-                        interaction.user.id
+
+                async def getInfo(paypay: PayPay | PayPayWebAPI):
+                    return await paypay.get_profile(), await paypay.get_balance()
+
+                linkStatus = await AccountService.getLinkStatus(interaction.user.id)
+                if linkStatus.paypay:
+                    profile, balance = await AccountService.usePayPay(
+                        interaction.user.id, getInfo
                     )
-                elif await AccountService.paypayWebAPIExists(interaction.user.id):
-                    paypay: PayPayWebAPI = await AccountService.loginPayPayWebAPI(
-                        interaction.user.id
+                elif linkStatus.paypayWebAPI:
+                    profile, balance = await AccountService.usePayPayWebAPI(
+                        interaction.user.id, getInfo
                     )
                 else:
                     raise AccountNotLinkedException()
-                profile = await paypay.get_profile()
-                balance = await paypay.get_balance()
                 embed = (
                     discord.Embed(title="PayPayの情報", colour=discord.Colour.red())
                     .set_author(name=profile.name, icon_url=profile.icon)
@@ -186,11 +195,18 @@ class AccountLinkCog(commands.Cog):
             return
 
         await interaction.response.defer(ephemeral=True)
-        if service == "kyash":
-            row = Database.pool.fetchrow(
-                "SELECT * FROM kyash WHERE id = $1", interaction.user.id
+        if not await ProxyHealthService.probe(proxy):
+            embed = discord.Embed(
+                title="プロキシに接続できませんでした",
+                description="プロキシが動いているか確認してください。",
+                colour=discord.Colour.red(),
             )
-            if not row:
+            await interaction.followup.send(embed=embed)
+            return
+
+        linkStatus = await AccountService.getLinkStatus(interaction.user.id)
+        if service == "kyash":
+            if not linkStatus.kyash:
                 embed = discord.Embed(
                     title="まだアカウントリンクしていません",
                     description="`/link` コマンドを使用してアカウントをリンクしてください",
@@ -204,16 +220,15 @@ class AccountLinkCog(commands.Cog):
                 proxy,
                 interaction.user.id,
             )
+            AccountService.invalidateLinkStatus(interaction.user.id)
+            AccountService.discardSession(interaction.user.id, "kyash")
 
             embed = discord.Embed(
                 title="プロキシを変更しました", colour=discord.Colour.green()
             )
             await interaction.followup.send(embed=embed)
         else:
-            row = Database.pool.fetchrow(
-                "SELECT * FROM paypay WHERE id = $1", interaction.user.id
-            )
-            if not row:
+            if not (linkStatus.paypay or linkStatus.paypayWebAPI):
                 embed = discord.Embed(
                     title="まだアカウントリンクしていません",
                     description="`/link` コマンドを使用してアカウントをリンクしてください",
@@ -227,6 +242,9 @@ class AccountLinkCog(commands.Cog):
                 proxy,
                 interaction.user.id,
             )
+            AccountService.invalidateLinkStatus(interaction.user.id)
+            AccountService.discardSession(interaction.user.id, "paypay")
+            AccountService.discardSession(interaction.user.id, "paypayWebAPI")
 
             embed = discord.Embed(
                 title="プロキシを変更しました", colour=discord.Colour.green()
@@ -277,6 +295,12 @@ class AccountLinkCog(commands.Cog):
             await interaction.response.send_message(embed=embed, ephemeral=True)
             return
         await interaction.response.defer(ephemeral=True)
+        if not await ProxyHealthService.probe(proxy):
+            await interaction.followup.send(
+                "プロキシに接続できませんでした。", ephemeral=True
+            )
+            return
+
         if service == "kyash":
             kyash = Kyash(proxy=proxy)
             try:
@@ -349,7 +373,12 @@ class AccountLinkCog(commands.Cog):
             )
             await message.reply(f"アカウントをリンクしました。")
 
-            AccountService.kyashCache[interaction.user.id] = kyash
+            AccountService.discardSession(interaction.user.id, "kyash")
+            AccountService.kyashCache.set(
+                interaction.user.id,
+                Session(TransportPool.attach(kyash, proxy), proxy=proxy),
+            )
+            AccountService.invalidateLinkStatus(interaction.user.id)
         elif service == "paypay-webapi":
             paypay = PayPayWebAPI(proxy=proxy)
             try:
@@ -423,7 +452,12 @@ class AccountLinkCog(commands.Cog):
             )
             await message.reply(f"アカウントをリンクしました。")
 
-            AccountService.paypayWebAPICache[interaction.user.id] = paypay
+            AccountService.discardSession(interaction.user.id, "paypayWebAPI")
+            AccountService.paypayWebAPICache.set(
+                interaction.user.id,
+                Session(TransportPool.attach(paypay, proxy), expiresAt, proxy=proxy),
+            )
+            AccountService.invalidateLinkStatus(interaction.user.id)
         else:
             paypay = PayPay(proxy=proxy)
             try:
@@ -504,10 +538,12 @@ class AccountLinkCog(commands.Cog):
             )
             await message.reply(f"アカウントをリンクしました。")
 
-            AccountService.paypayCache[interaction.user.id] = paypay
-            AccountService.paypayExternalUserIds[interaction.user.id] = (
-                profile.external_user_id
+            AccountService.discardSession(interaction.user.id, "paypay")
+            AccountService.paypayCache.set(
+                interaction.user.id,
+                Session(TransportPool.attach(paypay, proxy), expiresAt, proxy=proxy),
             )
+            AccountService.invalidateLinkStatus(interaction.user.id)
 
 
 async def setup(bot: commands.Bot):
@@ -0,0 +1,65 @@
+import traceback
+
+from discord.ext import commands, tasks
+
+from services.account import AccountService
+from services.proxy import ProxyHealthService
+
+
+class MaintenanceCog(commands.Cog):
+    """購入の邪魔にならないよう、裏で定期的に行う処理"""
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    async def cog_load(self) -> None:
+        try:
+            await AccountService.loadSessions()
+        except:
+            traceback.print_exc()
+        self.refreshTokens.start()
+        self.saveSessions.start()
+        self.probeProxies.start()
+
+    async def cog_unload(self) -> None:
+        self.refreshTokens.cancel()
+        self.saveSessions.cancel()
+        self.probeProxies.cancel()
+
+    @tasks.loop(minutes=5)
+    async def refreshTokens(self):
+        """期限が近いトークンを先回りして更新します。"""
+        try:
+            refreshed = await AccountService.refreshTokens()
+            if any(refreshed.values()):
+                print(f"refreshed tokens: {refreshed}")
+        except:
+            traceback.print_exc()
+
+    @refreshTokens.before_loop
+    async def beforeRefreshTokens(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(minutes=5)
+    async def saveSessions(self):
+        """再起動に備えて、ログイン済みのセッションを保存します。"""
+        try:
+            await AccountService.saveSessions()
+        except:
+            traceback.print_exc()
+
+    @tasks.loop(minutes=1)
+    async def probeProxies(self):
+        """プロキシに接続できるか確認します。"""
+        try:
+            await ProxyHealthService.probeAll()
+        except:
+            traceback.print_exc()
+
+    @probeProxies.before_loop
+    async def beforeProbeProxies(self):
+        await self.bot.wait_until_ready()
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(MaintenanceCog(bot))
@@ -11,11 +11,13 @@ from aiopaypaython import PayPay
 from cryptography.fernet import Fernet
 from discord import app_commands
 from discord.ext import commands
-from snowflake import SnowflakeGenerator
 
 from objects import PaymentType
-from services.database import Database
+from services.account import PaymentStatusUnknown
+from services.intent import IntentAlreadyExists, IntentService
+from services.user import UserService
 from services.money import MoneyService
+from services.router import InteractionRouter
 from .send import moneyGroup
 
 dotenv.load_dotenv()
@@ -38,160 +40,168 @@ class ClaimMoneyCog(commands.Cog):
         self.bot = bot
         self.cipherSuite = Fernet(os.getenv("fernet_key").encode())
 
-    @commands.Cog.listener()
-    async def on_interaction(self, interaction: discord.Interaction):
-        try:
-            if interaction.data["component_type"] == 2:
-                customId = interaction.data["custom_id"]
-                customFields = customId.split(",")
-                if customFields[0] == "claim":
-                    await interaction.response.defer(ephemeral=True)
-
-                    service = PaymentType(customFields[1].upper())
-                    amount = int(customFields[2])
-                    user = await self.bot.fetch_user(int(customFields[3]))
-
-                    if user.id == interaction.user.id:
-                        embed = discord.Embed(
-                            title="自分自身には送金できません",
-                            colour=discord.Colour.red(),
-                        )
-                        await interaction.followup.send(embed=embed, ephemeral=True)
-                        return
-
-                    async def sendLog(errorText: str):
-                        async with aiohttp.ClientSession() as session:
-                            webhook = discord.Webhook.from_url(
-                                os.getenv("error_webhook"), session=session
-                            )
-
-                            embed = (
-                                discord.Embed(
-                                    title="エラーが発生しました",
-                                    colour=discord.Colour.red(),
-                                )
-                                .set_thumbnail(url=interaction.user.display_avatar.url)
-                                .add_field(
-                                    name="送信先ユーザー",
-                                    value=f"{user.display_name} (ID: `{user.name}`) (UID: `{user.id}`)",
-                                )
-                                .add_field(
-                                    name="送信元ユーザー",
-                                    value=f"{interaction.user.mention} (ID: `{interaction.user.name}`) (UID: `{interaction.user.id}`)",
-                                )
-                                .add_field(
-                                    name="種別",
-                                    value=serviceString(service),
-                                )
-                                .add_field(
-                                    name="エラー",
-                                    value=f"```\n{errorText}```\n",
-                                )
-                            )
-
-                            await webhook.send(embed=embed)
-
-                    try:
-                        await MoneyService.sendMoney(
-                            amount=amount, target=interaction.user, to=user
-                        )
-                    except:
-                        await sendLog(traceback.format_exc())
-
-                    await interaction.delete_original_response()
-
-                    gen = SnowflakeGenerator(15)
-                    paymentId = next(gen)
-
-                    await Database.pool.execute(
-                        "INSERT INTO history (id, user_id, to_id, type, amount) VALUES ($1, $2, $3, $4, $5)",
-                        paymentId,
-                        interaction.user.id,
-                        user.id,
-                        (
-                            "GOT_PAYPAY"
-                            if service == PaymentType.PAYPAY
-                            else "GOT_KYASH"
-                        ),
-                        amount,
+    async def cog_load(self) -> None:
+        InteractionRouter.register(discord.ComponentType.button, "claim", self.claim)
+
+    async def cog_unload(self) -> None:
+        InteractionRouter.unregister(discord.ComponentType.button, "claim")
+
+    async def claim(self, interaction: discord.Interaction, customFields: list[str]):
+        await interaction.response.defer(ephemeral=True)
+
+        service = PaymentType(customFields[1].upper())
+        amount = int(customFields[2])
+        user = await UserService.getUser(self.bot, int(customFields[3]))
+
+        if user.id == interaction.user.id:
+            embed = discord.Embed(
+                title="自分自身には送金できません",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+
+        async def sendLog(errorText: str):
+            async with aiohttp.ClientSession() as session:
+                webhook = discord.Webhook.from_url(
+                    os.getenv("error_webhook"), session=session
+                )
+
+                embed = (
+                    discord.Embed(
+                        title="エラーが発生しました",
+                        colour=discord.Colour.red(),
                     )
-
-                    paymentId = next(gen)
-
-                    await Database.pool.execute(
-                        "INSERT INTO history (id, user_id, to_id, type, amount) VALUES ($1, $2, $3, $4, $5)",
-                        paymentId,
-                        user.id,
-                        interaction.user.id,
-                        (
-                            "SEND_PAYPAY"
-                            if service == PaymentType.PAYPAY
-                            else "SEND_KYASH"
-                        ),
-                        -amount,
+                    .set_thumbnail(url=interaction.user.display_avatar.url)
+                    .add_field(
+                        name="送信先ユーザー",
+                        value=f"{user.display_name} (ID: `{user.name}`) (UID: `{user.id}`)",
                     )
-
-                    try:
-                        embed = (
-                            discord.Embed(
-                                title="送金してもらいました！",
-                                colour=discord.Colour.green(),
-                            )
-                            .set_thumbnail(url=interaction.user.display_avatar)
-                            .add_field(
-                                name="誰から",
-                                value=f"{interaction.user.mention} (`{interaction.user.display_name}`) (ID: `{interaction.user.name}`)",
-                            )
-                            .add_field(name="どれぐらい", value=f"{amount}円")
-                            .add_field(name="何で", value=serviceString(service))
-                        )
-                        await user.send(embed=embed)
-                    except:
-                        pass
-
-                    try:
-                        embed = (
-                            discord.Embed(
-                                title="送金ログ",
-                                colour=discord.Colour.green(),
-                            )
-                            .set_thumbnail(url=user.display_avatar)
-                            .add_field(
-                                name="誰に",
-                                value=f"{user.mention} (`{user.display_name}`) (ID: `{user.name}`)",
-                            )
-                            .add_field(name="どれぐらい", value=f"{amount}円")
-                            .add_field(name="何で", value=serviceString(service))
-                        )
-                        await interaction.followup.send(embed=embed, ephemeral=True)
-                    except:
-                        pass
-
-                    embed = (
-                        discord.Embed(
-                            title="送金しました！",
-                            description="相手の方にDMが送信されていると思うので、トラブルになったらボット制作者の`nennneko5787`まで言ってくれればサポートします",
-                            colour=discord.Colour.green(),
-                        )
-                        .set_thumbnail(url=user.display_avatar)
-                        .add_field(
-                            name="誰に",
-                            value=f"{user.mention} (`{user.display_name}`) (ID: `{user.name}`)",
-                        )
-                        .add_field(name="どれぐらい", value=f"{amount}円")
-                        .add_field(name="何で", value=serviceString(service))
+                    .add_field(
+                        name="送信元ユーザー",
+                        value=f"{interaction.user.mention} (ID: `{interaction.user.name}`) (UID: `{interaction.user.id}`)",
                     )
-                    await interaction.followup.send(embed=embed, ephemeral=True)
-
-                    embed = discord.Embed(
-                        title="請求",
-                        description=f"{interaction.user.mention}さんからの**{amount}円**の請求です！",
-                        colour=discord.Colour.blurple(),
+                    .add_field(
+                        name="種別",
+                        value=serviceString(service),
+                    )
+                    .add_field(
+                        name="エラー",
+                        value=f"```\n{errorText}```\n",
                     )
-                    await interaction.message.edit(embed=embed)
-        except KeyError:
+                )
+
+                await webhook.send(embed=embed)
+
+        # ボタンを連打しても二重に送金しないように、同じ請求と支払う人の組には同じキーを使う
+        try:
+            intent = await IntentService.create(
+                f"claim:{interaction.message.id}:{interaction.user.id}",
+                kind="CLAIM",
+                userId=interaction.user.id,
+                toId=user.id,
+                amount=amount,
+                paymentType=service,
+            )
+        except IntentAlreadyExists:
+            embed = discord.Embed(
+                title="この請求はすでに支払い済みか、処理中です",
+                description="二重に送金しないよう、同じ請求への送金は1回だけ行います。\nトラブルが発生した場合は[サポートサーバー](https://discord.gg/PN3KWEnYzX)までどうぞ",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+        try:
+            await MoneyService.sendMoney(
+                amount=amount,
+                target=interaction.user,
+                to=user,
+                type=service,
+            )
+        except PaymentStatusUnknown as e:
+            await IntentService.markUnknown(intent, repr(e.__cause__))
+            await sendLog(traceback.format_exc())
+            embed = discord.Embed(
+                title="送金が完了したか確認できませんでした",
+                description=f"{e}\n**二重に送金しないよう、もう一度送金しないでください。**\n運営が送金の状況を確認します。トラブルが発生した場合は[サポートサーバー](https://discord.gg/PN3KWEnYzX)までどうぞ",
+                colour=discord.Colour.orange(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+        except Exception as e:
+            await IntentService.fail(intent, repr(e))
+            await sendLog(traceback.format_exc())
+            embed = discord.Embed(
+                title="送金できませんでした",
+                description=f"{e}\nトラブルが発生した場合は[サポートサーバー](https://discord.gg/PN3KWEnYzX)までどうぞ",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+        await IntentService.advance(intent, "paid")
+
+        try:
+            embed = (
+                discord.Embed(
+                    title="送金してもらいました！",
+                    colour=discord.Colour.green(),
+                )
+                .set_thumbnail(url=interaction.user.display_avatar)
+                .add_field(
+                    name="誰から",
+                    value=f"{interaction.user.mention} (`{interaction.user.display_name}`) (ID: `{interaction.user.name}`)",
+                )
+                .add_field(name="どれぐらい", value=f"{amount}円")
+                .add_field(name="何で", value=serviceString(service))
+            )
+            await user.send(embed=embed)
+        except:
             pass
 
+        try:
+            embed = (
+                discord.Embed(
+                    title="送金ログ",
+                    colour=discord.Colour.green(),
+                )
+                .set_thumbnail(url=user.display_avatar)
+                .add_field(
+                    name="誰に",
+                    value=f"{user.mention} (`{user.display_name}`) (ID: `{user.name}`)",
+                )
+                .add_field(name="どれぐらい", value=f"{amount}円")
+                .add_field(name="何で", value=serviceString(service))
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+        except:
+            pass
+
+        await IntentService.advance(intent, "delivered")
+        await IntentService.record(intent)
+
+        embed = (
+            discord.Embed(
+                title="送金しました！",
+                description="相手の方にDMが送信されていると思うので、トラブルになったらボット制作者の`nennneko5787`まで言ってくれればサポートします",
+                colour=discord.Colour.green(),
+            )
+            .set_thumbnail(url=user.display_avatar)
+            .add_field(
+                name="誰に",
+                value=f"{user.mention} (`{user.display_name}`) (ID: `{user.name}`)",
+            )
+            .add_field(name="どれぐらい", value=f"{amount}円")
+            .add_field(name="何で", value=serviceString(service))
+        )
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+        embed = discord.Embed(
+            title="請求",
+            description=f"{interaction.user.mention}さんからの**{amount}円**の請求です！",
+            colour=discord.Colour.blurple(),
+        )
+        await interaction.message.edit(embed=embed)
+
     # @moneyGroup.command(name="claim", description="請求パネルを作成します。")
     @app_commands.command(name="claim", description="請求パネルを作成します。")
     @app_commands.rename(amount="請求額")
@@ -11,9 +11,9 @@ from aiopaypaython import PayPay
 from cryptography.fernet import Fernet
 from discord import app_commands
 from discord.ext import commands
-from snowflake import SnowflakeGenerator
 
-from services.database import Database
+from services.account import PaymentStatusUnknown
+from services.intent import IntentService
 from services.money import MoneyService
 from objects import PaymentType
 
@@ -77,6 +77,7 @@ class SendMoneyCog(commands.Cog):
                 colour=discord.Colour.red(),
             )
             await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
 
         if user.id == interaction.user.id:
             embed = discord.Embed(
@@ -118,13 +119,41 @@ class SendMoneyCog(commands.Cog):
                 await webhook.send(embed=embed)
 
         await interaction.response.defer(ephemeral=True)
-        service = PaymentType(_service.value)
+        service = PaymentType(_service)
+        # スラッシュコマンドのインタラクションは1回しか届かないので、そのIDで二重の送金を防げる
+        intent = await IntentService.create(
+            f"send:{interaction.id}",
+            kind="SEND",
+            userId=interaction.user.id,
+            toId=user.id,
+            amount=amount,
+            paymentType=service,
+        )
         try:
             await MoneyService.sendMoney(
-                amount=amount, target=interaction.user, to=user
+                amount=amount, target=interaction.user, to=user, type=service
             )
-        except:
+        except PaymentStatusUnknown as e:
+            await IntentService.markUnknown(intent, repr(e.__cause__))
             await sendLog(service, traceback.format_exc())
+            embed = discord.Embed(
+                title="送金が完了したか確認できませんでした",
+                description=f"{e}\n**二重に送金しないよう、もう一度送金しないでください。**\n運営が送金の状況を確認します。トラブルが発生した場合は[サポートサーバー](https://discord.gg/PN3KWEnYzX)までどうぞ",
+                colour=discord.Colour.orange(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+        except Exception as e:
+            await IntentService.fail(intent, repr(e))
+            await sendLog(service, traceback.format_exc())
+            embed = discord.Embed(
+                title="送金できませんでした",
+                description=f"{e}\nトラブルが発生した場合は[サポートサーバー](https://discord.gg/PN3KWEnYzX)までどうぞ",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            return
+        await IntentService.advance(intent, "paid")
 
         try:
             embed = (
@@ -162,28 +191,8 @@ class SendMoneyCog(commands.Cog):
         except:
             pass
 
-        gen = SnowflakeGenerator(15)
-        paymentId = next(gen)
-
-        await Database.pool.execute(
-            "INSERT INTO history (id, user_id, to_id, type, amount) VALUES ($1, $2, $3, $4, $5)",
-            paymentId,
-            interaction.user.id,
-            user.id,
-            "SEND_PAYPAY" if service == PaymentType.PAYPAY else "SEND_KYASH",
-            -amount,
-        )
-
-        paymentId = next(gen)
-
-        await Database.pool.execute(
-            "INSERT INTO history (id, user_id, to_id, type, amount) VALUES ($1, $2, $3, $4, $5)",
-            paymentId,
-            user.id,
-            interaction.user.id,
-            "GOT_PAYPAY" if service == PaymentType.PAYPAY else "GOT_KYASH",
-            amount,
-        )
+        await IntentService.advance(intent, "delivered")
+        await IntentService.record(intent)
 
         embed = (
             discord.Embed(
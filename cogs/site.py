@@ -1,6 +1,9 @@
+import base64
 import math
 import os
 import traceback
+from datetime import datetime
+from typing import Optional
 
 import discord
 import dotenv
@@ -13,6 +16,7 @@ from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 
 from services.database import Database
+from services.user import UserService
 
 dotenv.load_dotenv()
 
@@ -28,6 +32,12 @@ async def loadUserData(data: str = Cookie(None)):
     return data
 
 
+def formatUser(user: Optional[discord.User], userId: int) -> str:
+    if not user:
+        return f"不明なユーザー (UID: {userId})"
+    return f"{user.display_name} (ID: {user.name})"
+
+
 class SiteCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
@@ -120,42 +130,73 @@ class SiteCog(commands.Cog):
         return userData
 
     async def getPaymentHistory(
-        self, userData: dict = Depends(loadUserData), page: int = 0
+        self, userData: dict = Depends(loadUserData), cursor: str = None
     ):
-        """ユーザーの購入履歴を取得します。"""
+        """ユーザーの購入履歴を取得します。
+        cursorには前回のレスポンスのnext_cursorを渡します。"""
         limit: int = 30
 
         if not userData:
             raise HTTPException(401)
 
-        count = await Database.pool.fetchval(
-            "SELECT COUNT(*) FROM history WHERE user_id = $1", int(userData["id"])
-        )
+        userId = int(userData["id"])
+
+        if cursor:
+            try:
+                boughtAt, lastId = orjson.loads(base64.urlsafe_b64decode(cursor))
+                boughtAt = datetime.fromisoformat(boughtAt)
+            except:
+                raise HTTPException(400)
+            rows = await Database.pool.fetch(
+                "SELECT * FROM history WHERE user_id = $1 AND (bought_at, id) < ($2, $3) ORDER BY bought_at DESC, id DESC LIMIT $4",
+                userId,
+                boughtAt,
+                lastId,
+                limit + 1,
+            )
+        else:
+            rows = await Database.pool.fetch(
+                "SELECT * FROM history WHERE user_id = $1 ORDER BY bought_at DESC, id DESC LIMIT $2",
+                userId,
+                limit + 1,
+            )
 
+        nextCursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nextCursor = base64.urlsafe_b64encode(
+                orjson.dumps([rows[-1]["bought_at"].isoformat(), rows[-1]["id"]])
+            ).decode()
+
+        users = await UserService.getUsers(self.bot, [row["to_id"] for row in rows])
         histories = []
 
-        for history in await Database.pool.fetch(
-            "SELECT * FROM history WHERE user_id = $1 ORDER BY bought_at DESC OFFSET $2 LIMIT $3",
-            int(userData["id"]),
-            page * limit,
-            limit,
-        ):
+        for history in rows:
             history = dict(history)
             history["id_str"] = str(history["id"])
             if history["jihanki"]:
                 history["jihanki"] = orjson.loads(history["jihanki"])
             if history["good"]:
                 history["good"] = orjson.loads(history["good"])
-            user = await self.bot.fetch_user(history["to_id"])
-            history["to"] = f"{user.display_name} (ID: {user.name})"
+            history["to"] = formatUser(users[history["to_id"]], history["to_id"])
             histories.append(history)
 
         data = {
-            "total": count,
-            "pages": math.ceil(count / limit),
             "histories": histories,
+            "next_cursor": nextCursor,
         }
 
+        # 件数は最初のページでのみ返す (トリガーで保持しているので定数時間)
+        if not cursor:
+            count = (
+                await Database.pool.fetchval(
+                    "SELECT count FROM history_counts WHERE user_id = $1", userId
+                )
+                or 0
+            )
+            data["total"] = count
+            data["pages"] = math.ceil(count / limit)
+
         return data
 
     async def getPayment(self, paymentId: int, userData: dict = Depends(loadUserData)):
@@ -184,8 +225,8 @@ class SiteCog(commands.Cog):
             payment["good"]["value"] = cipherSuite.decrypt(
                 payment["good"]["value"].encode()
             ).decode()
-        user = await self.bot.fetch_user(payment["to_id"])
-        payment["to"] = f"{user.display_name} (ID: {user.name})"
+        user = await UserService.getUser(self.bot, payment["to_id"])
+        payment["to"] = formatUser(user, payment["to_id"])
 
         return payment
 
@@ -1,5 +1,6 @@
 import asyncio
 import os
+import traceback
 from contextlib import asynccontextmanager
 
 import discord
@@ -9,13 +10,23 @@ from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 
+from services.account import AccountService
 from services.database import Database
+from services.history import HistoryService
+from services.router import InteractionRouter
+from services.transport import TransportPool
 
 dotenv.load_dotenv()
 
 discord.utils.setup_logging()
 
-bot = commands.Bot(["takoyaki#", "t#"], intents=discord.Intents.default())
+# レートリミットで長く待たされる場合は、待たずにRateLimitedを送出させる。
+# パネルの再描画(RenderScheduler)は、これを受け取って後から描画し直す
+bot = commands.Bot(
+    ["takoyaki#", "t#"],
+    intents=discord.Intents.default(),
+    max_ratelimit_timeout=float(os.getenv("max_ratelimit_timeout", 30)),
+)
 
 
 @tasks.loop(seconds=20)
@@ -34,6 +45,12 @@ async def on_ready():
     print(bot.user.id)
 
 
+@bot.event
+async def on_interaction(interaction: discord.Interaction):
+    # ボタンや選択メニューは、各コグが登録したルートへ振り分ける
+    await InteractionRouter.dispatch(interaction)
+
+
 @bot.event
 async def setup_hook():
     if os.getenv("site_test") != "a":
@@ -44,6 +61,7 @@ async def setup_hook():
         await bot.load_extension("cogs.jihanki.panel")
         await bot.load_extension("cogs.money.send")
         await bot.load_extension("cogs.money.claim")
+        await bot.load_extension("cogs.maintenance")
     await bot.load_extension("cogs.site")
 
     app.add_api_route(
@@ -82,9 +100,16 @@ async def setup_hook():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await Database.connect()
+    await Database.migrate()
     asyncio.create_task(bot.start(os.getenv("discord")))
     yield
     async with asyncio.timeout(10):
+        try:
+            await AccountService.saveSessions()
+        except:
+            traceback.print_exc()
+        await HistoryService.flush()
+        await TransportPool.close()
         await Database.pool.close()
 
 
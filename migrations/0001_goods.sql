@@ -0,0 +1,30 @@
+-- 商品をjihanki.goodsのJSONから独立したテーブルへ移行する
+CREATE TABLE IF NOT EXISTS goods (
+    id BIGINT PRIMARY KEY,
+    jihanki_id BIGINT NOT NULL REFERENCES jihanki (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL DEFAULT 0,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    price INTEGER NOT NULL CHECK (price >= 0),
+    infinite BOOLEAN NOT NULL DEFAULT FALSE,
+    value TEXT NOT NULL,
+    emoji TEXT
+);
+
+CREATE INDEX IF NOT EXISTS goods_jihanki_id_position_idx ON goods (jihanki_id, position);
+
+-- IDはスノーフレークと同じ形式 (ミリ秒 << 22 | 連番) で採番する
+INSERT INTO goods (id, jihanki_id, position, name, description, price, infinite, value, emoji)
+SELECT
+    ((floor(extract(epoch FROM now()) * 1000)::BIGINT) << 22) | ROW_NUMBER() OVER (),
+    jihanki.id,
+    item.position - 1,
+    item.good ->> 'name',
+    item.good ->> 'description',
+    (item.good ->> 'price')::INTEGER,
+    COALESCE((item.good ->> 'infinite')::BOOLEAN, FALSE),
+    item.good ->> 'value',
+    item.good ->> 'emoji'
+FROM jihanki
+CROSS JOIN LATERAL jsonb_array_elements(COALESCE(jihanki.goods::jsonb, '[]'::jsonb))
+    WITH ORDINALITY AS item(good, position);
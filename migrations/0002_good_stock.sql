@@ -0,0 +1,14 @@
+-- 在庫無限ではない商品の中身を、1行1コードの在庫プールとして持つ
+CREATE TABLE IF NOT EXISTS good_stock (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    good_id BIGINT NOT NULL REFERENCES goods (id) ON DELETE CASCADE,
+    value TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS good_stock_good_id_idx ON good_stock (good_id, id);
+
+INSERT INTO good_stock (good_id, value)
+SELECT id, value FROM goods WHERE NOT infinite AND value <> '' ORDER BY position;
+
+UPDATE goods SET value = '' WHERE NOT infinite;
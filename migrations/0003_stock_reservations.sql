@@ -0,0 +1,6 @@
+-- 決済中の在庫を確保しておくための列
+ALTER TABLE good_stock ADD COLUMN IF NOT EXISTS reserved_by BIGINT;
+ALTER TABLE good_stock ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS good_stock_reserved_until_idx ON good_stock (reserved_until)
+    WHERE reserved_until IS NOT NULL;
@@ -0,0 +1,30 @@
+-- 取引履歴をキーセットページネーションで引くための索引
+CREATE INDEX IF NOT EXISTS history_user_id_bought_at_id_idx ON history (user_id, bought_at DESC, id DESC);
+
+-- ユーザーごとの取引件数をトリガーで保持する
+CREATE TABLE IF NOT EXISTS history_counts (
+    user_id BIGINT PRIMARY KEY,
+    count BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION history_counts_update() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO history_counts (user_id, count) VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET count = history_counts.count + 1;
+        RETURN NEW;
+    ELSE
+        UPDATE history_counts SET count = count - 1 WHERE user_id = OLD.user_id;
+        RETURN OLD;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS history_counts_trigger ON history;
+CREATE TRIGGER history_counts_trigger
+    AFTER INSERT OR DELETE ON history
+    FOR EACH ROW EXECUTE FUNCTION history_counts_update();
+
+INSERT INTO history_counts (user_id, count)
+SELECT user_id, COUNT(*) FROM history GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE SET count = EXCLUDED.count;
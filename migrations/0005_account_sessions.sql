@@ -0,0 +1,10 @@
+-- 再起動後にログインし直さなくて済むよう、ログイン済みのセッションを保存しておくテーブル
+-- dataはFernetで暗号化したJSON
+CREATE TABLE IF NOT EXISTS account_sessions (
+    user_id BIGINT NOT NULL,
+    provider TEXT NOT NULL,
+    data TEXT NOT NULL,
+    expires_at TIMESTAMPTZ,
+    validated_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (user_id, provider)
+);
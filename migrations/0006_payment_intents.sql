@@ -0,0 +1,24 @@
+-- 決済から商品の受け渡し、履歴の記録までの進み具合を記録するテーブル
+-- state: created(決済前) → paid(決済済み) → delivered(受け渡し済み) → recorded(履歴に記録済み)、失敗した場合はfailed
+CREATE TABLE IF NOT EXISTS payment_intents (
+    id BIGINT PRIMARY KEY,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'created',
+    user_id BIGINT NOT NULL,
+    to_id BIGINT NOT NULL,
+    amount INTEGER NOT NULL,
+    payment_type TEXT NOT NULL,
+    jihanki TEXT,
+    good TEXT,
+    reservation_id BIGINT,
+    good_value TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- 復旧処理が止まったままの決済を探すためのインデックス
+CREATE INDEX IF NOT EXISTS payment_intents_pending_idx ON payment_intents (updated_at)
+    WHERE state IN ('created', 'paid', 'delivered');
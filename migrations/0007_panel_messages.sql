@@ -0,0 +1,10 @@
+-- 自販機パネルを送信したメッセージの一覧
+-- 自販機が編集されたときに、すべてのパネルを再描画するために使う
+CREATE TABLE IF NOT EXISTS panel_messages (
+    message_id BIGINT PRIMARY KEY,
+    channel_id BIGINT NOT NULL,
+    jihanki_id BIGINT NOT NULL REFERENCES jihanki (id) ON DELETE CASCADE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS panel_messages_jihanki_id_idx ON panel_messages (jihanki_id);
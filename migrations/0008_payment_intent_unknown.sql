@@ -0,0 +1,4 @@
+-- state: unknown(送金の途中で通信が途切れ、決済が完了したか確認できない)
+-- 再試行すると二重に送金される可能性があるので、自動では失敗にも再開にもせず、運営が確認する
+CREATE INDEX IF NOT EXISTS payment_intents_unknown_idx ON payment_intents (updated_at)
+    WHERE state = 'unknown';
@@ -0,0 +1,4 @@
+-- state: refund_required(決済の後に在庫がなくなっていて、商品を受け渡せなかった)
+-- 自販機のオーナーと運営に通知し、返金が終わるまで記録を残しておく
+CREATE INDEX IF NOT EXISTS payment_intents_refund_idx ON payment_intents (updated_at)
+    WHERE state = 'refund_required';
@@ -1,3 +1,6 @@
+from .account import LinkStatus
 from .enum import PaymentType
 from .good import Good
+from .intent import PaymentIntent
 from .jihanki import Jihanki
+from .reservation import Reservation
@@ -0,0 +1,10 @@
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+class LinkStatus(BaseModel):
+    paypay: bool = Field(False)
+    paypayWebAPI: bool = Field(False)
+    kyash: bool = Field(False)
+    paypayExternalUserId: Optional[str] = Field(None)
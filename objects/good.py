@@ -4,9 +4,11 @@ from pydantic import BaseModel, Field
 
 
 class Good(BaseModel):
+    id: Optional[int] = Field(None)
     name: str
     description: str
     price: int = Field(gt=-1)
     infinite: bool
     value: str
     emoji: Optional[str] = Field(None)
+    stock: int = Field(0)
@@ -0,0 +1,25 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from .enum import PaymentType
+
+
+class PaymentIntent(BaseModel):
+    id: int
+    idempotencyKey: str = Field(..., alias="idempotency_key")
+    kind: str
+    state: str
+    userId: int = Field(..., alias="user_id")
+    toId: int = Field(..., alias="to_id")
+    amount: int
+    paymentType: PaymentType = Field(..., alias="payment_type")
+    jihanki: Optional[str] = Field(None)
+    good: Optional[str] = Field(None)
+    reservationId: Optional[int] = Field(None, alias="reservation_id")
+    goodValue: Optional[str] = Field(None, alias="good_value")
+    attempts: int = Field(0)
+    lastError: Optional[str] = Field(None, alias="last_error")
+    createdAt: datetime = Field(..., alias="created_at")
+    updatedAt: datetime = Field(..., alias="updated_at")
@@ -17,3 +17,7 @@ class Jihanki(BaseModel):
     nsfw: bool
     freezed: Optional[str] = Field(None)
     shuffle: bool
+
+    def getGood(self, goodId: int) -> Optional[Good]:
+        """IDから商品を探します。見つからなかった場合はNoneを返します。"""
+        return next((good for good in self.goods if good.id == goodId), None)
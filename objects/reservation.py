@@ -0,0 +1,17 @@
+import secrets
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+class Reservation(BaseModel):
+    id: int
+    jihankiId: int
+    goodId: int
+    userId: int
+    expiresAt: datetime
+    channelId: Optional[int] = Field(None)
+    messageId: Optional[int] = Field(None)
+    # 確保ごとに異なる値。同じ在庫の行をほかのユーザーが確保し直しても、購入を区別できるようにする
+    token: str = Field(default_factory=lambda: secrets.token_hex(8))
@@ -1,16 +1,39 @@
+import asyncio
 import os
+import random
 import traceback
-from typing import Literal, Optional
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    Literal,
+    Optional,
+    TypeVar,
+)
 from zoneinfo import ZoneInfo
 
+import asyncpg
 import dotenv
+import httpx
+import orjson
 from aiokyasher import Kyash
 from aiopaypaython import PayPay
 from aiopaypaythonwebapi import PayPayWebAPI
 from cryptography.fernet import Fernet
 
+from objects import LinkStatus
+
+from .cache import SessionCache, TTLCache
+from .breaker import CircuitBreaker, ProviderUnavailable, guard
 from .database import Database
+from .proxy import ProxyHealthService
+from .singleflight import SingleFlight
+from .transport import TransportPool
 
 dotenv.load_dotenv()
 
@@ -27,53 +50,175 @@ class FailedToLoginException(Exception):
     pass
 
 
+class PaymentStatusUnknown(Exception):
+    """送金の途中で通信が途切れ、相手側で処理されたかどうかわからない
+    再試行すると二重に送金される可能性があるので、運営が確認するまで決済を止めておきます。"""
+
+    def __init__(self, provider: str):
+        super().__init__(
+            "決済サービスとの通信が途切れたため、決済が完了したか確認できませんでした。"
+        )
+        self.provider = provider
+
+
+def isAuthError(e: Exception) -> bool:
+    """トークンの期限切れなど、ログインし直せば成功する可能性のあるエラーかどうか。
+    ライブラリごとに例外クラスが違うので、クラス名で判定します。"""
+    return type(e).__name__.endswith("LoginError")
+
+
+def isProviderFailure(e: Exception) -> bool:
+    """決済サービスの不調によるエラーかどうか。通信エラー、タイムアウト、5xxだけを不調とみなします。"""
+    if isinstance(e, (httpx.TransportError, TimeoutError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return type(e).__name__.endswith("NetWorkError")
+
+
+def isStatusUnknown(e: Exception) -> bool:
+    """リクエストが相手に届いた後に途切れた可能性のあるエラーかどうか。
+    接続できなかった場合は、相手側で処理されていないことがわかっています。"""
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.ProxyError)):
+        return False
+    return isinstance(e, (httpx.TransportError, TimeoutError))
+
+
+T = TypeVar("T")
+C = TypeVar("C")
+
+PAYPAY_TOKEN_LIFETIME = timedelta(days=90)
+WEBAPI_TOKEN_LIFETIME = timedelta(hours=2)
+
+
+@dataclass
+class Session(Generic[C]):
+    """ログイン済みのクライアントと、そのトークンの情報"""
+
+    client: C
+    expiresAt: Optional[datetime] = None
+    validatedAt: datetime = field(
+        default_factory=lambda: datetime.now(ZoneInfo("Asia/Tokyo"))
+    )
+    proxy: Optional[str] = None
+
+    @property
+    def usable(self) -> bool:
+        """トークンの期限まで1分以上残っているかどうか。期限がわからない場合はTrueです。"""
+        return self.expiresAt is None or self.expiresAt > datetime.now(
+            ZoneInfo("Asia/Tokyo")
+        ) + timedelta(minutes=1)
+
+
 class AccountService:
-    kyashCache: dict[int, Kyash] = {}
-    paypayCache: dict[int, PayPay] = {}
-    paypayWebAPICache: dict[int, PayPayWebAPI] = {}
-    paypayExternalUserIds: dict[int, str] = {}
+    kyashCache: SessionCache[int, Session[Kyash]] = SessionCache(
+        closer=TransportPool.closeClient
+    )
+    paypayCache: SessionCache[int, Session[PayPay]] = SessionCache(
+        closer=TransportPool.closeClient
+    )
+    paypayWebAPICache: SessionCache[int, Session[PayPayWebAPI]] = SessionCache(
+        closer=TransportPool.closeClient
+    )
+    logins: SingleFlight[Any] = SingleFlight()
+    # 起動時に読み込んだ、前回のプロセスのセッション。初めて使われるときに復元されます。
+    snapshots: Dict[tuple[str, int], asyncpg.Record] = {}
+    # セッションの保存と復元に使う値。PayPayはそのままトークンでログインする処理に渡す。
+    # Kyashのloginはアプリのバージョンを調べに通信するので、作られたヘッダーごと保存してクライアントに直接設定する
+    sessionFields: Dict[str, tuple[str, ...]] = {
+        "paypay": ("access_token", "device_uuid", "client_uuid"),
+        "paypayWebAPI": ("access_token",),
+        "kyash": (
+            "access_token",
+            "client_uuid",
+            "installation_uuid",
+            "version",
+            "headers",
+        ),
+    }
+    # トークンの更新に失敗したアカウントの、連続して失敗した回数と次に更新する日時
+    refreshFailures: Dict[tuple[str, int], tuple[int, datetime]] = {}
+    linkStatusCache: TTLCache[int, LinkStatus] = TTLCache(maxsize=4096, ttl=300)
     cipherSuite = Fernet(os.getenv("fernet_key").encode())
 
     @classmethod
-    async def paypayExists(cls, userId: int) -> bool:
-        if userId in cls.paypayCache:
-            return True
-        else:
-            paypayAccount = await Database.pool.fetchrow(
-                "SELECT * FROM paypay WHERE id = $1", userId
+    async def getLinkStatuses(cls, userIds: Iterable[int]) -> Dict[int, LinkStatus]:
+        """複数のユーザーのアカウントのリンク状況を1回のクエリでまとめて取得します。
+        リンクしていないという結果もキャッシュされます。
+
+        Args:
+            userIds (Iterable[int]): ユーザーのIDのリスト。
+
+        Returns:
+            Dict[int, LinkStatus]: ユーザーごとのリンク状況。
+        """
+        statuses: Dict[int, LinkStatus] = {}
+        missing = []
+        for userId in dict.fromkeys(userIds):
+            status = cls.linkStatusCache.get(userId)
+            if status:
+                statuses[userId] = status
+            else:
+                missing.append(userId)
+
+        if missing:
+            rows = await Database.pool.fetch(
+                """
+                    SELECT
+                        users.id,
+                        paypay.client_uuid IS NOT NULL AS paypay,
+                        paypay.webapi_client_uuid IS NOT NULL AS paypay_webapi,
+                        paypay.external_user_id,
+                        kyash.id IS NOT NULL AS kyash
+                    FROM unnest($1::bigint[]) AS users(id)
+                    LEFT JOIN paypay ON paypay.id = users.id
+                    LEFT JOIN kyash ON kyash.id = users.id
+                """,
+                missing,
             )
-            if not paypayAccount:
-                return False
-            if not paypayAccount["client_uuid"]:
-                return False
-            cls.paypayExternalUserIds[userId] = paypayAccount["external_user_id"]
-            return True
+            for row in rows:
+                status = LinkStatus(
+                    paypay=row["paypay"],
+                    paypayWebAPI=row["paypay_webapi"],
+                    kyash=row["kyash"],
+                    paypayExternalUserId=row["external_user_id"],
+                )
+                cls.linkStatusCache.set(row["id"], status)
+                statuses[row["id"]] = status
+        return statuses
+
+    @classmethod
+    async def getLinkStatus(cls, userId: int) -> LinkStatus:
+        """ユーザーのアカウントのリンク状況を取得します。
+
+        Args:
+            userId (int): ユーザーのID。
+
+        Returns:
+            LinkStatus: リンク状況。
+        """
+        return (await cls.getLinkStatuses([userId]))[userId]
+
+    @classmethod
+    def invalidateLinkStatus(cls, userId: int) -> None:
+        """アカウントのリンクやプロキシの変更後に、キャッシュされたリンク状況を破棄します。
+
+        Args:
+            userId (int): ユーザーのID。
+        """
+        cls.linkStatusCache.pop(userId)
+
+    @classmethod
+    async def paypayExists(cls, userId: int) -> bool:
+        return (await cls.getLinkStatus(userId)).paypay
 
     @classmethod
     async def paypayWebAPIExists(cls, userId: int) -> bool:
-        if userId in cls.paypayCache:
-            return True
-        else:
-            paypayAccount = await Database.pool.fetchrow(
-                "SELECT * FROM paypay WHERE id = $1", userId
-            )
-            if not paypayAccount:
-                return False
-            if not paypayAccount["webapi_client_uuid"]:
-                return False
-            return True
+        return (await cls.getLinkStatus(userId)).paypayWebAPI
 
     @classmethod
     async def kyashExists(cls, userId: int) -> bool:
-        if userId in cls.paypayCache:
-            return True
-        else:
-            kyashAccount = await Database.pool.fetchrow(
-                "SELECT * FROM kyash WHERE id = $1", userId
-            )
-            if not kyashAccount:
-                return False
-            return True
+        return (await cls.getLinkStatus(userId)).kyash
 
     @classmethod
     async def getProxy(
@@ -87,95 +232,281 @@ class AccountService:
         return account["proxy"]
 
     @classmethod
-    async def loginPayPayProcess(cls, userId: int) -> PayPay:
-        paypayAccount = await Database.pool.fetchrow(
-            "SELECT * FROM paypay WHERE id = $1", userId
+    def _encrypt(cls, value: str) -> str:
+        return cls.cipherSuite.encrypt(value.encode()).decode()
+
+    @classmethod
+    def _breakers(
+        cls, provider: str, cache: SessionCache[int, Session], userId: int
+    ) -> list[CircuitBreaker]:
+        session = cache.get(userId)
+        proxy = session.proxy if session else None
+        return [
+            CircuitBreaker.get(provider),
+            CircuitBreaker.get(f"proxy:{ProxyHealthService.mask(proxy)}"),
+        ]
+
+    @classmethod
+    async def _call(
+        cls,
+        provider: str,
+        login: Callable[[int], Awaitable[Any]],
+        reLogin: Callable[[int], Awaitable[Any]],
+        userId: int,
+        func: Callable[[Any], Awaitable[T]],
+        *,
+        retry: bool = True,
+    ) -> T:
+        cache = cls._sessionCaches()[provider][0]
+        # 遮断中なら、ログインする前に諦める
+        CircuitBreaker.get(provider).ensureAvailable()
+        client = await login(userId)
+        try:
+            # 使っている間に、ほかの呼び出し元のログインでクライアントが閉じられないようにする
+            with cache.lease(client):
+                result = await guard(
+                    cls._breakers(provider, cache, userId),
+                    lambda: func(client),
+                    cancellable=retry,
+                    isFailure=isProviderFailure,
+                )
+        except ProviderUnavailable:
+            raise
+        except Exception as e:
+            if not retry:
+                if isStatusUnknown(e):
+                    raise PaymentStatusUnknown(provider) from e
+                raise
+            if not isAuthError(e):
+                # 通信エラーや残高不足などは、ログインし直しても結果が変わらない。
+                # タイムアウトは相手側で処理が終わっている可能性もあるので、再試行しない
+                raise
+            traceback.print_exc()
+            session = cache.get(userId)
+            if session and session.client is not client:
+                # ほかの呼び出し元がすでにログインし直している
+                client = session.client
+            else:
+                cache.pop(userId)
+                client = await reLogin(userId)
+            with cache.lease(client):
+                result = await guard(
+                    cls._breakers(provider, cache, userId),
+                    lambda: func(client),
+                    isFailure=isProviderFailure,
+                )
+        session = cache.get(userId)
+        if session:
+            session.validatedAt = datetime.now(ZoneInfo("Asia/Tokyo"))
+        return result
+
+    @classmethod
+    async def usePayPay(
+        cls,
+        userId: int,
+        func: Callable[[PayPay], Awaitable[T]],
+        *,
+        retry: bool = True,
+    ) -> T:
+        """PayPayのクライアントで処理を実行します。
+        トークンの期限切れで失敗した場合は、ログインし直して一度だけ再試行します。
+
+        Args:
+            userId (int): ユーザーのID。
+            func (Callable[[PayPay], Awaitable[T]]): 実行する処理。
+            retry (bool, optional): トークンの期限切れで失敗したときに、ログインし直して再試行するかどうか。
+                送金など、二重に実行されると困る処理ではFalseにしてください。
+                Falseの場合は制限時間で中断せず、通信が途切れたときはPaymentStatusUnknownを送出します。デフォルトはTrueです。
+
+        Returns:
+            T: 処理の結果。
+        """
+        return await cls._call(
+            "paypay",
+            cls.loginPayPay,
+            lambda userId: cls.loginPayPayProcess(userId, force=True),
+            userId,
+            func,
+            retry=retry,
         )
-        if not paypayAccount:
-            raise AccountNotLinkedException()
 
-        cls.paypayExternalUserIds[userId] = paypayAccount["external_user_id"]
+    @classmethod
+    async def usePayPayWebAPI(
+        cls,
+        userId: int,
+        func: Callable[[PayPayWebAPI], Awaitable[T]],
+        *,
+        retry: bool = True,
+    ) -> T:
+        """PayPay(Web API)のクライアントで処理を実行します。
+        トークンの期限切れで失敗した場合は、ログインし直して一度だけ再試行します。
+
+        Args:
+            userId (int): ユーザーのID。
+            func (Callable[[PayPayWebAPI], Awaitable[T]]): 実行する処理。
+            retry (bool, optional): トークンの期限切れで失敗したときに、ログインし直して再試行するかどうか。
+                送金など、二重に実行されると困る処理ではFalseにしてください。
+                Falseの場合は制限時間で中断せず、通信が途切れたときはPaymentStatusUnknownを送出します。デフォルトはTrueです。
+
+        Returns:
+            T: 処理の結果。
+        """
+        return await cls._call(
+            "paypayWebAPI",
+            cls.loginPayPayWebAPI,
+            lambda userId: cls.loginPayPayWebAPIProcess(userId, force=True),
+            userId,
+            func,
+            retry=retry,
+        )
+
+    @classmethod
+    async def useKyash(
+        cls,
+        userId: int,
+        func: Callable[[Kyash], Awaitable[T]],
+        *,
+        retry: bool = True,
+    ) -> T:
+        """Kyashのクライアントで処理を実行します。
+        トークンの期限切れで失敗した場合は、ログインし直して一度だけ再試行します。
+
+        Args:
+            userId (int): ユーザーのID。
+            func (Callable[[Kyash], Awaitable[T]]): 実行する処理。
+            retry (bool, optional): トークンの期限切れで失敗したときに、ログインし直して再試行するかどうか。
+                送金など、二重に実行されると困る処理ではFalseにしてください。
+                Falseの場合は制限時間で中断せず、通信が途切れたときはPaymentStatusUnknownを送出します。デフォルトはTrueです。
 
-        paypay = PayPay(proxy=paypayAccount["proxy"])
-        await paypay.initialize(
-            access_token=cls.cipherSuite.decrypt(paypayAccount["access_token"]).decode()
+        Returns:
+            T: 処理の結果。
+        """
+        return await cls._call(
+            "kyash", cls.loginKyash, cls.loginKyashProcess, userId, func, retry=retry
         )
 
-        async def tokenRefresh():
+    @classmethod
+    async def loginPayPayProcess(cls, userId: int, *, force: bool = False) -> PayPay:
+        # 同じユーザーのログインが同時に走った場合は、1回のログインにまとめる
+        # 強制的にログインし直す場合は、実行中のログインの結果ではなく新しいトークンを使う
+        return await cls.logins.do(
+            ("paypay", userId),
+            lambda: cls._loginPayPayProcess(userId, force=force),
+            fresh=force,
+        )
+
+    @classmethod
+    async def _renewPayPay(cls, paypayAccount: asyncpg.Record) -> PayPay:
+        """リフレッシュトークンでPayPayのトークンを更新します。
+        失敗した場合は電話番号とパスワードでログインし直します。"""
+        proxy = ProxyHealthService.select(paypayAccount["proxy"])
+        paypay = PayPay(proxy=proxy)
+        try:
+            await paypay.initialize(
+                access_token=cls.cipherSuite.decrypt(
+                    paypayAccount["access_token"]
+                ).decode()
+            )
             await paypay.token_refresh(
                 cls.cipherSuite.decrypt(paypayAccount["refresh_token"]).decode()
             )
-            expiresAt = datetime.now(ZoneInfo("Asia/Tokyo")) + timedelta(days=90)
+            return paypay
+        except:
+            if not (
+                paypayAccount["device_uuid"]
+                and paypayAccount["client_uuid"]
+                and paypayAccount["phone"]
+                and paypayAccount["password"]
+            ):
+                raise FailedToLoginException()
+        try:
+            paypay = PayPay(proxy=proxy)
+            await paypay.initialize(
+                phone=cls.cipherSuite.decrypt(paypayAccount["phone"]).decode(),
+                password=cls.cipherSuite.decrypt(paypayAccount["password"]).decode(),
+                device_uuid=str(paypayAccount["device_uuid"]).upper(),
+                client_uuid=str(paypayAccount["client_uuid"]).upper(),
+            )
+        except:
+            raise FailedToLoginException()
+        return paypay
+
+    @classmethod
+    async def _loginPayPayProcess(cls, userId: int, *, force: bool = False) -> PayPay:
+        """データベースに保存されたトークンでPayPayにログインします。
+        トークンの期限が切れている場合や、forceがTrueの場合はトークンを更新します。
+        """
+        paypayAccount = await Database.pool.fetchrow(
+            "SELECT * FROM paypay WHERE id = $1", userId
+        )
+        if not paypayAccount:
+            raise AccountNotLinkedException()
+
+        expiresAt = paypayAccount["expires_at"]
+        proxy = ProxyHealthService.select(paypayAccount["proxy"])
+        if force or expiresAt <= datetime.now(ZoneInfo("Asia/Tokyo")):
+            paypay = await cls._renewPayPay(paypayAccount)
+            expiresAt = datetime.now(ZoneInfo("Asia/Tokyo")) + PAYPAY_TOKEN_LIFETIME
             await Database.pool.execute(
                 "UPDATE ONLY paypay SET access_token = $1, refresh_token = $2, expires_at = $3 WHERE id = $4",
-                paypay.access_token,
-                paypay.refresh_token,
+                cls._encrypt(paypay.access_token),
+                cls._encrypt(paypay.refresh_token),
                 expiresAt,
                 userId,
             )
+        else:
+            paypay = PayPay(proxy=proxy)
+            await paypay.initialize(
+                access_token=cls.cipherSuite.decrypt(
+                    paypayAccount["access_token"]
+                ).decode()
+            )
+        TransportPool.attach(paypay, proxy)
+        cls.paypayCache.set(userId, Session(paypay, expiresAt, proxy=proxy))
+        return paypay
 
-        if (
-            paypayAccount["expires_at"].timestamp()
-            <= datetime.now(ZoneInfo("Asia/Tokyo")).timestamp()
-        ):
-            await tokenRefresh()
+    @classmethod
+    async def loginPayPay(cls, userId: int) -> PayPay:
+        session = cls.paypayCache.get(userId) or await cls._restoreSession(
+            "paypay", userId
+        )
+        if session and session.usable:
+            return session.client
+        return await cls.loginPayPayProcess(userId)
 
+    @classmethod
+    async def loginPayPayWebAPIProcess(
+        cls, userId: int, *, force: bool = False
+    ) -> PayPayWebAPI:
+        # 同じユーザーのログインが同時に走った場合は、1回のログインにまとめる
+        return await cls.logins.do(
+            ("paypayWebAPI", userId),
+            lambda: cls._loginPayPayWebAPIProcess(userId, force=force),
+            fresh=force,
+        )
+
+    @classmethod
+    async def _renewPayPayWebAPI(cls, paypayAccount: asyncpg.Record) -> PayPayWebAPI:
+        """電話番号とパスワードでPayPay(Web API)にログインし直します。"""
+        proxy = ProxyHealthService.select(paypayAccount["proxy"])
+        paypay = PayPayWebAPI(proxy=proxy)
         try:
-            await paypay.get_balance()
+            await paypay.initialize(
+                phone=cls.cipherSuite.decrypt(paypayAccount["phone"]).decode(),
+                password=cls.cipherSuite.decrypt(paypayAccount["password"]).decode(),
+                client_uuid=str(paypayAccount["webapi_client_uuid"]).upper(),
+            )
         except:
-            try:
-                await tokenRefresh()
-            except:
-                if (
-                    paypayAccount["device_uuid"]
-                    and paypayAccount["client_uuid"]
-                    and paypayAccount["phone"]
-                    and paypayAccount["password"]
-                ):
-                    try:
-                        paypay = PayPay(proxy=paypayAccount["proxy"])
-                        await paypay.initialize(
-                            phone=cls.cipherSuite.decrypt(
-                                paypayAccount["phone"]
-                            ).decode(),
-                            password=cls.cipherSuite.decrypt(
-                                paypayAccount["password"]
-                            ).decode(),
-                            device_uuid=str(paypayAccount["device_uuid"]).upper(),
-                            client_uuid=str(paypayAccount["client_uuid"]).upper(),
-                        )
-                        expiresAt = datetime.now(ZoneInfo("Asia/Tokyo")) + timedelta(
-                            days=90
-                        )
-
-                        await Database.pool.execute(
-                            "UPDATE ONLY paypay SET access_token = $1, refresh_token = $2, expires_at = $3 WHERE id = $4",
-                            paypay.access_token,
-                            paypay.refresh_token,
-                            expiresAt,
-                            userId,
-                        )
-                    except:
-                        raise FailedToLoginException()
-                else:
-                    raise FailedToLoginException()
-        cls.paypayCache[userId] = paypay
+            raise FailedToLoginException()
         return paypay
 
     @classmethod
-    async def loginPayPay(cls, userId: int) -> PayPay:
-        if userId in cls.paypayCache:
-            paypay = cls.paypayCache[userId]
-            try:
-                await paypay.get_balance()
-                return paypay
-            except:
-                return await cls.loginPayPayProcess(userId)
-        else:
-            return await cls.loginPayPayProcess(userId)
-
-    @classmethod
-    async def loginPayPayWebAPIProcess(cls, userId: int) -> PayPay:
+    async def _loginPayPayWebAPIProcess(
+        cls, userId: int, *, force: bool = False
+    ) -> PayPayWebAPI:
+        """データベースに保存されたトークンでPayPay(Web API)にログインします。
+        トークンの期限が切れている場合や、forceがTrueの場合は電話番号とパスワードでログインし直します。
+        """
         paypayAccount = await Database.pool.fetchrow(
             "SELECT * FROM paypay WHERE id = $1", userId
         )
@@ -183,66 +514,55 @@ class AccountService:
             raise AccountNotLinkedException()
         if not paypayAccount["webapi_client_uuid"]:
             raise AccountNotLinkedException()
-        paypay = PayPayWebAPI(proxy=paypayAccount["proxy"])
-
-        async def reLogin():
-            await paypay.initialize(
-                phone=cls.cipherSuite.decrypt(paypayAccount["phone"]).decode(),
-                password=cls.cipherSuite.decrypt(paypayAccount["password"]).decode(),
-                client_uuid=str(paypayAccount["webapi_client_uuid"]).upper(),
-            )
 
+        expiresAt = paypayAccount["webapi_expires_at"]
+        proxy = ProxyHealthService.select(paypayAccount["proxy"])
+        if force or expiresAt <= datetime.now(ZoneInfo("Asia/Tokyo")):
+            paypay = await cls._renewPayPayWebAPI(paypayAccount)
+            expiresAt = datetime.now(ZoneInfo("Asia/Tokyo")) + WEBAPI_TOKEN_LIFETIME
             await Database.pool.execute(
-                "UPDATE ONLY paypay SET webapi_access_token = $1 WHERE id = $2",
-                paypay.access_token,
+                "UPDATE ONLY paypay SET webapi_access_token = $1, webapi_expires_at = $2 WHERE id = $3",
+                cls._encrypt(paypay.access_token),
+                expiresAt,
                 userId,
             )
-
-        if (
-            paypayAccount["webapi_expires_at"].timestamp()
-            <= datetime.now(ZoneInfo("Asia/Tokyo")).timestamp()
-        ):
-            try:
-                await reLogin()
-            except:
-                raise FailedToLoginException()
         else:
-            try:
-                await paypay.initialize(
-                    access_token=cls.cipherSuite.decrypt(
-                        paypayAccount["webapi_access_token"]
-                    ).decode()
-                )
-                await paypay.get_balance()
-            except:
-                try:
-                    await reLogin()
-                except:
-                    raise FailedToLoginException()
-        cls.paypayWebAPICache[userId] = paypay
+            paypay = PayPayWebAPI(proxy=proxy)
+            await paypay.initialize(
+                access_token=cls.cipherSuite.decrypt(
+                    paypayAccount["webapi_access_token"]
+                ).decode()
+            )
+        TransportPool.attach(paypay, proxy)
+        cls.paypayWebAPICache.set(userId, Session(paypay, expiresAt, proxy=proxy))
         return paypay
 
     @classmethod
     async def loginPayPayWebAPI(cls, userId: int) -> PayPayWebAPI:
-        if userId in cls.paypayWebAPICache:
-            paypay = cls.paypayWebAPICache[userId]
-            try:
-                await paypay.get_balance()
-                return paypay
-            except:
-                return await cls.loginPayPayWebAPIProcess(userId)
-        else:
-            return await cls.loginPayPayWebAPIProcess(userId)
+        session = cls.paypayWebAPICache.get(userId) or await cls._restoreSession(
+            "paypayWebAPI", userId
+        )
+        if session and session.usable:
+            return session.client
+        return await cls.loginPayPayWebAPIProcess(userId)
+
+    @classmethod
+    async def loginKyashProcess(cls, userId: int) -> Kyash:
+        # 同じユーザーのログインが同時に走った場合は、1回のログインにまとめる
+        return await cls.logins.do(
+            ("kyash", userId), lambda: cls._loginKyashProcess(userId)
+        )
 
     @classmethod
-    async def loginKyashProcess(cls, userId) -> Kyash:
+    async def _loginKyashProcess(cls, userId: int) -> Kyash:
         kyashAccount = await Database.pool.fetchrow(
             "SELECT * FROM kyash WHERE id = $1", userId
         )
         if not kyashAccount:
             raise AccountNotLinkedException()
 
-        kyash = Kyash(proxy=kyashAccount["proxy"])
+        proxy = ProxyHealthService.select(kyashAccount["proxy"])
+        kyash = Kyash(proxy=proxy)
         try:
             await kyash.login(
                 email=cls.cipherSuite.decrypt(kyashAccount["email"]).decode(),
@@ -252,12 +572,320 @@ class AccountService:
             )
         except:
             raise FailedToLoginException()
-        cls.kyashCache[userId] = kyash
+        TransportPool.attach(kyash, proxy)
+        cls.kyashCache.set(userId, Session(kyash, proxy=proxy))
         return kyash
 
     @classmethod
     async def loginKyash(cls, userId: int) -> Kyash:
-        if userId in cls.kyashCache:
-            return cls.kyashCache[userId]
-        else:
-            return await cls.loginKyashProcess(userId)
+        session = cls.kyashCache.get(userId) or await cls._restoreSession(
+            "kyash", userId
+        )
+        if session and session.usable:
+            return session.client
+        return await cls.loginKyashProcess(userId)
+
+    @classmethod
+    async def refreshTokens(
+        cls,
+        *,
+        concurrency: int = 4,
+        jitter: float = 5.0,
+        paypayMargin: timedelta = timedelta(days=3),
+        webAPIMargin: timedelta = timedelta(minutes=15),
+        kyashIdle: timedelta = timedelta(minutes=20),
+        backoff: timedelta = timedelta(minutes=1),
+        maxBackoff: timedelta = timedelta(hours=1),
+    ) -> dict[str, int]:
+        """期限が近いトークンを、購入者を待たせないよう先回りして更新します。
+        対象は、キャッシュにセッションがある(最近使われた)アカウントだけです。使われていないアカウントでキャッシュを埋めないようにします。
+        更新したトークンは、キャッシュに入れる前にアカウントごとにデータベースに書き込みます。
+        更新に失敗したアカウントは、失敗した回数に応じて間隔を空けてから再び更新します。
+
+        Args:
+            concurrency (int, optional): 同時に更新する最大数。デフォルトは4です。
+            jitter (float, optional): 更新の開始をずらす最大の秒数。デフォルトは5秒です。
+            paypayMargin (timedelta, optional): PayPayのトークンを期限のどれぐらい前に更新するか。
+            webAPIMargin (timedelta, optional): PayPay(Web API)のトークンを期限のどれぐらい前に更新するか。
+            kyashIdle (timedelta, optional): Kyashのセッションをどれぐらい使われなかったら確認するか。
+            backoff (timedelta, optional): 1回失敗したアカウントを次に更新するまでの間隔。失敗するたびに倍になります。デフォルトは1分です。
+            maxBackoff (timedelta, optional): 失敗したアカウントを次に更新するまでの最大の間隔。デフォルトは1時間です。
+
+        Returns:
+            dict[str, int]: サービスごとの更新した数と、失敗が続いているため飛ばした数。
+        """
+        now = datetime.now(ZoneInfo("Asia/Tokyo"))
+        semaphore = asyncio.Semaphore(concurrency)
+        counts = {"paypay": 0, "paypayWebAPI": 0, "kyash": 0, "skipped": 0}
+
+        paypayIds = await Database.pool.fetch(
+            "SELECT id FROM paypay WHERE client_uuid IS NOT NULL AND expires_at < $1 AND id = ANY($2::bigint[])",
+            now + paypayMargin,
+            [userId for userId, _ in cls.paypayCache.items()],
+        )
+        webAPIIds = await Database.pool.fetch(
+            "SELECT id FROM paypay WHERE webapi_client_uuid IS NOT NULL AND webapi_expires_at < $1 AND id = ANY($2::bigint[])",
+            now + webAPIMargin,
+            [userId for userId, _ in cls.paypayWebAPICache.items()],
+        )
+
+        async def run(
+            provider: str, key: tuple[str, int], func: Callable[[], Awaitable[Any]]
+        ):
+            failures, nextAttempt = cls.refreshFailures.get(key, (0, now))
+            if nextAttempt > now:
+                counts["skipped"] += 1
+                return
+            async with semaphore:
+                # 一斉にアクセスしないよう、開始を少しずつずらす
+                await asyncio.sleep(random.uniform(0, jitter))
+                try:
+                    result = await cls.logins.do(key, func)
+                except:
+                    traceback.print_exc()
+                    # 失敗が続くアカウントに、毎回アクセスしないようにする
+                    delay = min(backoff * (2**failures), maxBackoff)
+                    cls.refreshFailures[key] = (
+                        failures + 1,
+                        datetime.now(ZoneInfo("Asia/Tokyo")) + delay,
+                    )
+                    return
+                cls.refreshFailures.pop(key, None)
+                if result is not None:
+                    counts[provider] += 1
+                return result
+
+        async def refreshPayPay(userId: int) -> Optional[PayPay]:
+            # 待っている間にほかのログインがトークンを更新しているかもしれないので、読み直す
+            row = await Database.pool.fetchrow(
+                "SELECT * FROM paypay WHERE id = $1 AND client_uuid IS NOT NULL AND expires_at < $2",
+                userId,
+                now + paypayMargin,
+            )
+            if not row or userId not in cls.paypayCache:
+                return None
+            paypay = await cls._renewPayPay(row)
+            expiresAt = datetime.now(ZoneInfo("Asia/Tokyo")) + PAYPAY_TOKEN_LIFETIME
+            # 古いリフレッシュトークンは使えなくなっているので、キャッシュに入れる前に保存する
+            await Database.pool.execute(
+                "UPDATE ONLY paypay SET access_token = $1, refresh_token = $2, expires_at = $3 WHERE id = $4",
+                cls._encrypt(paypay.access_token),
+                cls._encrypt(paypay.refresh_token),
+                expiresAt,
+                userId,
+            )
+            proxy = ProxyHealthService.select(row["proxy"])
+            TransportPool.attach(paypay, proxy)
+            cls.paypayCache.set(userId, Session(paypay, expiresAt, proxy=proxy))
+            return paypay
+
+        async def refreshPayPayWebAPI(userId: int) -> Optional[PayPayWebAPI]:
+            row = await Database.pool.fetchrow(
+                "SELECT * FROM paypay WHERE id = $1 AND webapi_client_uuid IS NOT NULL AND webapi_expires_at < $2",
+                userId,
+                now + webAPIMargin,
+            )
+            if not row or userId not in cls.paypayWebAPICache:
+                return None
+            paypay = await cls._renewPayPayWebAPI(row)
+            expiresAt = datetime.now(ZoneInfo("Asia/Tokyo")) + WEBAPI_TOKEN_LIFETIME
+            await Database.pool.execute(
+                "UPDATE ONLY paypay SET webapi_access_token = $1, webapi_expires_at = $2 WHERE id = $3",
+                cls._encrypt(paypay.access_token),
+                expiresAt,
+                userId,
+            )
+            proxy = ProxyHealthService.select(row["proxy"])
+            TransportPool.attach(paypay, proxy)
+            cls.paypayWebAPICache.set(userId, Session(paypay, expiresAt, proxy=proxy))
+            return paypay
+
+        async def checkKyash(userId: int) -> Optional[dict]:
+            if userId not in cls.kyashCache:
+                return None
+            return await cls.useKyash(userId, lambda kyash: kyash.get_wallet())
+
+        # Kyashのセッションは期限がわからないので、しばらく使われていないものを確認しておく
+        idleKyash = [
+            userId
+            for userId, session in cls.kyashCache.items()
+            if now - session.validatedAt > kyashIdle
+        ]
+
+        await asyncio.gather(
+            *(
+                run(
+                    "paypay",
+                    ("paypay", row["id"]),
+                    lambda userId=row["id"]: refreshPayPay(userId),
+                )
+                for row in paypayIds
+            ),
+            *(
+                run(
+                    "paypayWebAPI",
+                    ("paypayWebAPI", row["id"]),
+                    lambda userId=row["id"]: refreshPayPayWebAPI(userId),
+                )
+                for row in webAPIIds
+            ),
+            *(
+                run(
+                    "kyash",
+                    ("kyashCheck", userId),
+                    lambda userId=userId: checkKyash(userId),
+                )
+                for userId in idleKyash
+            ),
+        )
+        return counts
+
+    @classmethod
+    def _sessionCaches(cls) -> dict[str, tuple[SessionCache[int, Session], type]]:
+        return {
+            "paypay": (cls.paypayCache, PayPay),
+            "paypayWebAPI": (cls.paypayWebAPICache, PayPayWebAPI),
+            "kyash": (cls.kyashCache, Kyash),
+        }
+
+    @classmethod
+    async def _restoreSession(cls, provider: str, userId: int) -> Optional[Session]:
+        if (provider, userId) not in cls.snapshots:
+            return None
+        # 同じユーザーの復元が同時に走った場合は、1回の復元にまとめる
+        return await cls.logins.do(
+            (f"{provider}Restore", userId),
+            lambda: cls._restoreSessionProcess(provider, userId),
+        )
+
+    @classmethod
+    async def _restoreSessionProcess(
+        cls, provider: str, userId: int
+    ) -> Optional[Session]:
+        row = cls.snapshots.get((provider, userId))
+        if not row:
+            return None
+        cache, clientType = cls._sessionCaches()[provider]
+        proxy = ProxyHealthService.select(row["proxy"])
+        try:
+            state = orjson.loads(cls.cipherSuite.decrypt(row["data"].encode()))
+            tokens = {key: state.get(key) for key in cls.sessionFields[provider]}
+            if provider == "kyash" and not tokens["headers"]:
+                # ヘッダーを保存していなかった頃のセッションは、通常どおりログインし直す
+                return None
+            client = clientType(proxy=proxy)
+            if provider == "kyash":
+                # 通信せずに、ログイン後の状態をそのまま戻す
+                for key, value in tokens.items():
+                    setattr(client, key, value)
+            else:
+                # トークンでログインするライブラリの処理を通して、ヘッダーなどを作り直す
+                await client.initialize(**tokens)
+            TransportPool.attach(client, proxy)
+        except:
+            traceback.print_exc()
+            return None
+        finally:
+            cls.snapshots.pop((provider, userId), None)
+        # 復元したセッションが使えなかった場合は、usePayPayなどの再試行でログインし直される
+        session = Session(client, row["expires_at"], row["validated_at"], proxy)
+        cache.set(userId, session)
+        return session
+
+    @classmethod
+    def discardSession(
+        cls, userId: int, provider: Literal["paypay", "paypayWebAPI", "kyash"]
+    ) -> None:
+        """アカウントのリンクやプロキシの変更後に、キャッシュされたセッションを破棄します。
+
+        Args:
+            userId (int): ユーザーのID。
+            provider (Literal["paypay", "paypayWebAPI", "kyash"]): サービス。
+        """
+        cls.snapshots.pop((provider, userId), None)
+        cls.refreshFailures.pop((provider, userId), None)
+        cls._sessionCaches()[provider][0].pop(userId)
+
+    @classmethod
+    async def saveSessions(cls) -> int:
+        """ログイン済みのセッションを暗号化してデータベースに保存します。
+        `sessionFields`にある、トークンでログインし直すのに必要な値だけを保存します。
+
+        Returns:
+            int: 保存したセッションの数。
+        """
+        rows = []
+        for provider, (cache, _) in cls._sessionCaches().items():
+            for userId, session in cache.items():
+                state = {
+                    key: getattr(session.client, key, None)
+                    for key in cls.sessionFields[provider]
+                }
+                rows.append(
+                    (
+                        userId,
+                        provider,
+                        cls.cipherSuite.encrypt(orjson.dumps(state)).decode(),
+                        session.expiresAt,
+                        session.validatedAt,
+                    )
+                )
+        # まだ復元されていないセッションも次回に引き継ぐ
+        rows.extend(
+            (
+                row["user_id"],
+                row["provider"],
+                row["data"],
+                row["expires_at"],
+                row["validated_at"],
+            )
+            for row in cls.snapshots.values()
+        )
+
+        async with Database.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute("DELETE FROM account_sessions")
+                await connection.executemany(
+                    "INSERT INTO account_sessions (user_id, provider, data, expires_at, validated_at) VALUES ($1, $2, $3, $4, $5) ON CONFLICT DO NOTHING",
+                    rows,
+                )
+        return len(rows)
+
+    @classmethod
+    async def loadSessions(cls, *, idle: timedelta = timedelta(minutes=30)) -> int:
+        """前回のプロセスが保存したセッションを読み込みます。
+        読み込むだけで、実際に復元されるのはそのユーザーが初めてログインしようとしたときです。
+
+        Args:
+            idle (timedelta, optional): これより前から使われていないセッションは読み込みません。デフォルトは30分です。
+
+        Returns:
+            int: 読み込んだセッションの数。
+        """
+        rows = await Database.pool.fetch(
+            """
+                SELECT
+                    account_sessions.*,
+                    CASE WHEN account_sessions.provider = 'kyash' THEN kyash.proxy ELSE paypay.proxy END AS proxy
+                FROM account_sessions
+                LEFT JOIN paypay ON paypay.id = account_sessions.user_id
+                LEFT JOIN kyash ON kyash.id = account_sessions.user_id
+                WHERE account_sessions.validated_at > $1
+                    AND (
+                        (account_sessions.provider = 'kyash' AND kyash.id IS NOT NULL)
+                        OR (account_sessions.provider <> 'kyash' AND paypay.id IS NOT NULL)
+                    )
+            """,
+            datetime.now(ZoneInfo("Asia/Tokyo")) - idle,
+        )
+        cls.snapshots = {(row["provider"], row["user_id"]): row for row in rows}
+        return len(rows)
+
+    @classmethod
+    def sessionStats(cls) -> dict[str, dict[str, int | float]]:
+        """ログイン済みクライアントのキャッシュの統計情報を返します。"""
+        return {
+            "paypay": cls.paypayCache.stats(),
+            "paypayWebAPI": cls.paypayWebAPICache.stats(),
+            "kyash": cls.kyashCache.stats(),
+        }
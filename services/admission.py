@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import dotenv
+
+dotenv.load_dotenv()
+
+
+class Overloaded(Exception):
+    """混み合っているため、購入を受け付けなかった"""
+
+    pass
+
+
+class AdmissionController:
+    """購入の同時実行数を制限し、混み合っているときはすぐに断るための仕組み
+    上限を超えた購入は少しだけ待たせ、それでも空かない場合や待ち行列がいっぱいの場合は断ります。
+    決済サービスが遅くなっているときは、同時実行数の上限を自動的に下げます。
+    商品の選択と決済では処理時間が大きく違うので、処理時間は別々に記録し、上限には決済の処理時間だけを使います。"""
+
+    maxInFlight = int(os.getenv("purchase_max_inflight", 32))
+    minInFlight = 4
+    maxQueue = int(os.getenv("purchase_max_queue", 64))
+    queueTimeout = float(os.getenv("purchase_queue_timeout", 5))
+    # これより決済の処理時間が長くなると、同時実行数の上限を下げ始める
+    targetLatency = float(os.getenv("purchase_target_latency", 5))
+    alpha = 0.2
+
+    inFlight = 0
+    waiters = 0
+    # 決済サービスを呼び出す処理と、商品の選択などそれ以外の処理の、平均の処理時間(秒)
+    paymentLatency = 0.0
+    selectLatency = 0.0
+    accepted = 0
+    queued = 0
+    shed = 0
+    condition = asyncio.Condition()
+
+    @classmethod
+    def limit(cls) -> int:
+        """現在の同時実行数の上限。決済の処理時間が目標を超えた分だけ下がります。"""
+        if cls.paymentLatency <= cls.targetLatency:
+            return cls.maxInFlight
+        return max(
+            cls.minInFlight,
+            int(cls.maxInFlight * cls.targetLatency / cls.paymentLatency),
+        )
+
+    @classmethod
+    @asynccontextmanager
+    async def admit(cls, *, payment: bool = False) -> AsyncIterator[None]:
+        """購入を受け付けます。
+
+        Args:
+            payment (bool, optional): 決済サービスを呼び出す処理かどうか。処理時間を記録する先が変わります。デフォルトはFalseです。
+
+        Raises:
+            Overloaded: 混み合っていて受け付けられなかった場合。
+        """
+        async with cls.condition:
+            if cls.inFlight >= cls.limit():
+                # 待っても間に合いそうにない場合は、待たせずにすぐ断る
+                latency = cls.paymentLatency if payment else cls.selectLatency
+                expectedWait = (cls.waiters + 1) * latency / cls.limit()
+                if cls.waiters >= cls.maxQueue or expectedWait > cls.queueTimeout:
+                    cls.shed += 1
+                    raise Overloaded()
+                cls.queued += 1
+                cls.waiters += 1
+                try:
+                    await asyncio.wait_for(
+                        cls.condition.wait_for(lambda: cls.inFlight < cls.limit()),
+                        cls.queueTimeout,
+                    )
+                except TimeoutError:
+                    cls.shed += 1
+                    raise Overloaded()
+                finally:
+                    cls.waiters -= 1
+            cls.inFlight += 1
+            cls.accepted += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            async with cls.condition:
+                cls.inFlight -= 1
+                if payment:
+                    cls.paymentLatency = (
+                        cls.alpha * elapsed + (1 - cls.alpha) * cls.paymentLatency
+                    )
+                else:
+                    cls.selectLatency = (
+                        cls.alpha * elapsed + (1 - cls.alpha) * cls.selectLatency
+                    )
+                cls.condition.notify_all()
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        """受け付けの統計情報を返します。"""
+        return {
+            "inFlight": cls.inFlight,
+            "limit": cls.limit(),
+            "waiting": cls.waiters,
+            "paymentLatency": cls.paymentLatency,
+            "selectLatency": cls.selectLatency,
+            "accepted": cls.accepted,
+            "queued": cls.queued,
+            "shed": cls.shed,
+        }
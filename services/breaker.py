@@ -0,0 +1,222 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Literal, TypeVar
+
+import dotenv
+
+dotenv.load_dotenv()
+
+T = TypeVar("T")
+
+State = Literal["closed", "open", "halfOpen"]
+
+
+class ProviderUnavailable(Exception):
+    """決済サービスやプロキシが不調で、呼び出しを止めている"""
+
+    def __init__(self, name: str, message: str):
+        super().__init__(message)
+        self.name = name
+        self.message = message
+
+
+class CircuitBreaker:
+    """直近の呼び出しのエラー率と遅延を見て、不調な相手への呼び出しを一時的に止めるブレーカー
+    closed(通常) → open(遮断) → halfOpen(試しに1回だけ通す) → closed の順に状態が変わります。"""
+
+    breakers: Dict[str, "CircuitBreaker"] = {}
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        deadline: float = 20.0,
+        window: float = 60.0,
+        minCalls: int = 5,
+        failureRate: float = 0.5,
+        slowCall: float = 10.0,
+        openFor: float = 30.0,
+    ):
+        """
+        Args:
+            name (str): ブレーカーの名前。
+            deadline (float, optional): 1回の呼び出しの制限時間(秒)。デフォルトは20秒です。
+            window (float, optional): エラー率を計算する期間(秒)。デフォルトは60秒です。
+            minCalls (int, optional): 遮断を判断するのに必要な最小の呼び出し回数。デフォルトは5回です。
+            failureRate (float, optional): 遮断するエラー率(遅い呼び出しを含む)。デフォルトは50%です。
+            slowCall (float, optional): 遅い呼び出しとみなす時間(秒)。デフォルトは10秒です。
+            openFor (float, optional): 遮断してから試しに呼び出すまでの時間(秒)。デフォルトは30秒です。
+        """
+        self.name = name
+        self.deadline = deadline
+        self.window = window
+        self.minCalls = minCalls
+        self.failureRate = failureRate
+        self.slowCall = slowCall
+        self.openFor = openFor
+        self.state: State = "closed"
+        self.openedAt = 0.0
+        self.trial = False
+        self.calls: Deque[tuple[float, bool]] = deque()
+        self.transitions: Dict[str, int] = {}
+        self.rejected = 0
+
+    @classmethod
+    def get(cls, name: str) -> "CircuitBreaker":
+        """名前に対応するブレーカーを取得します。
+        制限時間は環境変数 `{name}_deadline` (例: `paypay_deadline`) で変更できます。
+
+        Args:
+            name (str): ブレーカーの名前。
+
+        Returns:
+            CircuitBreaker: ブレーカー。
+        """
+        breaker = cls.breakers.get(name)
+        if breaker is None:
+            deadline = float(
+                os.getenv(f"{name}_deadline", os.getenv("provider_deadline", 20))
+            )
+            breaker = cls(name, deadline=deadline, slowCall=deadline / 2)
+            cls.breakers[name] = breaker
+        return breaker
+
+    def _transition(self, state: State) -> None:
+        key = f"{self.state}->{state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.state = state
+        if state == "open":
+            self.openedAt = time.monotonic()
+        elif state == "closed":
+            self.calls.clear()
+
+    def check(self) -> None:
+        """呼び出してよいか確認します。
+
+        Raises:
+            ProviderUnavailable: 遮断中の場合。
+        """
+        if self.state == "open":
+            if time.monotonic() - self.openedAt < self.openFor:
+                self.rejected += 1
+                raise ProviderUnavailable(
+                    self.name, "現在混み合っているか、障害が発生しています。"
+                )
+            self._transition("halfOpen")
+            self.trial = False
+        if self.state == "halfOpen":
+            if self.trial:
+                self.rejected += 1
+                raise ProviderUnavailable(
+                    self.name, "現在混み合っているか、障害が発生しています。"
+                )
+            self.trial = True
+
+    def ensureAvailable(self) -> None:
+        """遮断中でないことを確認します。checkと違い、試しの呼び出しの枠は使いません。
+
+        Raises:
+            ProviderUnavailable: 遮断中の場合。
+        """
+        if self.state == "open" and time.monotonic() - self.openedAt < self.openFor:
+            self.rejected += 1
+            raise ProviderUnavailable(
+                self.name, "現在混み合っているか、障害が発生しています。"
+            )
+
+    def cancel(self) -> None:
+        """checkしたものの呼び出さなかった場合に、試しの呼び出しの枠を返します。"""
+        if self.state == "halfOpen":
+            self.trial = False
+
+    def record(self, ok: bool, latency: float) -> None:
+        """呼び出しの結果を記録します。
+
+        Args:
+            ok (bool): 成功したかどうか。
+            latency (float): かかった時間(秒)。
+        """
+        failed = (not ok) or latency >= self.slowCall
+        if self.state == "halfOpen":
+            self.trial = False
+            self._transition("open" if failed else "closed")
+            return
+
+        now = time.monotonic()
+        self.calls.append((now, failed))
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+        if len(self.calls) >= self.minCalls:
+            failures = sum(1 for _, failed in self.calls if failed)
+            if failures / len(self.calls) >= self.failureRate:
+                self._transition("open")
+
+    def stats(self) -> dict[str, int | str]:
+        """ブレーカーの統計情報を返します。"""
+        return {
+            "state": self.state,
+            "calls": len(self.calls),
+            "failures": sum(1 for _, failed in self.calls if failed),
+            "rejected": self.rejected,
+            **self.transitions,
+        }
+
+
+async def guard(
+    breakers: list[CircuitBreaker],
+    func: Callable[[], Awaitable[T]],
+    *,
+    cancellable: bool = True,
+    isFailure: Callable[[Exception], bool] = lambda e: True,
+) -> T:
+    """ブレーカーを通して呼び出します。
+    制限時間は、ブレーカーのうち一番短いものが使われます。
+
+    Args:
+        breakers (list[CircuitBreaker]): 通すブレーカー。
+        func (Callable[[], Awaitable[T]]): 呼び出す処理。
+        cancellable (bool, optional): 制限時間を過ぎたときに中断するかどうか。
+            送金など、途中で中断すると結果がわからなくなる処理ではFalseにしてください。その場合は遅い呼び出しとして記録するだけです。デフォルトはTrueです。
+        isFailure (Callable[[Exception], bool], optional): 例外を相手側の不調として記録するかどうかを判定する関数。
+            残高不足などの利用者側のエラーで遮断しないように使います。デフォルトではすべての例外を不調として記録します。
+
+    Raises:
+        ProviderUnavailable: 遮断中の場合や、制限時間内に終わらなかった場合。
+
+    Returns:
+        T: 処理の結果。
+    """
+    for i, breaker in enumerate(breakers):
+        try:
+            breaker.check()
+        except ProviderUnavailable:
+            for checked in breakers[:i]:
+                checked.cancel()
+            raise
+    deadline = min(breaker.deadline for breaker in breakers)
+    start = time.monotonic()
+    try:
+        async with asyncio.timeout(deadline if cancellable else None):
+            result = await func()
+    except TimeoutError:
+        for breaker in breakers:
+            breaker.record(False, time.monotonic() - start)
+        if not cancellable:
+            raise
+        raise ProviderUnavailable(
+            breakers[0].name, "応答に時間がかかりすぎたため、中断しました。"
+        )
+    except Exception as e:
+        ok = not isFailure(e)
+        for breaker in breakers:
+            breaker.record(ok, time.monotonic() - start)
+        raise
+    except asyncio.CancelledError:
+        for breaker in breakers:
+            breaker.cancel()
+        raise
+    for breaker in breakers:
+        breaker.record(True, time.monotonic() - start)
+    return result
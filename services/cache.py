@@ -0,0 +1,243 @@
+import asyncio
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterator,
+    TypeVar,
+)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class TTLCache(Generic[K, V]):
+    """件数の上限(LRU)と有効期限(TTL)を持つプロセス内キャッシュ。"""
+
+    def __init__(self, *, maxsize: int = 1024, ttl: float = 60.0):
+        """
+        Args:
+            maxsize (int, optional): 保持する最大件数。デフォルトは1024です。
+            ttl (float, optional): 有効期限(秒)。デフォルトは60秒です。
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        """キャッシュから値を取得します。期限切れの場合は削除されます。
+
+        Args:
+            key (K): キー。
+            default (Any, optional): 見つからなかった場合に返す値。デフォルトはNoneです。
+
+        Returns:
+            V | Any: キャッシュされた値。
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expiresAt, value = entry
+        if expiresAt <= time.monotonic():
+            self._evict(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, *, ttl: float | None = None) -> None:
+        """キャッシュに値を保存します。上限を超えた場合は最も古いものから削除されます。
+
+        Args:
+            key (K): キー。
+            value (V): 値。
+            ttl (float | None, optional): このエントリだけの有効期限(秒)。デフォルトはNoneです。
+        """
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._evict(next(iter(self._data)))
+
+    def pop(self, key: K, default: Any = None) -> V | Any:
+        """キャッシュから値を削除します。
+
+        Args:
+            key (K): キー。
+            default (Any, optional): 見つからなかった場合に返す値。デフォルトはNoneです。
+
+        Returns:
+            V | Any: 削除された値。
+        """
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self) -> None:
+        """キャッシュを空にします。"""
+        for key in list(self._data):
+            self._evict(key)
+
+    def purge(self) -> None:
+        """期限切れのエントリをすべて削除します。"""
+        now = time.monotonic()
+        for key in [
+            key for key, (expiresAt, _) in self._data.items() if expiresAt <= now
+        ]:
+            self._evict(key)
+
+    def items(self) -> list[tuple[K, V]]:
+        """期限切れでないエントリの一覧を返します。LRUの順番やヒット率には影響しません。"""
+        now = time.monotonic()
+        return [
+            (key, value)
+            for key, (expiresAt, value) in self._data.items()
+            if expiresAt > now
+        ]
+
+    def stats(self) -> dict[str, int | float]:
+        """キャッシュの統計情報を返します。"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": (self.hits / total) if total else 0.0,
+        }
+
+    def _evict(self, key: K) -> None:
+        self._data.pop(key, None)
+
+    def __contains__(self, key: K) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SessionCache(TTLCache[K, V]):
+    """ログイン済みのクライアントを保持するキャッシュ。
+    一定時間使われなかったものや、上限を超えて追い出されたものはHTTPセッションを閉じてから破棄します。
+    `lease`で使っている間のクライアントは、キャッシュから外れても使い終わるまで閉じません。"""
+
+    def __init__(
+        self,
+        *,
+        closer: Callable[[Any], Awaitable[None]],
+        maxsize: int = 1000,
+        idle: float = 30 * 60,
+        grace: float = 30.0,
+    ):
+        """
+        Args:
+            closer (Callable[[Any], Awaitable[None]]): クライアントのHTTPセッションを閉じる関数。
+            maxsize (int, optional): 保持する最大件数。デフォルトは1000です。
+            idle (float, optional): 使われなかった場合に破棄するまでの時間(秒)。デフォルトは30分です。
+            grace (float, optional): キャッシュから外れたクライアントを閉じるまで待つ時間(秒)。
+                キャッシュから取り出してから`lease`するまでの間に閉じられないようにします。デフォルトは30秒です。
+        """
+        super().__init__(maxsize=maxsize, ttl=idle)
+        self.closer = closer
+        self.grace = grace
+        self.evictions = 0
+        # クライアントごとの、使っている処理の数
+        self.leases: Dict[int, int] = {}
+        # キャッシュから外れたものの、まだ使われているクライアント
+        self.retired: Dict[int, Any] = {}
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        value = super().get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        # 使われるたびに期限を延ばす
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def set(self, key: K, value: V, *, ttl: float | None = None) -> None:
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not value:
+            self._close(entry[1])
+        # ログインのたびに、使われなくなったクライアントを片付ける
+        self.purge()
+        super().set(key, value, ttl=ttl)
+
+    def pop(self, key: K, default: Any = None) -> V | Any:
+        """キャッシュからクライアントを削除し、使われていなければHTTPセッションを閉じます。"""
+        value = super().pop(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self._close(value)
+        return value
+
+    @contextmanager
+    def lease(self, client: Any) -> Iterator[Any]:
+        """クライアントを使っている間、HTTPセッションが閉じられないようにします。
+
+        Args:
+            client (Any): 使うクライアント。
+        """
+        key = id(client)
+        self.leases[key] = self.leases.get(key, 0) + 1
+        try:
+            yield client
+        finally:
+            self.leases[key] -= 1
+            if self.leases[key] <= 0:
+                del self.leases[key]
+                retired = self.retired.pop(key, None)
+                if retired is not None:
+                    self._schedule(retired)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            **super().stats(),
+            "evictions": self.evictions,
+            "leased": len(self.leases),
+            "retired": len(self.retired),
+        }
+
+    def _evict(self, key: K) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.evictions += 1
+            self._close(entry[1])
+
+    def _close(self, value: V) -> None:
+        # Sessionで包まれている場合は、中のクライアントを閉じる
+        client = getattr(value, "client", value)
+        if id(client) in self.leases:
+            # 使い終わったときに閉じる
+            self.retired[id(client)] = client
+            return
+        self._schedule(client)
+
+    def _schedule(self, client: Any) -> None:
+        try:
+            asyncio.get_running_loop().create_task(self._closeLater(client))
+        except RuntimeError:
+            pass
+
+    async def _closeLater(self, client: Any) -> None:
+        await asyncio.sleep(self.grace)
+        if id(client) in self.leases:
+            self.retired[id(client)] = client
+            return
+        try:
+            await self.closer(client)
+        except:
+            traceback.print_exc()
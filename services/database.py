@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 
 import asyncpg
 import dotenv
@@ -12,3 +13,23 @@ class Database:
     @classmethod
     async def connect(cls):
         cls.pool = await asyncpg.create_pool(os.getenv("dsn"), statement_cache_size=0)
+
+    @classmethod
+    async def migrate(cls, directory: str = "migrations"):
+        """未適用のマイグレーション(migrations/*.sql)をファイル名順に適用します。"""
+        async with cls.pool.acquire() as connection:
+            await connection.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations (name TEXT PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+            applied = {
+                row["name"]
+                for row in await connection.fetch("SELECT name FROM schema_migrations")
+            }
+            for path in sorted(Path(directory).glob("*.sql")):
+                if path.name in applied:
+                    continue
+                async with connection.transaction():
+                    await connection.execute(path.read_text(encoding="utf-8"))
+                    await connection.execute(
+                        "INSERT INTO schema_migrations (name) VALUES ($1)", path.name
+                    )
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, Dict
+
+import dotenv
+
+dotenv.load_dotenv()
+
+
+class PurchaseExecutor:
+    """決済を、お金を動かすユーザーごとに順番に実行するための仕組み
+    販売者と購入者など、同じユーザーが関わる決済は来た順に1つずつ、関わるユーザーが重ならない決済は全体の上限まで並行して実行されます。"""
+
+    semaphore = asyncio.Semaphore(int(os.getenv("purchase_concurrency", 16)))
+    locks: Dict[int, asyncio.Lock] = {}
+    # ユーザーごとの、実行中または待っている決済の数
+    depths: Dict[int, int] = {}
+    completed = 0
+    totalWait = 0.0
+    maxWait = 0.0
+
+    @classmethod
+    @asynccontextmanager
+    async def slot(cls, *userIds: int) -> AsyncIterator[None]:
+        """決済に関わるユーザー全員の順番が来るまで待ってから、決済を実行する枠を確保します。
+
+        Args:
+            *userIds (int): 決済に関わるユーザー(販売者と購入者など)のID。
+        """
+        userIds = sorted(set(userIds))
+        for userId in userIds:
+            cls.locks.setdefault(userId, asyncio.Lock())
+            cls.depths[userId] = cls.depths.get(userId, 0) + 1
+        start = time.monotonic()
+        try:
+            async with AsyncExitStack() as stack:
+                # ほかの決済と互いに待ち合わないよう、ロックは常にIDの小さい順に取る
+                for userId in userIds:
+                    await stack.enter_async_context(cls.locks[userId])
+                # ユーザーの順番を先に待つことで、同じユーザーの決済が全体の枠を埋めないようにする
+                await stack.enter_async_context(cls.semaphore)
+                wait = time.monotonic() - start
+                cls.totalWait += wait
+                cls.maxWait = max(cls.maxWait, wait)
+                try:
+                    yield
+                finally:
+                    cls.completed += 1
+        finally:
+            for userId in userIds:
+                cls.depths[userId] -= 1
+                if cls.depths[userId] <= 0:
+                    del cls.depths[userId]
+                    del cls.locks[userId]
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        """決済の待ち行列の統計情報を返します。"""
+        return {
+            "users": len(cls.depths),
+            "depth": sum(cls.depths.values()),
+            "maxDepth": max(cls.depths.values(), default=0),
+            "completed": cls.completed,
+            "avgWait": (cls.totalWait / cls.completed) if cls.completed else 0.0,
+            "maxWait": cls.maxWait,
+        }
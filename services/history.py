@@ -0,0 +1,176 @@
+import asyncio
+import os
+import traceback
+from typing import List, Optional, Tuple
+
+import asyncpg
+import dotenv
+from snowflake import SnowflakeGenerator
+
+from .database import Database
+
+dotenv.load_dotenv()
+
+HistoryRow = Tuple[int, Optional[str], Optional[str], int, int, str, int]
+
+
+class HistoryService:
+    """取引履歴を書き込むサービス
+    取引の両側(支払った側と受け取った側)の行は、常に1つのトランザクションでまとめて書き込みます。
+    `history_flush_interval`(秒)を設定すると、その間に届いた複数の取引をまとめて1回で書き込みます。"""
+
+    generator = SnowflakeGenerator(15)
+    interval = float(os.getenv("history_flush_interval", 0))
+
+    pending: List[Tuple[int, List[HistoryRow], asyncio.Future]] = []
+    flushing: Optional[asyncio.Task] = None
+    batches = 0
+    written = 0
+
+    @classmethod
+    def legs(
+        cls,
+        *,
+        userId: int,
+        toId: int,
+        type: str,
+        gotType: str,
+        amount: int,
+        jihanki: Optional[str] = None,
+        good: Optional[str] = None,
+    ) -> List[HistoryRow]:
+        """1つの取引の両側の行を作ります。
+
+        Args:
+            userId (int): お金を払ったユーザーのID。
+            toId (int): お金を受け取ったユーザーのID。
+            type (str): 払った側の種別。
+            gotType (str): 受け取った側の種別。
+            amount (int): 金額。
+            jihanki (Optional[str], optional): 自販機のJSON。デフォルトはNoneです。
+            good (Optional[str], optional): 商品のJSON。デフォルトはNoneです。
+
+        Returns:
+            List[HistoryRow]: 書き込む行。
+        """
+        return [
+            (next(cls.generator), jihanki, good, userId, toId, type, -amount),
+            (next(cls.generator), jihanki, good, toId, userId, gotType, amount),
+        ]
+
+    @classmethod
+    async def insert(
+        cls, rows: List[HistoryRow], *, connection: Optional[asyncpg.Connection] = None
+    ) -> None:
+        """行を書き込みます。接続を渡さない場合は、新しいトランザクションで書き込みます。
+
+        Args:
+            rows (List[HistoryRow]): 書き込む行。
+            connection (Optional[asyncpg.Connection], optional): トランザクション中の接続。デフォルトはNoneです。
+        """
+        if not rows:
+            return
+        if connection is None:
+            async with Database.pool.acquire() as connection:
+                async with connection.transaction():
+                    await cls.insert(rows, connection=connection)
+            return
+        # executemanyはパイプラインで送られるので、行数に関わらず1往復で済む
+        await connection.executemany(
+            "INSERT INTO history (id, jihanki, good, user_id, to_id, type, amount) VALUES ($1, $2, $3, $4, $5, $6, $7)",
+            rows,
+        )
+        cls.written += len(rows)
+
+    @classmethod
+    async def _markRecorded(
+        cls, connection: asyncpg.Connection, intentIds: List[int]
+    ) -> set[int]:
+        return {
+            row["id"]
+            for row in await connection.fetch(
+                "UPDATE payment_intents SET state = 'recorded', updated_at = now() WHERE id = ANY($1::bigint[]) AND state = 'delivered' RETURNING id",
+                intentIds,
+            )
+        }
+
+    @classmethod
+    async def record(cls, intentId: int, rows: List[HistoryRow]) -> bool:
+        """決済を記録済みにし、その履歴を書き込みます。
+        記録済みにする更新と履歴の書き込みは同じトランザクションで行われるので、二重に記録されることはありません。
+
+        Args:
+            intentId (int): 受け渡しの終わった決済のID。
+            rows (List[HistoryRow]): 書き込む行。
+
+        Returns:
+            bool: この呼び出しで記録したかどうか。
+        """
+        if cls.interval <= 0:
+            async with Database.pool.acquire() as connection:
+                async with connection.transaction():
+                    if not await cls._markRecorded(connection, [intentId]):
+                        return False
+                    await cls.insert(rows, connection=connection)
+            cls.batches += 1
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        cls.pending.append((intentId, rows, future))
+        if cls.flushing is None:
+            cls.flushing = asyncio.create_task(cls._flushLater())
+        return await future
+
+    @classmethod
+    async def _flushLater(cls) -> None:
+        await asyncio.sleep(cls.interval)
+        # 書き込み中に届いた取引は、次のまとまりとして書き込む
+        cls.flushing = None
+        await cls.flush()
+
+    @classmethod
+    async def flush(cls) -> None:
+        """まとめて書き込むために待たせている取引を、今すぐ書き込みます。"""
+        pending, cls.pending = cls.pending, []
+        if not pending:
+            return
+
+        try:
+            async with Database.pool.acquire() as connection:
+                async with connection.transaction():
+                    recorded = await cls._markRecorded(
+                        connection, [intentId for intentId, _, _ in pending]
+                    )
+                    await cls.insert(
+                        [
+                            row
+                            for intentId, rows, _ in pending
+                            if intentId in recorded
+                            for row in rows
+                        ],
+                        connection=connection,
+                    )
+        except BaseException as e:
+            traceback.print_exc()
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+
+        cls.batches += 1
+        for intentId, _, future in pending:
+            if not future.done():
+                future.set_result(intentId in recorded)
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        """書き込みの統計情報を返します。"""
+        return {
+            "interval": cls.interval,
+            "pending": len(cls.pending),
+            "batches": cls.batches,
+            "rows": cls.written,
+            "rowsPerBatch": (cls.written / cls.batches) if cls.batches else 0.0,
+        }
@@ -0,0 +1,318 @@
+from datetime import datetime, timedelta
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+
+import asyncpg
+from snowflake import SnowflakeGenerator
+
+from objects import Good, Jihanki, PaymentIntent, PaymentType, Reservation
+
+from .database import Database
+from .history import HistoryService
+from .jihanki import JihankiService
+from .reservation import ReservationService
+
+# 状態は created → paid → delivered → recorded の順にしか進まない
+# 途中で止まった場合は、failed(お金が動いていない)か unknown(決済が完了したか確認できない)になる
+# 決済の後に商品を受け渡せなかった場合は、refund_required(返金が必要)になる
+STATES = ["created", "paid", "delivered", "recorded"]
+
+
+class IntentAlreadyExists(Exception):
+    """同じキーの決済がすでに処理中か、完了している"""
+
+    def __init__(self, intent: PaymentIntent):
+        super().__init__(f"決済 {intent.id} はすでに {intent.state} です")
+        self.intent = intent
+
+
+class IntentService:
+    """決済の進み具合を記録し、途中で止まった決済を再開できるようにするサービス
+    各段階はデータベース上で一度しか進まないので、同じ決済を何度再開しても安全です。"""
+
+    generator = SnowflakeGenerator(16)
+
+    @classmethod
+    async def create(
+        cls,
+        key: str,
+        *,
+        kind: str,
+        userId: int,
+        toId: int,
+        amount: int,
+        paymentType: PaymentType,
+        jihanki: Optional[Jihanki] = None,
+        good: Optional[Good] = None,
+        reservation: Optional[Reservation] = None,
+    ) -> PaymentIntent:
+        """決済を記録します。
+        同じキーの決済が失敗していた場合は、それを作り直して返します。
+
+        Args:
+            key (str): 決済を識別するキー。在庫の確保のIDや送金リンクなど、同じ決済を二重に行わないための値を使います。
+            kind (str): 決済の種類。`BUY`、`SEND`、`CLAIM`のいずれかです。
+            userId (int): お金を払うユーザーのID。
+            toId (int): お金を受け取るユーザーのID。
+            amount (int): 金額。
+            paymentType (PaymentType): 決済に使うサービス。
+            jihanki (Optional[Jihanki], optional): 購入した商品が属する自販機。デフォルトはNoneです。
+            good (Optional[Good], optional): 購入した商品。デフォルトはNoneです。
+            reservation (Optional[Reservation], optional): 確保した在庫。デフォルトはNoneです。
+
+        Raises:
+            IntentAlreadyExists: 同じキーの決済がすでに処理中か、完了している場合。
+
+        Returns:
+            PaymentIntent: 記録された決済。
+        """
+        row = await Database.pool.fetchrow(
+            """
+                INSERT INTO payment_intents (id, idempotency_key, kind, user_id, to_id, amount, payment_type, jihanki, good, reservation_id)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                ON CONFLICT (idempotency_key) DO UPDATE SET
+                    state = 'created', kind = EXCLUDED.kind, user_id = EXCLUDED.user_id, to_id = EXCLUDED.to_id,
+                    amount = EXCLUDED.amount, payment_type = EXCLUDED.payment_type, jihanki = EXCLUDED.jihanki,
+                    good = EXCLUDED.good, reservation_id = EXCLUDED.reservation_id, last_error = NULL, updated_at = now()
+                -- お金が動いていないことがわかっている失敗した決済だけを、やり直せるようにする
+                WHERE payment_intents.state = 'failed'
+                RETURNING *
+            """,
+            next(cls.generator),
+            key,
+            kind,
+            userId,
+            toId,
+            amount,
+            paymentType.value,
+            (
+                jihanki.model_dump_json(by_alias=True, exclude={"goods"})
+                if jihanki
+                else None
+            ),
+            # コードは在庫から取り出したときに記録する
+            (
+                good.model_copy(update={"value": "", "stock": 0}).model_dump_json()
+                if good
+                else None
+            ),
+            reservation.id if reservation else None,
+        )
+        if not row:
+            row = await Database.pool.fetchrow(
+                "SELECT * FROM payment_intents WHERE idempotency_key = $1", key
+            )
+            raise IntentAlreadyExists(PaymentIntent(**dict(row)))
+        return PaymentIntent(**dict(row))
+
+    @classmethod
+    async def advance(
+        cls,
+        intent: PaymentIntent,
+        state: str,
+        *,
+        connection: Optional[asyncpg.Connection] = None,
+    ) -> bool:
+        """決済を次の段階に進めます。
+        ほかの処理がすでに進めていた場合は何もしません。
+
+        Args:
+            intent (PaymentIntent): 決済。
+            state (str): 進める先の段階。
+            connection (Optional[asyncpg.Connection], optional): トランザクション中の接続。デフォルトはNoneです。
+
+        Returns:
+            bool: この呼び出しで進めることができたかどうか。
+        """
+        previous = STATES[STATES.index(state) - 1]
+        updated = await (connection or Database.pool).fetchval(
+            "UPDATE payment_intents SET state = $1, updated_at = now() WHERE id = $2 AND state = $3 RETURNING id",
+            state,
+            intent.id,
+            previous,
+        )
+        if updated:
+            intent.state = state
+        return updated is not None
+
+    @classmethod
+    async def _settle(cls, intent: PaymentIntent, state: str, error: str) -> None:
+        await Database.pool.execute(
+            "UPDATE payment_intents SET state = $1, last_error = $2, updated_at = now() WHERE id = $3 AND state <> 'recorded'",
+            state,
+            error,
+            intent.id,
+        )
+        intent.state = state
+        intent.lastError = error
+
+    @classmethod
+    async def fail(cls, intent: PaymentIntent, error: str) -> None:
+        """決済を失敗にします。お金が動いていないことがわかっている場合にだけ使います。
+
+        Args:
+            intent (PaymentIntent): 決済。
+            error (str): 失敗した理由。
+        """
+        await cls._settle(intent, "failed", error)
+
+    @classmethod
+    async def markUnknown(cls, intent: PaymentIntent, error: str) -> None:
+        """決済が完了したか確認できないことを記録します。
+        自動では再開も失敗もしないので、運営が決済サービスの履歴を確認して処理します。
+
+        Args:
+            intent (PaymentIntent): 決済。
+            error (str): 確認できなかった理由。
+        """
+        await cls._settle(intent, "unknown", error)
+
+    @classmethod
+    async def requireRefund(cls, intent: PaymentIntent, error: str) -> bool:
+        """決済は終わったものの商品を受け渡せず、返金が必要なことを記録します。
+
+        Args:
+            intent (PaymentIntent): 決済の終わった購入。
+            error (str): 受け渡せなかった理由。
+
+        Returns:
+            bool: この呼び出しで記録したかどうか。ほかの処理がすでに記録していた場合はFalseです。
+        """
+        updated = await Database.pool.fetchval(
+            "UPDATE payment_intents SET state = 'refund_required', last_error = $1, updated_at = now() WHERE id = $2 AND state = 'paid' RETURNING id",
+            error,
+            intent.id,
+        )
+        intent.state = "refund_required"
+        intent.lastError = error
+        return updated is not None
+
+    @classmethod
+    def getJihanki(cls, intent: PaymentIntent) -> Optional[Jihanki]:
+        """決済の時点の自販機を返します。"""
+        return Jihanki.model_validate_json(intent.jihanki) if intent.jihanki else None
+
+    @classmethod
+    def getGood(cls, intent: PaymentIntent) -> Optional[Good]:
+        """決済の時点の商品を返します。在庫から取り出したコードが入っています。"""
+        if not intent.good:
+            return None
+        return Good.model_validate_json(intent.good).model_copy(
+            update={"value": intent.goodValue}
+        )
+
+    @classmethod
+    async def takeStock(cls, intent: PaymentIntent) -> Optional[str]:
+        """購入された商品のコードを在庫から取り出し、決済に記録します。
+        すでに取り出している場合は、そのコードを返します。
+        在庫の削除と記録は同じトランザクションで行われるので、コードが失われることはありません。
+
+        Args:
+            intent (PaymentIntent): 購入の決済。
+
+        Returns:
+            Optional[str]: 暗号化されたコード。在庫がない場合はNoneです。
+        """
+        if intent.goodValue is not None:
+            return intent.goodValue
+
+        jihanki = cls.getJihanki(intent)
+        good = Good.model_validate_json(intent.good)
+        async with Database.pool.acquire() as connection:
+            async with connection.transaction():
+                # 同じ決済を同時に処理している場合に備えて、行をロックしてから確認する
+                value = await connection.fetchval(
+                    "SELECT good_value FROM payment_intents WHERE id = $1 FOR UPDATE",
+                    intent.id,
+                )
+                if value is None:
+                    if good.infinite:
+                        value = await connection.fetchval(
+                            "SELECT value FROM goods WHERE id = $1", good.id
+                        )
+                    elif intent.reservationId:
+                        value = await ReservationService.commit(
+                            jihanki,
+                            good,
+                            Reservation(
+                                id=intent.reservationId,
+                                jihankiId=jihanki.id,
+                                goodId=good.id,
+                                userId=intent.userId,
+                                expiresAt=datetime.now(ZoneInfo("Asia/Tokyo")),
+                            ),
+                            connection=connection,
+                        )
+                    else:
+                        value = await JihankiService.dispenseStock(
+                            jihanki, good, connection=connection
+                        )
+                    if value is None:
+                        return None
+                    await connection.execute(
+                        "UPDATE payment_intents SET good_value = $1, updated_at = now() WHERE id = $2",
+                        value,
+                        intent.id,
+                    )
+        intent.goodValue = value
+        return value
+
+    @classmethod
+    async def record(cls, intent: PaymentIntent) -> bool:
+        """決済を履歴に記録します。
+        履歴の書き込みと段階の更新は同じトランザクションで行われるので、二重に記録されることはありません。
+
+        Args:
+            intent (PaymentIntent): 受け渡しの終わった決済。
+
+        Returns:
+            bool: この呼び出しで記録したかどうか。
+        """
+        if intent.kind == "BUY":
+            rows = HistoryService.legs(
+                userId=intent.userId,
+                toId=intent.toId,
+                type="BUY",
+                gotType="GOT_BUY",
+                amount=intent.amount,
+                jihanki=cls.getJihanki(intent).model_dump_json(exclude={"goods"}),
+                good=cls.getGood(intent).model_dump_json(),
+            )
+        else:
+            rows = HistoryService.legs(
+                userId=intent.userId,
+                toId=intent.toId,
+                type=f"SEND_{intent.paymentType.value}",
+                gotType=f"GOT_{intent.paymentType.value}",
+                amount=intent.amount,
+            )
+
+        if not await HistoryService.record(intent.id, rows):
+            return False
+        intent.state = "recorded"
+        return True
+
+    @classmethod
+    async def getStuck(cls, olderThan: timedelta) -> List[PaymentIntent]:
+        """しばらく進んでいない決済を取得します。
+
+        Args:
+            olderThan (timedelta): 最後に進んでからの時間。
+
+        Returns:
+            List[PaymentIntent]: 止まっている決済。
+        """
+        rows = await Database.pool.fetch(
+            "SELECT * FROM payment_intents WHERE state IN ('created', 'paid', 'delivered') AND updated_at < $1 ORDER BY id LIMIT 100",
+            datetime.now(ZoneInfo("Asia/Tokyo")) - olderThan,
+        )
+        return [PaymentIntent(**dict(row)) for row in rows]
+
+    @classmethod
+    async def touch(cls, intent: PaymentIntent, error: Optional[str] = None) -> None:
+        """再開に失敗したことを記録します。"""
+        await Database.pool.execute(
+            "UPDATE payment_intents SET attempts = attempts + 1, last_error = $1, updated_at = now() WHERE id = $2",
+            error,
+            intent.id,
+        )
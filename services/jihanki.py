@@ -1,13 +1,24 @@
 from typing import List, Optional
 
+import asyncpg
 import discord
 import orjson
 from discord import app_commands
+from snowflake import SnowflakeGenerator
 
-from objects import Jihanki
+from objects import Good, Jihanki
 
+from .cache import TTLCache
 from .database import Database
 
+JIHANKI_COLUMNS = "id, created_at, name, description, owner_id, achievement_channel_id, nsfw, freezed, shuffle"
+AVAILABLE_STOCK = (
+    "(good_stock.reserved_until IS NULL OR good_stock.reserved_until < now())"
+)
+STOCK_SUBQUERY = f"(SELECT COUNT(*) FROM good_stock WHERE good_stock.good_id = goods.id AND {AVAILABLE_STOCK})"
+GOOD_COLUMNS = f"goods.*, {STOCK_SUBQUERY} AS stock"
+GOODS_SUBQUERY = f"COALESCE((SELECT json_agg(to_jsonb(goods) || jsonb_build_object('stock', {STOCK_SUBQUERY}) ORDER BY goods.position, goods.id) FROM goods WHERE goods.jihanki_id = jihanki.id), '[]')"
+
 
 class FailedToRequest(Exception):
     pass
@@ -17,9 +28,47 @@ class JihankiNotFoundException(Exception):
     pass
 
 
+class GoodNotFoundException(Exception):
+    pass
+
+
 class JihankiService:
     """自販機を管理するサービス"""
 
+    cache: TTLCache[int, Jihanki] = TTLCache(maxsize=512, ttl=60)
+    goodIdGenerator = SnowflakeGenerator(40)
+
+    @classmethod
+    def _cacheJihanki(cls, jihanki: Jihanki) -> Jihanki:
+        """自販機をキャッシュに保存し、呼び出し元が変更してもよいコピーを返します。"""
+        cls.cache.set(jihanki.id, jihanki)
+        return jihanki.model_copy(deep=True)
+
+    @classmethod
+    def _rowToJihanki(cls, row, goods: Optional[List[Good]] = None) -> Jihanki:
+        dictRow = dict(row)
+        if goods is not None:
+            dictRow["goods"] = goods
+        else:
+            dictRow["goods"] = orjson.loads(dictRow["goods"])
+        return Jihanki.model_validate(dictRow)
+
+    @classmethod
+    def _patchCachedGoods(cls, jihankiId: int, good: Good, *, delete: bool = False):
+        """キャッシュされている自販機の商品を1件だけ更新します。"""
+        cached: Optional[Jihanki] = cls.cache.pop(jihankiId)
+        if not cached:
+            return
+        goods = [_good for _good in cached.goods if _good.id != good.id]
+        if not delete:
+            index = next(
+                (i for i, _good in enumerate(cached.goods) if _good.id == good.id),
+                len(goods),
+            )
+            goods.insert(index, good.model_copy(deep=True))
+        cached.goods = goods
+        cls.cache.set(jihankiId, cached)
+
     @classmethod
     async def makeJihanki(cls, jihanki: Jihanki) -> Jihanki:
         """自販機を作成します。
@@ -34,7 +83,7 @@ class JihankiService:
             Jihanki: 完全な自販機のインスタンス。
         """
         row = await Database.pool.fetchrow(
-            "INSERT INTO jihanki (id, name, description, owner_id, achievement_channel_id, nsfw, shuffle) VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *",
+            f"INSERT INTO jihanki (id, name, description, owner_id, achievement_channel_id, nsfw, shuffle) VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING {JIHANKI_COLUMNS}",
             jihanki.id,
             jihanki.name,
             jihanki.description,
@@ -45,9 +94,7 @@ class JihankiService:
         )
         if not row:
             raise FailedToRequest()
-        dictRow = dict(row)
-        dictRow["goods"] = orjson.loads(dictRow["goods"])
-        return Jihanki.model_validate(dictRow)
+        return cls._cacheJihanki(cls._rowToJihanki(row, []))
 
     @classmethod
     async def getJihanki(
@@ -68,25 +115,27 @@ class JihankiService:
         Returns:
             Jihanki: 取得した自販機のインスタンス。
         """
-        if not isinstance(id, int):
+        if id is not None and not isinstance(id, int):
             id = int(id)
         if id and name:
             raise ValueError("IDと名前を両方指定することはできません。")
         if not name:
+            cached = cls.cache.get(id)
+            if cached:
+                return cached.model_copy(deep=True)
             row = await Database.pool.fetchrow(
-                "SELECT * FROM jihanki WHERE id = $1", id
+                f"SELECT {JIHANKI_COLUMNS}, {GOODS_SUBQUERY} AS goods FROM jihanki WHERE id = $1",
+                id,
             )
         else:
             row = await Database.pool.fetchrow(
-                "SELECT * FROM jihanki WHERE name LIKE $1 AND owner_id = $2 LIMIT 1",
+                f"SELECT {JIHANKI_COLUMNS}, {GOODS_SUBQUERY} AS goods FROM jihanki WHERE name LIKE $1 AND owner_id = $2 LIMIT 1",
                 name,
                 userId,
             )
         if not row:
             raise JihankiNotFoundException()
-        dictRow = dict(row)
-        dictRow["goods"] = orjson.loads(dictRow["goods"])
-        return Jihanki.model_validate(dictRow)
+        return cls._cacheJihanki(cls._rowToJihanki(row))
 
     @classmethod
     async def getUserJihankis(cls, userId: int) -> List[Jihanki]:
@@ -104,17 +153,12 @@ class JihankiService:
             Jihanki: 取得した自販機のインスタンス。
         """
         rows = await Database.pool.fetch(
-            "SELECT * FROM jihanki WHERE owner_id = $1",
+            f"SELECT {JIHANKI_COLUMNS}, {GOODS_SUBQUERY} AS goods FROM jihanki WHERE owner_id = $1",
             userId,
         )
         if not rows:
             raise JihankiNotFoundException()
-        jihankis = []
-        for row in rows:
-            dictRow = dict(row)
-            dictRow["goods"] = orjson.loads(dictRow["goods"])
-            jihankis.append(Jihanki.model_validate(dict(dictRow)))
-        return jihankis
+        return [cls._cacheJihanki(cls._rowToJihanki(row)) for row in rows]
 
     @classmethod
     async def deleteJihanki(cls, jihanki: Jihanki) -> None:
@@ -127,14 +171,15 @@ class JihankiService:
             "DELETE FROM jihanki WHERE id = $1",
             jihanki.id,
         )
+        cls.cache.pop(jihanki.id)
 
     @classmethod
-    async def editJihanki(cls, jihanki: Jihanki, *, editGoods: bool = False) -> Jihanki:
+    async def editJihanki(cls, jihanki: Jihanki) -> Jihanki:
         """自販機を編集します。
+        商品の編集には addGood, editGood, deleteGood を使用してください。
 
         Args:
             jihanki (Jihanki): 編集する自販機のインスタンス。
-            editGoods (bool, optional): 商品を編集するかどうか。デフォルトはNoneです。
 
         Raises:
             FailedToRequest: リクエストに失敗した場合。
@@ -142,28 +187,216 @@ class JihankiService:
         Returns:
             Jihanki: 編集後の自販機のインスタンス。
         """
-        if editGoods:
-            goods = orjson.dumps([good.model_dump() for good in jihanki.goods]).decode()
-            row = await Database.pool.fetchrow(
-                "UPDATE ONLY jihanki SET goods = $1 WHERE id = $2 RETURNING *",
-                goods,
-                jihanki.id,
-            )
-        else:
-            row = await Database.pool.fetchrow(
-                "UPDATE ONLY jihanki SET name = $1, description = $2, achievement_channel_id = $3, nsfw = $4, shuffle = $5 WHERE id = $6 RETURNING *",
-                jihanki.name,
-                jihanki.description,
-                jihanki.achievementChannelId,
-                jihanki.nsfw,
-                jihanki.shuffle,
-                jihanki.id,
-            )
+        row = await Database.pool.fetchrow(
+            f"UPDATE ONLY jihanki SET name = $1, description = $2, achievement_channel_id = $3, nsfw = $4, shuffle = $5 WHERE id = $6 RETURNING {JIHANKI_COLUMNS}",
+            jihanki.name,
+            jihanki.description,
+            jihanki.achievementChannelId,
+            jihanki.nsfw,
+            jihanki.shuffle,
+            jihanki.id,
+        )
         if not row:
             raise FailedToRequest()
-        dictRow = dict(row)
-        dictRow["goods"] = orjson.loads(dictRow["goods"])
-        return Jihanki.model_validate(dictRow)
+        return cls._cacheJihanki(
+            cls._rowToJihanki(row, [good.model_copy() for good in jihanki.goods])
+        )
+
+    @classmethod
+    async def getGoods(cls, jihankiId: int) -> List[Good]:
+        """自販機の商品を並び順で取得します。
+
+        Args:
+            jihankiId (int): 自販機のID。
+
+        Returns:
+            List[Good]: 商品のリスト。
+        """
+        rows = await Database.pool.fetch(
+            f"SELECT {GOOD_COLUMNS} FROM goods WHERE jihanki_id = $1 ORDER BY position, id",
+            jihankiId,
+        )
+        return [Good.model_validate(dict(row)) for row in rows]
+
+    @classmethod
+    async def getGood(cls, goodId: int) -> Good:
+        """商品を1件取得します。
+
+        Args:
+            goodId (int): 商品のID。
+
+        Raises:
+            GoodNotFoundException: 商品が存在しない場合。
+
+        Returns:
+            Good: 商品のインスタンス。
+        """
+        row = await Database.pool.fetchrow(
+            f"SELECT {GOOD_COLUMNS} FROM goods WHERE id = $1", goodId
+        )
+        if not row:
+            raise GoodNotFoundException()
+        return Good.model_validate(dict(row))
+
+    @classmethod
+    async def addGood(cls, jihanki: Jihanki, good: Good) -> Good:
+        """自販機の末尾に商品を追加します。
+
+        Args:
+            jihanki (Jihanki): 商品を追加する自販機のインスタンス。
+            good (Good): 追加する商品のインスタンス。
+
+        Raises:
+            FailedToRequest: リクエストに失敗した場合。
+
+        Returns:
+            Good: IDが採番された商品のインスタンス。
+        """
+        row = await Database.pool.fetchrow(
+            """
+                INSERT INTO goods (id, jihanki_id, position, name, description, price, infinite, value, emoji)
+                VALUES ($1, $2, COALESCE((SELECT MAX(position) + 1 FROM goods WHERE jihanki_id = $2), 0), $3, $4, $5, $6, $7, $8)
+                RETURNING *
+            """,
+            next(cls.goodIdGenerator),
+            jihanki.id,
+            good.name,
+            good.description,
+            good.price,
+            good.infinite,
+            good.value,
+            good.emoji,
+        )
+        if not row:
+            raise FailedToRequest()
+        good = Good.model_validate(dict(row))
+        cls._patchCachedGoods(jihanki.id, good)
+        return good
+
+    @classmethod
+    async def editGood(cls, jihanki: Jihanki, good: Good) -> Good:
+        """商品を編集します。
+
+        Args:
+            jihanki (Jihanki): 商品が属する自販機のインスタンス。
+            good (Good): 編集する商品のインスタンス。
+
+        Raises:
+            GoodNotFoundException: 商品が存在しない場合。
+
+        Returns:
+            Good: 編集後の商品のインスタンス。
+        """
+        row = await Database.pool.fetchrow(
+            f"UPDATE ONLY goods SET name = $1, description = $2, price = $3, infinite = $4, value = $5, emoji = $6 WHERE id = $7 AND jihanki_id = $8 RETURNING {GOOD_COLUMNS}",
+            good.name,
+            good.description,
+            good.price,
+            good.infinite,
+            good.value,
+            good.emoji,
+            good.id,
+            jihanki.id,
+        )
+        if not row:
+            raise GoodNotFoundException()
+        good = Good.model_validate(dict(row))
+        cls._patchCachedGoods(jihanki.id, good)
+        return good
+
+    @classmethod
+    async def deleteGood(cls, jihanki: Jihanki, good: Good) -> bool:
+        """商品を削除します。
+
+        Args:
+            jihanki (Jihanki): 商品が属する自販機のインスタンス。
+            good (Good): 削除する商品のインスタンス。
+
+        Returns:
+            bool: 商品を削除できたかどうか。すでに削除されていた場合はFalseです。
+        """
+        deleted = await Database.pool.fetchval(
+            "DELETE FROM goods WHERE id = $1 AND jihanki_id = $2 RETURNING id",
+            good.id,
+            jihanki.id,
+        )
+        cls._patchCachedGoods(jihanki.id, good, delete=True)
+        return deleted is not None
+
+    @classmethod
+    def updateCachedStock(cls, jihankiId: int, goodId: int, stock: int):
+        """キャッシュされている自販機の商品の在庫数を更新します。"""
+        cached: Optional[Jihanki] = cls.cache.pop(jihankiId)
+        if not cached:
+            return
+        good = cached.getGood(goodId)
+        if good:
+            good.stock = max(stock, 0)
+        cls.cache.set(jihankiId, cached)
+
+    @classmethod
+    async def addStock(cls, jihanki: Jihanki, good: Good, values: List[str]) -> int:
+        """商品の在庫にコードをまとめて追加します。
+
+        Args:
+            jihanki (Jihanki): 商品が属する自販機のインスタンス。
+            good (Good): 在庫を追加する商品のインスタンス。
+            values (List[str]): 暗号化済みのコードのリスト。
+
+        Returns:
+            int: 追加後の在庫数。
+        """
+        stock = await Database.pool.fetchval(
+            f"""
+                WITH inserted AS (
+                    INSERT INTO good_stock (good_id, value)
+                    SELECT $1, value FROM unnest($2::text[]) AS value
+                    RETURNING id
+                )
+                SELECT (SELECT COUNT(*) FROM good_stock WHERE good_id = $1 AND {AVAILABLE_STOCK}) + (SELECT COUNT(*) FROM inserted)
+            """,
+            good.id,
+            values,
+        )
+        good.stock = stock
+        cls.updateCachedStock(jihanki.id, good.id, stock)
+        return stock
+
+    @classmethod
+    async def dispenseStock(
+        cls,
+        jihanki: Jihanki,
+        good: Good,
+        *,
+        connection: Optional[asyncpg.Connection] = None,
+    ) -> Optional[str]:
+        """商品の在庫からコードを1つ取り出します。
+        同時に購入された場合でも、同じコードが二重に払い出されることはありません。
+        決済中のユーザーが確保している在庫は取り出されません。
+
+        Args:
+            jihanki (Jihanki): 商品が属する自販機のインスタンス。
+            good (Good): コードを取り出す商品のインスタンス。
+            connection (Optional[asyncpg.Connection], optional): トランザクション中の接続。デフォルトはNoneです。
+
+        Returns:
+            Optional[str]: 暗号化されたコード。在庫がない場合はNoneです。
+        """
+        value = await (connection or Database.pool).fetchval(
+            f"""
+                DELETE FROM good_stock WHERE id = (
+                    SELECT id FROM good_stock WHERE good_id = $1 AND {AVAILABLE_STOCK}
+                    ORDER BY id LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING value
+            """,
+            good.id,
+        )
+        if value is not None:
+            good.stock = max(good.stock - 1, 0)
+            cls.updateCachedStock(jihanki.id, good.id, good.stock)
+        return value
 
     @classmethod
     async def getJihankiList(
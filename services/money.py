@@ -4,6 +4,8 @@ import discord
 
 from objects import PaymentType
 from services.account import AccountService
+from services.executor import PurchaseExecutor
+from services.payment import PaymentService
 
 
 class PayPayAccountNotExists(Exception):
@@ -19,16 +21,22 @@ class MoneyService:
         target: Union[discord.User, discord.Member],
         to: Union[discord.User, discord.Member],
     ) -> bool:
-        if not await AccountService.paypayExists(target.id):
+        linkStatuses = await AccountService.getLinkStatuses([target.id, to.id])
+        if not linkStatuses[target.id].paypay:
             raise PayPayAccountNotExists("PayPayアカウントをリンクしてください")
-        if not await AccountService.paypayExists(to.id):
+        if not linkStatuses[to.id].paypay:
             raise PayPayAccountNotExists(
                 "送金先ユーザーにPayPayアカウントをリンクするようにお願いしてください"
             )
-        targetPayPayAccount = await AccountService.loginPayPay(target.id)
-        toPayPayExternalId = await AccountService.loginPayPay(to.id)
+        toPayPayExternalId = linkStatuses[to.id].paypayExternalUserId
 
-        await targetPayPayAccount.send_money(amount, toPayPayExternalId)
+        # 送金は再試行しないので、先に残高を確認してセッションが有効なことを確かめておく
+        await AccountService.usePayPay(target.id, lambda paypay: paypay.get_balance())
+        await AccountService.usePayPay(
+            target.id,
+            lambda paypay: paypay.send_money(amount, toPayPayExternalId),
+            retry=False,
+        )
         return True
 
     @classmethod
@@ -45,12 +53,10 @@ class MoneyService:
             raise PayPayAccountNotExists(
                 "送金先ユーザーにPayPayアカウントをリンクするようにお願いしてください"
             )
-        targetKyashAccount = await AccountService.loginKyash(target.id)
-        toKyashAccount = await AccountService.loginKyash(to.id)
 
-        await targetKyashAccount.create_link(amount)
-        url = targetKyashAccount.created_link
-        await toKyashAccount.link_recieve(url)
+        await PaymentService.transferWithKyash(
+            amount=amount, payerId=target.id, receiverId=to.id
+        )
         return True
 
     @classmethod
@@ -65,12 +71,16 @@ class MoneyService:
         if amount <= 0:
             raise ValueError("amountは1以上でなければなりません")
 
-        match (type):
-            case PaymentType.PAYPAY:
-                return await cls.sendMoneyWithPayPay(
-                    amount=amount, target=target, to=to
-                )
-            case PaymentType.KYASH:
-                return await cls.sendMoneyWithKyash(amount=amount, target=target, to=to)
-            case _:
-                raise ValueError("PaymentTypeが無効です")
+        # 購入の決済と同じく、同じユーザーが関わる送金は1つずつ実行する
+        async with PurchaseExecutor.slot(target.id, to.id):
+            match (type):
+                case PaymentType.PAYPAY:
+                    return await cls.sendMoneyWithPayPay(
+                        amount=amount, target=target, to=to
+                    )
+                case PaymentType.KYASH:
+                    return await cls.sendMoneyWithKyash(
+                        amount=amount, target=target, to=to
+                    )
+                case _:
+                    raise ValueError("PaymentTypeが無効です")
@@ -0,0 +1,72 @@
+from typing import List, Tuple
+
+from .cache import TTLCache
+from .database import Database
+
+
+class PanelService:
+    """自販機パネルが送信されたメッセージを管理するサービス"""
+
+    # 自販機IDごとの、パネルの(チャンネルID, メッセージID)のリスト
+    cache: TTLCache[int, List[Tuple[int, int]]] = TTLCache(maxsize=1024, ttl=600)
+    # 登録済みのメッセージID。操作のたびに書き込まないようにするためのもの
+    registered: TTLCache[int, bool] = TTLCache(maxsize=8192, ttl=3600)
+
+    @classmethod
+    async def register(cls, jihankiId: int, channelId: int, messageId: int) -> None:
+        """パネルを登録します。すでに登録されている場合は何もしません。
+
+        Args:
+            jihankiId (int): 自販機のID。
+            channelId (int): パネルのチャンネルID。
+            messageId (int): パネルのメッセージID。
+        """
+        if messageId in cls.registered:
+            return
+        await Database.pool.execute(
+            """
+                INSERT INTO panel_messages (message_id, channel_id, jihanki_id) VALUES ($1, $2, $3)
+                ON CONFLICT (message_id) DO UPDATE SET channel_id = EXCLUDED.channel_id, jihanki_id = EXCLUDED.jihanki_id
+            """,
+            messageId,
+            channelId,
+            jihankiId,
+        )
+        cls.registered.set(messageId, True)
+        cls.cache.pop(jihankiId)
+
+    @classmethod
+    async def getPanels(cls, jihankiId: int) -> List[Tuple[int, int]]:
+        """自販機のパネルの一覧を取得します。
+
+        Args:
+            jihankiId (int): 自販機のID。
+
+        Returns:
+            List[Tuple[int, int]]: パネルの(チャンネルID, メッセージID)のリスト。
+        """
+        panels = cls.cache.get(jihankiId)
+        if panels is not None:
+            return panels
+        rows = await Database.pool.fetch(
+            "SELECT channel_id, message_id FROM panel_messages WHERE jihanki_id = $1",
+            jihankiId,
+        )
+        panels = [(row["channel_id"], row["message_id"]) for row in rows]
+        cls.cache.set(jihankiId, panels)
+        return panels
+
+    @classmethod
+    async def remove(cls, messageId: int) -> None:
+        """削除されたメッセージなど、もう使えないパネルの登録を解除します。
+
+        Args:
+            messageId (int): パネルのメッセージID。
+        """
+        jihankiId = await Database.pool.fetchval(
+            "DELETE FROM panel_messages WHERE message_id = $1 RETURNING jihanki_id",
+            messageId,
+        )
+        cls.registered.pop(messageId)
+        if jihankiId is not None:
+            cls.cache.pop(jihankiId)
@@ -1,6 +1,10 @@
+import traceback
+
 import discord
+from aiokyasher import Kyash
 
-from .account import AccountService
+from .account import AccountService, PaymentStatusUnknown
+from .executor import PurchaseExecutor
 
 
 class AccountNotLinked(Exception):
@@ -20,64 +24,129 @@ class PaymentService:
     async def payWithPayPay(
         self, *, amount: int, buyer: discord.Member, seller: discord.Member
     ):
-        if (not await AccountService.paypayExists(buyer.id)) or (
-            not await AccountService.paypayExists(seller.id)
-        ):
-            raise AccountNotLinked()
-
-        buyerPayPayAccount = await AccountService.loginPayPay(buyer.id)
-
-        balance = await buyerPayPayAccount.get_balance()
-        if (int(balance.money) + int(balance.money_light)) < amount:
-            raise MoneyNotEnough()
-
-        await buyerPayPayAccount.send_money(
-            amount, AccountService.paypayExternalUserIds[seller.id]
-        )
+        async with PurchaseExecutor.slot(seller.id, buyer.id):
+            linkStatuses = await AccountService.getLinkStatuses([buyer.id, seller.id])
+            if (not linkStatuses[buyer.id].paypay) or (
+                not linkStatuses[seller.id].paypay
+            ):
+                raise AccountNotLinked()
+
+            balance = await AccountService.usePayPay(
+                buyer.id, lambda paypay: paypay.get_balance()
+            )
+            if (int(balance.money) + int(balance.money_light)) < amount:
+                raise MoneyNotEnough()
+
+            # 残高の確認でセッションが有効なことはわかっているので、送金は再試行しない
+            await AccountService.usePayPay(
+                buyer.id,
+                lambda paypay: paypay.send_money(
+                    amount, linkStatuses[seller.id].paypayExternalUserId
+                ),
+                retry=False,
+            )
 
     @classmethod
     async def receivePayPayUrl(
         self, *, url: str, amount: int, seller: discord.Member, passcode: str = None
     ):
-        if not await AccountService.paypayWebAPIExists(seller.id):
-            raise AccountNotLinked()
-
-        sellerPayPayAccount = await AccountService.loginPayPayWebAPI(seller.id)
-        linkInfo = await sellerPayPayAccount.link_check(url)
-        if int(linkInfo.amount) < amount:
-            raise MoneyNotEnough()
-
-        await sellerPayPayAccount.link_receive(url, passcode)
+        async with PurchaseExecutor.slot(seller.id):
+            if not await AccountService.paypayWebAPIExists(seller.id):
+                raise AccountNotLinked()
+
+            linkInfo = await AccountService.usePayPayWebAPI(
+                seller.id, lambda paypay: paypay.link_check(url)
+            )
+            if int(linkInfo.amount) < amount:
+                raise MoneyNotEnough()
+
+            await AccountService.usePayPayWebAPI(
+                seller.id,
+                lambda paypay: paypay.link_receive(url, passcode),
+                retry=False,
+            )
 
     @classmethod
     async def payWithKyash(
         self, *, amount: int, buyer: discord.Member, seller: discord.Member
     ):
-        if (not await AccountService.kyashExists(buyer.id)) or (
-            not await AccountService.kyashExists(seller.id)
-        ):
-            raise AccountNotLinked()
+        async with PurchaseExecutor.slot(seller.id, buyer.id):
+            linkStatuses = await AccountService.getLinkStatuses([buyer.id, seller.id])
+            if (not linkStatuses[buyer.id].kyash) or (
+                not linkStatuses[seller.id].kyash
+            ):
+                raise AccountNotLinked()
 
-        buyerKyashAccount = await AccountService.loginKyash(buyer.id)
+            async def getBalance(kyash: Kyash) -> int:
+                await kyash.get_wallet()
+                return int(kyash.money) + int(kyash.value)
 
-        await buyerKyashAccount.get_wallet()
-        if (int(buyerKyashAccount.money) + int(buyerKyashAccount.value)) < amount:
-            raise MoneyNotEnough()
+            if await AccountService.useKyash(buyer.id, getBalance) < amount:
+                raise MoneyNotEnough()
 
-        await buyerKyashAccount.create_link(amount)
-        remittanceUrl = buyerKyashAccount.created_link
+            await self.transferWithKyash(
+                amount=amount, payerId=buyer.id, receiverId=seller.id
+            )
 
-        sellerKyashAccount = await AccountService.loginKyash(seller.id)
-        await sellerKyashAccount.link_recieve(remittanceUrl)
+    @classmethod
+    async def transferWithKyash(self, *, amount: int, payerId: int, receiverId: int):
+        """Kyashの送金リンクを作り、相手に受け取らせます。
+        リンクを作った時点で支払う側のお金は動くので、受け取る側のセッションは先に確かめておきます。
+        受け取れなかった場合はリンクを取り消し、取り消せなかった場合はPaymentStatusUnknownを送出します。
+
+        Args:
+            amount (int): 金額。
+            payerId (int): 支払うユーザーのID。
+            receiverId (int): 受け取るユーザーのID。
+        """
+        # get_walletは何度実行しても問題ないので、期限切れならここでログインし直せる
+        await AccountService.useKyash(receiverId, lambda kyash: kyash.get_wallet())
+
+        async def createLink(kyash: Kyash) -> str:
+            await kyash.create_link(amount)
+            return kyash.created_link
+
+        # ログインし直した場合は別のクライアントになるので、リンクは処理の中で取り出す
+        remittanceUrl = await AccountService.useKyash(payerId, createLink, retry=False)
+
+        try:
+            await AccountService.useKyash(
+                receiverId,
+                lambda kyash: kyash.link_recieve(remittanceUrl),
+                retry=False,
+            )
+        except PaymentStatusUnknown:
+            # 受け取られたかどうかわからないので、取り消さずに運営の確認を待つ
+            raise
+        except Exception as e:
+            try:
+                await AccountService.useKyash(
+                    payerId,
+                    lambda kyash: kyash.link_cancel(remittanceUrl),
+                    retry=False,
+                )
+            except Exception:
+                traceback.print_exc()
+                raise PaymentStatusUnknown("kyash") from e
+            raise
 
     @classmethod
     async def receiveKyashUrl(self, *, url: str, amount: int, seller: discord.Member):
-        if not await AccountService.kyashExists(seller.id):
-            raise AccountNotLinked()
-
-        sellerKyashAccount = await AccountService.loginKyash(seller.id)
-        await sellerKyashAccount.link_check(url)
-        if int(sellerKyashAccount.link_amount) < amount:
-            raise MoneyNotEnough()
-
-        await sellerKyashAccount.link_recieve(url, sellerKyashAccount.link_uuid)
+        async with PurchaseExecutor.slot(seller.id):
+            if not await AccountService.kyashExists(seller.id):
+                raise AccountNotLinked()
+
+            async def linkCheck(kyash: Kyash) -> tuple[int, str]:
+                await kyash.link_check(url)
+                return int(kyash.link_amount), kyash.link_uuid
+
+            # クライアントはほかの決済と共有しているので、結果は処理の中で取り出す
+            linkAmount, linkUuid = await AccountService.useKyash(seller.id, linkCheck)
+            if linkAmount < amount:
+                raise MoneyNotEnough()
+
+            await AccountService.useKyash(
+                seller.id,
+                lambda kyash: kyash.link_recieve(url, linkUuid),
+                retry=False,
+            )
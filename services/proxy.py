@@ -0,0 +1,154 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+from urllib.parse import urlsplit
+
+import dotenv
+import httpx
+
+from .database import Database
+from .transport import TransportPool
+
+dotenv.load_dotenv()
+
+
+@dataclass
+class ProxyHealth:
+    """プロキシの状態。遅延とエラー率は指数移動平均です。"""
+
+    latency: Optional[float] = None
+    errorRate: float = 0.0
+    failures: int = 0
+    checks: int = 0
+    checkedAt: Optional[float] = None
+
+    @property
+    def healthy(self) -> bool:
+        """3回続けて失敗していなければTrueです。"""
+        return self.failures < 3
+
+
+class ProxyHealthService:
+    """プロキシに定期的に接続して、遅延とエラー率を記録するサービス"""
+
+    alpha = 0.3
+    timeout = 10.0
+    probeUrl = os.getenv("proxy_probe_url", "https://www.paypay.ne.jp/")
+    # ユーザーのプロキシが落ちているときに代わりに使うプロキシ。
+    # ユーザーが設定したプロキシをほかのユーザーに使わせることはしない。
+    fallbackProxies = [
+        proxy
+        for proxy in [os.getenv("default_proxy")]
+        + os.getenv("fallback_proxies", "").split(",")
+        if proxy
+    ]
+    health: Dict[Optional[str], ProxyHealth] = {}
+
+    @staticmethod
+    def mask(proxy: Optional[str]) -> str:
+        """プロキシのURLから認証情報を取り除きます。"""
+        if not proxy:
+            return "(なし)"
+        url = urlsplit(TransportPool.normalizeProxy(proxy))
+        return f"{url.scheme}://{url.hostname}" + (f":{url.port}" if url.port else "")
+
+    @classmethod
+    async def probe(cls, proxy: Optional[str]) -> bool:
+        """プロキシに接続できるか確認し、結果を記録します。
+        ステータスコードに関係なく、応答が返ってくれば成功とみなします。
+        URLとして正しくないプロキシの場合は、例外を送出せずにFalseを返します。
+
+        Args:
+            proxy (Optional[str]): プロキシのURL。
+
+        Returns:
+            bool: 接続できたかどうか。
+        """
+        health = cls.health.setdefault(proxy, ProxyHealth())
+        start = time.monotonic()
+        try:
+            # ユーザーが入力したプロキシも確認するので、共有のプールには入れず使い捨ての接続で確認する
+            async with httpx.AsyncClient(
+                proxy=TransportPool.normalizeProxy(proxy),
+                timeout=cls.timeout,
+                verify=TransportPool.sslContext,
+            ) as client:
+                await client.head(cls.probeUrl)
+            ok = True
+        except (httpx.HTTPError, httpx.InvalidURL, ValueError, OSError):
+            # 不正なURLのプロキシは、接続できなかったものとして扱う
+            ok = False
+        latency = time.monotonic() - start
+
+        health.checks += 1
+        health.checkedAt = time.time()
+        health.errorRate = cls.alpha * (not ok) + (1 - cls.alpha) * health.errorRate
+        if ok:
+            health.failures = 0
+            health.latency = (
+                latency
+                if health.latency is None
+                else cls.alpha * latency + (1 - cls.alpha) * health.latency
+            )
+        else:
+            health.failures += 1
+        return ok
+
+    @classmethod
+    async def probeAll(
+        cls, proxies: Optional[Iterable[Optional[str]]] = None, *, concurrency: int = 8
+    ) -> Dict[Optional[str], ProxyHealth]:
+        """プロキシをまとめて確認します。
+
+        Args:
+            proxies (Optional[Iterable[Optional[str]]], optional): 確認するプロキシ。
+                省略した場合は、リンクされたアカウントで使われているものと代わりのプロキシをすべて確認します。
+            concurrency (int, optional): 同時に確認する最大数。デフォルトは8です。
+
+        Returns:
+            Dict[Optional[str], ProxyHealth]: プロキシごとの状態。
+        """
+        if proxies is None:
+            rows = await Database.pool.fetch(
+                "SELECT proxy FROM paypay UNION SELECT proxy FROM kyash"
+            )
+            proxies = [row["proxy"] for row in rows] + cls.fallbackProxies
+        proxies = list(dict.fromkeys(proxies))
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def probe(proxy: Optional[str]):
+            async with semaphore:
+                await cls.probe(proxy)
+
+        await asyncio.gather(*(probe(proxy) for proxy in proxies))
+        # 使われなくなったプロキシの記録は捨てる
+        for proxy in list(cls.health):
+            if proxy not in proxies:
+                del cls.health[proxy]
+        return {proxy: cls.health[proxy] for proxy in proxies}
+
+    @classmethod
+    def select(cls, proxy: Optional[str]) -> Optional[str]:
+        """実際に使うプロキシを選びます。
+        指定されたプロキシが落ちている場合は、代わりのプロキシのうち一番速いものを返します。
+
+        Args:
+            proxy (Optional[str]): ユーザーが設定したプロキシ。
+
+        Returns:
+            Optional[str]: 使うプロキシ。
+        """
+        health = cls.health.get(proxy)
+        if health is None or health.healthy:
+            return proxy
+        candidates = [
+            (cls.health[fallback].latency or cls.timeout, fallback)
+            for fallback in cls.fallbackProxies
+            if fallback in cls.health and cls.health[fallback].healthy
+        ]
+        if not candidates:
+            return proxy
+        return min(candidates)[1]
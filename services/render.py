@@ -0,0 +1,161 @@
+import asyncio
+import os
+import time
+import traceback
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import discord
+import dotenv
+
+dotenv.load_dotenv()
+
+Render = Callable[[], Awaitable[None]]
+
+
+class RenderScheduler:
+    """パネルの再描画をメッセージごとにまとめて実行する仕組み
+    短い間に何度も再描画が頼まれた場合は、最後に頼まれたものだけを1回だけ実行します。
+    同じチャンネルのメッセージの編集は一定の間隔を空けて行い、Discordのレートリミットに引っかからないようにします。"""
+
+    # 再描画を頼まれてから、ほかの依頼が来ないか待つ時間(秒)
+    debounce = float(os.getenv("render_debounce", 1))
+    # 同じチャンネルでメッセージを編集する最短の間隔(秒)
+    channelInterval = float(os.getenv("render_channel_interval", 1))
+    # 全体で同時に行う編集の数。多くのパネルを一度に再描画するときに、グローバルなレートリミットを超えないようにする
+    semaphore = asyncio.Semaphore(int(os.getenv("render_concurrency", 8)))
+
+    pending: Dict[int, Render] = {}
+    waiters: Dict[int, List[asyncio.Future]] = {}
+    workers: Dict[int, asyncio.Task] = {}
+    channelLocks: Dict[int, asyncio.Lock] = {}
+    # チャンネルごとの、ロックを使っている処理の数
+    channelUsers: Dict[int, int] = {}
+    lastEdits: Dict[int, float] = {}
+
+    requested = 0
+    merged = 0
+    rendered = 0
+    skipped = 0
+    rateLimited = 0
+
+    @classmethod
+    def schedule(
+        cls,
+        channelId: int,
+        messageId: int,
+        render: Render,
+        *,
+        delay: Optional[float] = None,
+    ) -> asyncio.Future:
+        """メッセージの再描画を予約します。
+        まだ実行されていない再描画がある場合は、新しいものに置き換えます。
+
+        Args:
+            channelId (int): メッセージのチャンネルID。
+            messageId (int): 再描画するメッセージのID。
+            render (Render): 再描画を行う関数。
+            delay (Optional[float], optional): ほかの依頼を待つ時間(秒)。デフォルトはNoneで、`debounce`を使います。
+
+        Returns:
+            asyncio.Future: この依頼を含む再描画が終わったときに完了するFuture。
+                描画に失敗した場合は、その例外が送出されます。
+        """
+        cls.requested += 1
+        if messageId in cls.pending:
+            cls.merged += 1
+        cls.pending[messageId] = render
+
+        future = asyncio.get_running_loop().create_future()
+        # 結果を待たない呼び出し元のために、失敗しても警告が出ないようにしておく
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        cls.waiters.setdefault(messageId, []).append(future)
+
+        if messageId not in cls.workers:
+            cls.workers[messageId] = asyncio.create_task(
+                cls._work(
+                    channelId, messageId, cls.debounce if delay is None else delay
+                )
+            )
+        return future
+
+    @classmethod
+    async def _work(cls, channelId: int, messageId: int, delay: float) -> None:
+        try:
+            await asyncio.sleep(delay)
+            while messageId in cls.pending:
+                lock = cls.channelLocks.setdefault(channelId, asyncio.Lock())
+                cls.channelUsers[channelId] = cls.channelUsers.get(channelId, 0) + 1
+                try:
+                    await cls._render(lock, channelId, messageId)
+                finally:
+                    cls.channelUsers[channelId] -= 1
+                    if cls.channelUsers[channelId] <= 0:
+                        del cls.channelUsers[channelId]
+                        del cls.channelLocks[channelId]
+        finally:
+            cls.workers.pop(messageId, None)
+            for future in cls.waiters.pop(messageId, []):
+                if not future.done():
+                    future.cancel()
+            cls.pending.pop(messageId, None)
+            if len(cls.lastEdits) > 1024:
+                now = time.monotonic()
+                cls.lastEdits = {
+                    key: value
+                    for key, value in cls.lastEdits.items()
+                    if now - value < cls.channelInterval
+                }
+
+    @classmethod
+    async def _render(cls, lock: asyncio.Lock, channelId: int, messageId: int) -> None:
+        async with lock:
+            wait = cls.lastEdits.get(channelId, 0) + cls.channelInterval
+            wait -= time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            # 待っている間に届いた依頼もまとめて、最新のものだけを描画する
+            render = cls.pending.pop(messageId)
+            waiters = cls.waiters.pop(messageId, [])
+            error: Optional[BaseException] = None
+            try:
+                async with cls.semaphore:
+                    await render()
+                cls.rendered += 1
+            except discord.RateLimited as e:
+                # Botのmax_ratelimit_timeoutより長く待たされる場合に送出される
+                cls.rateLimited += 1
+                # 新しい依頼が来ていなければ、待ってからもう一度描画する
+                cls.pending.setdefault(messageId, render)
+                cls.waiters.setdefault(messageId, []).extend(waiters)
+                waiters = []
+                await asyncio.sleep(e.retry_after)
+            except (discord.NotFound, discord.Forbidden) as e:
+                # メッセージが消されたか、編集できなくなった
+                cls.skipped += 1
+                error = e
+            except Exception as e:
+                cls.skipped += 1
+                error = e
+                traceback.print_exc()
+            finally:
+                cls.lastEdits[channelId] = time.monotonic()
+                # 描画を待っている呼び出し元には、失敗したことを伝える
+                for future in waiters:
+                    if not future.done():
+                        if error is None:
+                            future.set_result(None)
+                        else:
+                            future.set_exception(error)
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        """再描画の統計情報を返します。"""
+        return {
+            "pending": len(cls.pending),
+            "requested": cls.requested,
+            "rendered": cls.rendered,
+            "merged": cls.merged,
+            "skipped": cls.skipped,
+            "rateLimited": cls.rateLimited,
+        }
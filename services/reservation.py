@@ -0,0 +1,190 @@
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+
+from objects import Good, Jihanki, Reservation
+
+from .database import Database
+from .jihanki import AVAILABLE_STOCK, JihankiService
+
+
+class ReservationService:
+    """決済が終わるまでの間、在庫を確保しておくサービス"""
+
+    # 決済画面のタイムアウト(5分)に、モーダルの送信が間に合うよう少し余裕をもたせる
+    ttl = timedelta(seconds=330)
+    reservations: Dict[int, Reservation] = {}
+    # 選択や決済のたびに探すので、(ユーザーID, 商品ID)からも引けるようにしておく
+    userReservations: Dict[Tuple[int, int], Reservation] = {}
+
+    @classmethod
+    def find(cls, userId: int, goodId: int) -> Optional[Reservation]:
+        """ユーザーが商品の在庫を確保しているかどうかを調べます。
+
+        Args:
+            userId (int): ユーザーのID。
+            goodId (int): 商品のID。
+
+        Returns:
+            Optional[Reservation]: 確保している在庫。確保していない場合はNoneです。
+        """
+        return cls.userReservations.get((userId, goodId))
+
+    @classmethod
+    def _remember(cls, reservation: Reservation) -> None:
+        # 期限の切れた確保の在庫を、ほかのユーザーが確保し直した場合
+        cls._forget(reservation.id)
+        cls.reservations[reservation.id] = reservation
+        cls.userReservations[(reservation.userId, reservation.goodId)] = reservation
+
+    @classmethod
+    def _forget(cls, reservationId: int) -> Optional[Reservation]:
+        reservation = cls.reservations.pop(reservationId, None)
+        if reservation:
+            key = (reservation.userId, reservation.goodId)
+            if cls.userReservations.get(key) is reservation:
+                del cls.userReservations[key]
+        return reservation
+
+    @classmethod
+    async def reserve(
+        cls,
+        jihanki: Jihanki,
+        good: Good,
+        userId: int,
+        *,
+        channelId: Optional[int] = None,
+        messageId: Optional[int] = None,
+    ) -> Optional[Reservation]:
+        """在庫を1つ確保します。
+        同じユーザーが同じ商品をすでに確保している場合は、その確保を延長します。
+
+        Args:
+            jihanki (Jihanki): 商品が属する自販機のインスタンス。
+            good (Good): 確保する商品のインスタンス。
+            userId (int): 購入しようとしているユーザーのID。
+            channelId (Optional[int], optional): 自販機パネルのチャンネルID。デフォルトはNoneです。
+            messageId (Optional[int], optional): 自販機パネルのメッセージID。デフォルトはNoneです。
+
+        Returns:
+            Optional[Reservation]: 確保した在庫。在庫がない場合はNoneです。
+        """
+        row = await Database.pool.fetchrow(
+            f"""
+                WITH reserved AS (
+                    UPDATE good_stock SET reserved_by = $2, reserved_until = now() + $3::interval
+                    WHERE id = (
+                        SELECT id FROM good_stock
+                        WHERE good_id = $1 AND ({AVAILABLE_STOCK} OR reserved_by = $2)
+                        ORDER BY reserved_by IS NOT DISTINCT FROM $2 DESC, id
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, reserved_until
+                )
+                SELECT
+                    reserved.id,
+                    reserved.reserved_until,
+                    (
+                        SELECT COUNT(*) FROM good_stock
+                        WHERE good_id = $1 AND id <> reserved.id AND {AVAILABLE_STOCK}
+                    ) AS stock
+                FROM reserved
+            """,
+            good.id,
+            userId,
+            cls.ttl,
+        )
+        if not row:
+            return None
+
+        existing = cls.find(userId, good.id)
+        if existing:
+            cls._forget(existing.id)
+        reservation = Reservation(
+            id=row["id"],
+            jihankiId=jihanki.id,
+            goodId=good.id,
+            userId=userId,
+            expiresAt=row["reserved_until"],
+            channelId=channelId,
+            messageId=messageId,
+        )
+        if existing and existing.id == reservation.id:
+            # 確保を延長しただけなので、同じ購入として扱う
+            reservation.token = existing.token
+        cls._remember(reservation)
+
+        good.stock = row["stock"]
+        JihankiService.updateCachedStock(jihanki.id, good.id, row["stock"])
+        return reservation
+
+    @classmethod
+    async def commit(
+        cls,
+        jihanki: Jihanki,
+        good: Good,
+        reservation: Reservation,
+        *,
+        connection: Optional[asyncpg.Connection] = None,
+    ) -> Optional[str]:
+        """確保していた在庫を販売済みにし、コードを取り出します。
+        決済の後に呼ばれるので、期限切れなどで確保が失われていた場合は、ほかの在庫を取り出さずにNoneを返します。
+
+        Args:
+            jihanki (Jihanki): 商品が属する自販機のインスタンス。
+            good (Good): 購入された商品のインスタンス。
+            reservation (Reservation): 確保した在庫。
+            connection (Optional[asyncpg.Connection], optional): トランザクション中の接続。デフォルトはNoneです。
+
+        Returns:
+            Optional[str]: 暗号化されたコード。確保が失われていた場合はNoneです。
+        """
+        cls._forget(reservation.id)
+        return await (connection or Database.pool).fetchval(
+            "DELETE FROM good_stock WHERE id = $1 AND reserved_by = $2 RETURNING value",
+            reservation.id,
+            reservation.userId,
+        )
+
+    @classmethod
+    async def release(cls, reservation: Reservation) -> None:
+        """確保していた在庫を解放します。
+
+        Args:
+            reservation (Reservation): 解放する在庫。
+        """
+        cls._forget(reservation.id)
+        await Database.pool.execute(
+            "UPDATE good_stock SET reserved_by = NULL, reserved_until = NULL WHERE id = $1 AND reserved_by = $2",
+            reservation.id,
+            reservation.userId,
+        )
+        JihankiService.cache.pop(reservation.jihankiId)
+
+    @classmethod
+    async def releaseExpired(cls) -> Dict[int, List[Reservation]]:
+        """期限切れの確保をまとめて解放します。
+
+        Returns:
+            Dict[int, List[Reservation]]: 自販機IDごとの解放された確保。
+                再起動前の確保など、パネルの場所がわからないものは空のリストになります。
+        """
+        rows = await Database.pool.fetch("""
+                UPDATE good_stock SET reserved_by = NULL, reserved_until = NULL
+                FROM goods
+                WHERE goods.id = good_stock.good_id
+                    AND good_stock.reserved_until IS NOT NULL
+                    AND good_stock.reserved_until < now()
+                RETURNING good_stock.id, goods.jihanki_id
+            """)
+        released: Dict[int, List[Reservation]] = {}
+        for row in rows:
+            reservations = released.setdefault(row["jihanki_id"], [])
+            reservation = cls._forget(row["id"])
+            if reservation:
+                reservations.append(reservation)
+        for jihankiId in released:
+            JihankiService.cache.pop(jihankiId)
+        return released
@@ -0,0 +1,114 @@
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import discord
+
+Handler = Callable[[discord.Interaction, list[str]], Awaitable[None]]
+
+
+@dataclass
+class RouteStats:
+    """ルートごとの統計情報"""
+
+    calls: int = 0
+    errors: int = 0
+    totalTime: float = 0.0
+    maxTime: float = 0.0
+
+
+class InteractionRouter:
+    """コンポーネントのインタラクションを、custom_idの先頭の値で各コグの処理に振り分ける仕組み
+    custom_idは `種類,値1,値2,...` の形式で、ルートは(コンポーネントの種類, 種類)の組で登録します。
+    振り分けは辞書を1回引くだけなので、ルートやコグが増えても遅くなりません。"""
+
+    routes: Dict[Tuple[int, str], Handler] = {}
+    routeStats: Dict[Tuple[int, str], RouteStats] = {}
+    unrouted = 0
+
+    @classmethod
+    def register(
+        cls, componentType: discord.ComponentType, prefix: str, handler: Handler
+    ) -> None:
+        """ルートを登録します。
+
+        Args:
+            componentType (discord.ComponentType): ボタンや選択メニューなどのコンポーネントの種類。
+            prefix (str): custom_idの先頭の値。
+            handler (Handler): インタラクションと、custom_idをカンマで区切ったリストを受け取る関数。
+        """
+        key = (componentType.value, prefix)
+        cls.routes[key] = handler
+        cls.routeStats.setdefault(key, RouteStats())
+
+    @classmethod
+    def unregister(cls, componentType: discord.ComponentType, prefix: str) -> None:
+        """ルートの登録を解除します。"""
+        cls.routes.pop((componentType.value, prefix), None)
+
+    @classmethod
+    def resolve(
+        cls, interaction: discord.Interaction
+    ) -> Optional[Tuple[Tuple[int, str], Handler, list[str]]]:
+        """インタラクションを処理するルートを探します。
+
+        Returns:
+            Optional[Tuple[Tuple[int, str], Handler, list[str]]]: ルートのキー、処理する関数、custom_idを区切ったリスト。見つからない場合はNoneです。
+        """
+        if interaction.type != discord.InteractionType.component:
+            return None
+        data = interaction.data or {}
+        customId = data.get("custom_id")
+        if not customId:
+            return None
+        customFields = customId.split(",")
+        key = (data.get("component_type"), customFields[0])
+        handler = cls.routes.get(key)
+        if handler is None:
+            return None
+        return key, handler, customFields
+
+    @classmethod
+    async def dispatch(cls, interaction: discord.Interaction) -> bool:
+        """インタラクションを登録されたルートに振り分けます。
+
+        Args:
+            interaction (discord.Interaction): 受け取ったインタラクション。
+
+        Returns:
+            bool: 処理するルートがあったかどうか。
+        """
+        route = cls.resolve(interaction)
+        if route is None:
+            cls.unrouted += 1
+            return False
+
+        key, handler, customFields = route
+        stats = cls.routeStats[key]
+        stats.calls += 1
+        start = time.perf_counter()
+        try:
+            await handler(interaction, customFields)
+        except:
+            stats.errors += 1
+            traceback.print_exc()
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.totalTime += elapsed
+            stats.maxTime = max(stats.maxTime, elapsed)
+        return True
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        """ルートごとの呼び出し回数、エラー数、平均・最大の処理時間(秒)を返します。"""
+        result: dict[str, int | float] = {"unrouted": cls.unrouted}
+        for (componentType, prefix), stats in cls.routeStats.items():
+            name = f"{discord.ComponentType(componentType).name}:{prefix}"
+            result[f"{name}.calls"] = stats.calls
+            result[f"{name}.errors"] = stats.errors
+            result[f"{name}.avg"] = (
+                stats.totalTime / stats.calls if stats.calls else 0.0
+            )
+            result[f"{name}.max"] = stats.maxTime
+        return result
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """同じキーの処理が同時に呼ばれた場合、1回だけ実行して結果を共有する"""
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future[T]] = {}
+        # 実行中の処理が終わるのを待っている、新しく実行する処理
+        self.pending: Dict[Hashable, asyncio.Future[T]] = {}
+
+    async def do(
+        self, key: Hashable, func: Callable[[], Awaitable[T]], *, fresh: bool = False
+    ) -> T:
+        """キーに対応する処理を実行します。
+        すでに実行中の場合は、新たに実行せずにその結果を待ちます。
+
+        Args:
+            key (Hashable): 処理を識別するキー。
+            func (Callable[[], Awaitable[T]]): 実行する処理。
+            fresh (bool, optional): 実行中の処理の結果を使わず、それが終わってから新しく実行するかどうか。
+                同時に呼ばれたfreshな呼び出しは、1回の実行にまとめます。デフォルトはFalseです。
+
+        Returns:
+            T: 処理の結果。
+        """
+        if fresh:
+            future = self.pending.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self._doAfterCurrent(key, func))
+                self.pending[key] = future
+            return await asyncio.shield(future)
+
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.calls[key] = future
+
+            def done(_):
+                if self.calls.get(key) is future:
+                    del self.calls[key]
+
+            future.add_done_callback(done)
+        # 待っている呼び出し元がキャンセルされても、ほかの呼び出し元の処理は止めない
+        return await asyncio.shield(future)
+
+    async def _doAfterCurrent(
+        self, key: Hashable, func: Callable[[], Awaitable[T]]
+    ) -> T:
+        # 実行中の処理は、呼び出される前の状態をもとにしているかもしれないので、結果を使わない
+        while (current := self.calls.get(key)) is not None:
+            await asyncio.wait([current])
+        # ここからは、後から来たfreshな呼び出しを次の実行にまとめる
+        del self.pending[key]
+        return await self.do(key, func)
+
+    def __len__(self) -> int:
+        return len(self.calls)
@@ -0,0 +1,176 @@
+import asyncio
+import os
+import traceback
+import weakref
+from typing import Any, Dict, Optional, TypeVar
+
+import aiohttp
+import dotenv
+import httpx
+
+dotenv.load_dotenv()
+
+T = TypeVar("T")
+
+
+class TransportPool:
+    """決済サービスのクライアントが使うHTTP接続を、プロキシごとに共有するプール
+    同じプロキシ(またはプロキシ無し)を使うユーザー同士で、keep-aliveの接続とTLSセッションを使い回します。"""
+
+    limits = httpx.Limits(
+        max_connections=int(os.getenv("proxy_max_connections", 50)),
+        max_keepalive_connections=int(os.getenv("proxy_max_keepalive_connections", 20)),
+        keepalive_expiry=60,
+    )
+    # すべてのトランスポートで同じSSLContextを使うと、TLSセッションが再利用される
+    sslContext = httpx.create_ssl_context()
+    transports: Dict[Optional[str], httpx.AsyncHTTPTransport] = {}
+    connectors: Dict[Optional[str], aiohttp.TCPConnector] = {}
+    pooledClients: weakref.WeakSet[httpx.AsyncClient] = weakref.WeakSet()
+
+    @staticmethod
+    def normalizeProxy(proxy: Optional[str]) -> Optional[str]:
+        """スキームのないプロキシ(`host:port`など)に、決済サービスのライブラリと同じく`http://`を付けます。
+        以前に保存されたプロキシはスキームがないことがあり、そのままではhttpxが受け付けません。
+
+        Args:
+            proxy (Optional[str]): プロキシのURL。
+
+        Returns:
+            Optional[str]: スキームの付いたプロキシのURL。
+        """
+        if proxy and "://" not in proxy:
+            return "http://" + proxy
+        return proxy
+
+    @classmethod
+    def getTransport(cls, proxy: Optional[str]) -> httpx.AsyncHTTPTransport:
+        """プロキシに対応するhttpxのトランスポートを取得します。
+
+        Args:
+            proxy (Optional[str]): プロキシのURL。
+
+        Returns:
+            httpx.AsyncHTTPTransport: 共有されたトランスポート。
+        """
+        proxy = cls.normalizeProxy(proxy)
+        transport = cls.transports.get(proxy)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(
+                proxy=proxy, limits=cls.limits, verify=cls.sslContext, retries=1
+            )
+            cls.transports[proxy] = transport
+        return transport
+
+    @classmethod
+    def getConnector(cls, proxy: Optional[str]) -> aiohttp.TCPConnector:
+        """プロキシに対応するaiohttpのコネクタを取得します。
+        aiohttpではプロキシはリクエストごとに指定されるので、接続数の上限を分けるためだけにプロキシごとに作ります。
+
+        Args:
+            proxy (Optional[str]): プロキシのURL。
+
+        Returns:
+            aiohttp.TCPConnector: 共有されたコネクタ。
+        """
+        proxy = cls.normalizeProxy(proxy)
+        connector = cls.connectors.get(proxy)
+        if connector is None or connector.closed:
+            connector = aiohttp.TCPConnector(
+                limit=cls.limits.max_connections,
+                keepalive_timeout=cls.limits.keepalive_expiry,
+                ssl=cls.sslContext,
+            )
+            cls.connectors[proxy] = connector
+        return connector
+
+    @classmethod
+    def isPooled(cls, client: httpx.AsyncClient) -> bool:
+        """共有されたトランスポートを使っているクライアントかどうか。
+        このクライアントを閉じるとトランスポートも閉じてしまうので、閉じずに破棄してください。"""
+        return client in cls.pooledClients
+
+    @classmethod
+    def attach(cls, client: T, proxy: Optional[str]) -> T:
+        """決済サービスのクライアントが内部に持っているHTTPセッションを、共有された接続を使うものに差し替えます。
+        ヘッダーやクッキーはそのまま引き継がれます。
+
+        Args:
+            client (T): 決済サービスのクライアント。
+            proxy (Optional[str]): クライアントが使うプロキシのURL。
+
+        Returns:
+            T: 同じクライアント。
+        """
+        for name, value in list(vars(client).items()):
+            if isinstance(value, httpx.AsyncClient):
+                if cls.isPooled(value):
+                    continue
+                pooled = httpx.AsyncClient(
+                    transport=cls.getTransport(proxy),
+                    headers=value.headers,
+                    cookies=value.cookies,
+                    timeout=value.timeout,
+                    follow_redirects=value.follow_redirects,
+                    base_url=value.base_url,
+                )
+                cls.pooledClients.add(pooled)
+            elif isinstance(value, aiohttp.ClientSession):
+                if value.connector in cls.connectors.values():
+                    continue
+                pooled = aiohttp.ClientSession(
+                    connector=cls.getConnector(proxy),
+                    connector_owner=False,
+                    headers=value.headers,
+                    cookie_jar=value.cookie_jar,
+                    timeout=value.timeout,
+                )
+            else:
+                continue
+            setattr(client, name, pooled)
+            cls._close(value)
+        return client
+
+    @classmethod
+    def _close(cls, session: httpx.AsyncClient | aiohttp.ClientSession) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if isinstance(session, httpx.AsyncClient):
+            loop.create_task(session.aclose())
+        else:
+            loop.create_task(session.close())
+
+    @classmethod
+    async def closeClient(cls, client: Any) -> None:
+        """決済サービスのクライアントが内部に持っているHTTPセッションを閉じます。
+        共有された接続はほかのクライアントも使っているので閉じません。"""
+        for value in vars(client).values():
+            try:
+                if isinstance(value, httpx.AsyncClient):
+                    if not cls.isPooled(value):
+                        await value.aclose()
+                elif isinstance(value, aiohttp.ClientSession):
+                    await value.close()
+            except:
+                traceback.print_exc()
+
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        """プールの統計情報を返します。"""
+        return {
+            "transports": len(cls.transports),
+            "connectors": len(cls.connectors),
+            "clients": len(cls.pooledClients),
+        }
+
+    @classmethod
+    async def close(cls) -> None:
+        """すべての共有された接続を閉じます。"""
+        for transport in cls.transports.values():
+            await transport.aclose()
+        for connector in cls.connectors.values():
+            await connector.close()
+        cls.transports.clear()
+        cls.connectors.clear()
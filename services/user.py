@@ -0,0 +1,87 @@
+import asyncio
+from typing import Dict, Iterable, Optional
+
+import discord
+from discord.ext import commands
+
+from .cache import TTLCache
+from .singleflight import SingleFlight
+
+NOT_FOUND = object()
+
+
+class UserService:
+    """Discordのユーザー情報を解決するサービス
+    ゲートウェイのキャッシュ、TTLキャッシュ、REST APIの順に探します。
+    ボット全体で共有し、fetch_userを直接呼ぶ代わりに使用してください。"""
+
+    cache: TTLCache[int, discord.User | object] = TTLCache(maxsize=4096, ttl=600)
+    semaphore = asyncio.Semaphore(5)
+    inflight: SingleFlight[Optional[discord.User]] = SingleFlight()
+
+    @classmethod
+    async def _fetch(cls, bot: commands.Bot, userId: int) -> Optional[discord.User]:
+        # 同じユーザーの取得が同時に走った場合は、1回のリクエストにまとめる
+        return await cls.inflight.do(userId, lambda: cls._fetchProcess(bot, userId))
+
+    @classmethod
+    async def _fetchProcess(
+        cls, bot: commands.Bot, userId: int
+    ) -> Optional[discord.User]:
+        async with cls.semaphore:
+            for _ in range(2):
+                try:
+                    user = await bot.fetch_user(userId)
+                    break
+                except discord.NotFound:
+                    cls.cache.set(userId, NOT_FOUND, ttl=60)
+                    return None
+                except discord.RateLimited as e:
+                    # discord.py側で待ちきれなかったレートリミットは、一度だけ待ってから再試行する
+                    await asyncio.sleep(e.retry_after)
+            else:
+                return None
+        cls.cache.set(userId, user)
+        return user
+
+    @classmethod
+    async def getUser(cls, bot: commands.Bot, userId: int) -> Optional[discord.User]:
+        """ユーザーを取得します。
+
+        Args:
+            bot (commands.Bot): ボット。
+            userId (int): ユーザーのID。
+
+        Returns:
+            Optional[discord.User]: ユーザー。存在しない場合はNoneです。
+        """
+        return (await cls.getUsers(bot, [userId]))[userId]
+
+    @classmethod
+    async def getUsers(
+        cls, bot: commands.Bot, userIds: Iterable[int]
+    ) -> Dict[int, Optional[discord.User]]:
+        """複数のユーザーをまとめて取得します。
+        キャッシュにないユーザーは重複を除いて並行して取得されます。
+
+        Args:
+            bot (commands.Bot): ボット。
+            userIds (Iterable[int]): ユーザーのIDのリスト。
+
+        Returns:
+            Dict[int, Optional[discord.User]]: IDごとのユーザー。存在しない場合はNoneです。
+        """
+        users: Dict[int, Optional[discord.User]] = {}
+        missing = []
+        for userId in dict.fromkeys(userIds):
+            user = bot.get_user(userId) or cls.cache.get(userId)
+            if user is NOT_FOUND:
+                users[userId] = None
+            elif user:
+                users[userId] = user
+            else:
+                missing.append(userId)
+
+        fetched = await asyncio.gather(*(cls._fetch(bot, userId) for userId in missing))
+        users.update(zip(missing, fetched))
+        return users